@@ -10,14 +10,14 @@ from econtools.metrics.regutil import winsorize
 
 from util import UTM
 from util.system import data_path
-from util.distance import center_data, getdist
+from util.distance import center_data, within_any, SpatialIndex
 from util.buildblocks import swap_index, build_avg
 from clean import (load_geounit, load_bgdata, load_blocks, load_blocks_wzip,
                    load_bg_area, load_houses_places, std_cities, load_monitors,
                    load_houses_block2000)
 from clean.pr2 import load_stacks
 from atmods.io import load_full_exposure as aio_load_full_exposure
-from atmods.io import (_get_all_facids, load_firm_normed_exp,
+from atmods.io import (load_exposure_matrices,
                        formatted_firms_emission_grams_sec)
 from atmods.env import MAXDIST
 from analysis.regutils import (region_def_by_firm,)
@@ -339,7 +339,8 @@ def stacked_sale_data():
     df = _stack_em_up(facids, utms, RAW_STACKED_DIST_MAX_MI)
     df = _get_their_rawexposure(df, facids)
     # Merge in firm's emissions
-    emit = formatted_firms_noxgs().fillna(0).stack('quarter').to_frame('noxgs')
+    emit = formatted_firms_emission_grams_sec(stacked=True).fillna(0)
+    emit = emit.to_frame('noxgs')
     emit = emit.sort_index()
     df = df.reset_index().set_index(['facid', 'year', 'quarter']).sort_index()
     df = df.join(emit)
@@ -352,15 +353,16 @@ def stacked_sale_data():
 def _stack_em_up(facids, utms, max_miles):
     houses, _I = prep_regdata_sale()
     h_utm = houses[UTM].drop_duplicates()
+    house_index = SpatialIndex(h_utm)
     new_idx = pd.DataFrame()
     for facid in facids:
         print "Facid: {}".format(facid)
         this_utm = utms.loc[facid]
-        dist = getdist(h_utm, this_utm).squeeze().values
-        in_samp = dist <= max_miles*1.6
-        this_h_df = h_utm[in_samp].copy()
+        __, in_samp, dist = house_index.within(this_utm, max_miles*1.6)
+        order = np.argsort(in_samp)     # Keep houses' order
+        this_h_df = h_utm.iloc[in_samp[order]].copy()
         this_h_df['facid'] = facid
-        this_h_df['dist'] = dist[in_samp]
+        this_h_df['dist'] = dist[order]
         new_idx = new_idx.append(this_h_df)
 
     keepvars = ['property_id', 'year', 'quarter'] + UTM
@@ -375,16 +377,21 @@ def _get_their_rawexposure(df, facids):
     df.sort_index(inplace=True)
     exp_name = 'raw_exposure'
     df[exp_name] = np.nan
-    raw_exposure = all_raw_exposure('house', 'aermod')
-    raw_exposure.columns.name = 'facid'
-    raw_exposure.name = exp_name
+    utm_idx, exp_facids, matrices = all_raw_exposure('house', 'aermod')
+    exp_facids = pd.Index(exp_facids)
+    quarters = pd.Index(range(1, 4 + 1), name='quarter')
 
     for facid in facids:
         print "Exp facid {}".format(facid)
         if facid not in facids_in_df:
             print "skipped!"
             continue
-        this_facid = raw_exposure[facid].to_frame(exp_name)
+        col = exp_facids.get_loc(facid)
+        this_facid = pd.DataFrame(
+            np.column_stack([mat[:, col].toarray().ravel()
+                             for mat in matrices]),
+            index=utm_idx, columns=quarters)
+        this_facid = this_facid.stack('quarter').to_frame(exp_name)
         this_facid['facid'] = facid
         this_facid.set_index('facid', append=True, inplace=True)
         df.update(this_facid)
@@ -748,7 +755,7 @@ def center_sw(regdata, maxdist=SAMPLE_REGION_DIST, convex=False):
     region_points = load_stacks(firmlist).groupby('facid')[UTM].mean()
     _push_out_southwest(region_points)
     # Main "distance from seed firms" criterion
-    in_region = getdist(df, region_points, within=maxdist).max(axis=1)
+    in_region = within_any(df, region_points, maxdist)
 
     if convex:
         # Add area between circles
@@ -950,32 +957,21 @@ def firms_affecting_region(maxdist=SAMPLE_REGION_DIST, region='sw'):
 
 
 # Methods that have to be here to use `center_sw`
-@load_or_build(data_path('{}s_rawfirm_{}.p'), path_args=[0, 1])
 def all_raw_exposure(geounit, model):
-    """ DataFrame of *all* raw expsoure, at once """
+    """
+    *All* firms' raw exposure at `center_sw` receptors, as (`utm_idx`,
+    `facids`, `matrices`), one sparse (receptor x facid) matrix per quarter
+    (see `atmods.io.load_exposure_matrices`).
+    """
     # NOTE: This should be in `atmods.io`, BUT without restricting data with
     # `center_sw`, it is way too big. So this has to be here to avoid circular
     # imports
 
-    firm_list = _get_all_facids(geounit, model)
-    # Initialize output matrix
+    utm_idx, facids, matrices = load_exposure_matrices(geounit, model)
     utms = center_sw(load_geounit(geounit)[UTM].drop_duplicates())
-    utm_idx = utms.set_index(UTM).index
-    pn = pd.Panel(np.zeros((len(firm_list), len(utms), 4)),
-                  items=firm_list,
-                  major_axis=utm_idx,
-                  minor_axis=range(1, 4 + 1),
-                  )
-    pn.minor_axis.name = 'quarter'
-    for facid in firm_list:
-        print "Facid: {}".format(facid)
-        this_firms = load_firm_normed_exp(geounit, model, facid)
-        pn[facid].update(this_firms)
-        del this_firms
-
-    df = pn.to_frame().astype(np.float32)   # Cast to float just in case
-
-    return df
+    rows = utm_idx.get_indexer(utms.set_index(UTM).index)
+    rows = rows[rows >= 0]
+    return utm_idx[rows], facids, [mat[rows] for mat in matrices]
 
 
 def load_full_exposure(geounit, model, **kwargs):
@@ -1050,4 +1046,4 @@ def _def_monitor_samp(year, quarter):
 
 
 if __name__ == '__main__':
-    df = all_raw_exposure('house', 'aermod')
+    utm_idx, facids, matrices = all_raw_exposure('house', 'aermod')
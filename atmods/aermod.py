@@ -7,9 +7,15 @@ import subprocess
 import sys
 import time
 import tempfile
+import Queue
+import StringIO
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
 
 from atmods.env import (SCRATCH_PATH, AERMOD_SRC_PATH, PATH_FOR_MET,
-                        AERMOD_OUTPUT_FILE, COMMAND)
+                        AERMOD_OUTPUT_FILE, BIN_NAME)
 
 # TODO: Check that passed DF columns are all kosher
 
@@ -59,12 +65,48 @@ STACK_TEMPLATE = (
     " {stack_veloc} {stack_diam}")
 
 POLAR_TEMPLATE = (spaces3 + "GRIDPOLR POL1 STA\n" +
-                  spaces17 + "ORIG STACK1\n" +
-                  spaces17 + "DIST {radii}\n" +
+                  spaces17 + "ORIG {orig_east} {orig_north}\n" +
+                  "{radii}" +
                   spaces17 + "GDIR {radial_bins} {deg_start} {deg_step}\n" +
                   spaces3 + "GRIDPOLR POL1 END")
+POLAR_DIST_LINE = spaces17 + "DIST {}\n"
+POLAR_DISTS_PER_LINE = 8
+# Default polar grid spacing (degrees) for `Aermod(polar=True)`
+POLAR_DEG_STEP = 5
 
 STACKVARS = ['stack_ht', 'stack_temp', 'stack_veloc', 'stack_diam']
+# Everything about a stack that Aermod output depends on, except emissions
+STACK_GEOMETRY = ['utm_east', 'utm_north'] + STACKVARS
+# `facid` for unit-emission runs. It's only used in the input file's title,
+# so a constant lets identical stacks from different firms share cache entries
+UNIT_FACID = 0
+
+# Printed after each Aermod run, see `Aermod.call_aermod`
+TIMING_LINE = ("{units} units, {sec_per_unit:.4f} sec per unit, "
+               "{stacks} stacks, {receptors} receptors, "
+               "stack_ht {stack_ht:.2f}, met {metsite}")
+
+# %-style versions of the templates above for bulk formatting, see
+# `_write_lines`. Order of `STACK_LINE` fields is `id`, UTM, `id`,
+# `emit_share`, `STACKVARS`.
+RECEPTOR_LINE = '\n   DISCCART %s %s'
+STACK_LINE = (
+    "\n   LOCATION STACK%s POINT %s %s"
+    "\n   SRCPARAM STACK%s %s %s %s %s %s")
+# Lines formatted and written per `write` call
+WRITE_BLOCK_ROWS = 20000
+
+# POSTFILE columns are X, Y, AVERAGE CONC, ZELEV, ZHILL, ZFLAG, AVE, GRP,
+# DATE (e.g., 378647.00, 3782677.00, 16.43396, 22.00, 22.00, 0.00, MONTH, ALL,
+# 09013124). Only read these.
+POSTFILE_UTM_EAST = 0
+POSTFILE_UTM_NORTH = 1
+POSTFILE_EXPOSURE = 2
+POSTFILE_DATE = 8
+POSTFILE_USECOLS = {POSTFILE_UTM_EAST: np.float64,
+                    POSTFILE_UTM_NORTH: np.float64,
+                    POSTFILE_EXPOSURE: np.float32,
+                    POSTFILE_DATE: np.int64}
 
 
 class Aermod(object):
@@ -93,9 +135,42 @@ class Aermod(object):
         WARNING: This is meant to be used with only one source at a time, but
         can support multiple firms in one DataFrame for testing purposes. But
         the meteorological data will be taken from the first source only.
+    quiet : bool
+        Suppress AERMOD's stdout.
+    cleanup : bool
+        Delete the temp instance folder after the run. Ignored if `pool` is
+        passed.
+    pool : AermodPool, optional
+        Run in one of the pool's warm instance folders instead of creating
+        (and deleting) a fresh one.
+    shards : int
+        Split `receptorDF` into this many spatial shards and run them as
+        concurrent Aermod processes (see `run_sharded`).
+    processes : int, optional
+        Size of process pool for `shards`. Defaults to `shards` or number of
+        CPU's, whichever is smaller.
+    reducer : callable, optional
+        Called as `reducer(postfile_path, receptorDF)` in place of
+        `read_output`, e.g., to stream the POSTFILE straight to a smaller
+        frame. Its output is divided by `PRECISION_SCALE`. Must be picklable
+        (module level) if `shards` > 1.
+    polar : bool
+        Run Aermod on a polar grid centered on the stacks instead of on
+        `receptorDF` directly, then interpolate to `receptorDF` with
+        `polar_bilinear`. Output is the same format as usual.
+    polar_radii : array-like, optional
+        Ring distances (meters) for `polar`. Default is `default_polar_radii`
+        out to the farthest receptor.
+    polar_step : float
+        Degrees between the polar grid's spokes.
+    cache : atmods.cache.AermodCache, optional
+        Look up output in `cache` before running Aermod, store it after.
     """
 
-    def __init__(self, receptorDF, sourceDF, quiet=False, cleanup=True):
+    def __init__(self, receptorDF, sourceDF, quiet=False, cleanup=True,
+                 pool=None, shards=1, processes=None, reducer=None,
+                 polar=False, polar_radii=None, polar_step=POLAR_DEG_STEP,
+                 cache=None):
 
         self.receptorDF = receptorDF.copy()
 
@@ -108,21 +183,64 @@ class Aermod(object):
         else:
             self.sourceDF = pd.DataFrame(sourceDF).copy()
 
+        if polar and (shards > 1 or reducer is not None):
+            raise ValueError("`polar` can't be used with `shards`/`reducer`")
+
+        self.shards = shards
+        self.processes = processes
+        if shards > 1:
+            # Shards build their own `Aermod`, keep unscaled `emit_share`
+            self._raw_sourceDF = self.sourceDF.copy()
+
         # Scale up `emit_share` for decimal precision
         self.sourceDF['emit_share'] *= PRECISION_SCALE
 
         self.quiet = quiet
         self.cleanup = cleanup
+        self.pool = pool
+        self.reducer = reducer
+        self.cache = cache
+
+        self.polar = polar
+        if polar:
+            utm = self.sourceDF[['utm_east', 'utm_north']].astype(float)
+            self.polar_origin = utm.mean().values
+            if polar_radii is None:
+                polar_radii = default_polar_radii(
+                    self._receptor_dists()[2].max())
+            self.polar_radii = np.sort(np.asarray(polar_radii, dtype=float))
+            self.polar_step = polar_step
 
     def runModel(self):
+        if self.cache is None:
+            return self._run_uncached()
+
+        key = self.cache.key(self)
+        output = self.cache.get(key)
+        if output is None:
+            output = self._run_uncached()
+            self.cache.put(key, output)
+        elif not self.quiet:
+            print "Aermod output found in cache ({})".format(key)
+        return output
+
+    def _run_uncached(self):
+        if self.shards > 1:
+            return run_sharded(self.receptorDF, self._raw_sourceDF,
+                               self.shards, processes=self.processes,
+                               quiet=self.quiet, cleanup=self.cleanup,
+                               reducer=self.reducer)
+
+        if self.pool is not None:
+            self.instance_path = self.pool.acquire()
+            try:
+                output = self._run_in_instance()
+            finally:
+                self.pool.release(self.instance_path)
+            return output
+
         self.instance_path = self.prep_aermod_directory()
-        inp_contents, unit_count = self.make_inp_file()
-        with open(os.path.join(self.instance_path, 'aermod.inp'), 'w') as f:
-            f.write(inp_contents)
-        self.call_aermod(unit_count)
-        # Format output
-        output = self.read_output()
-        output['exposure'] /= PRECISION_SCALE  # Re-scale exposure
+        output = self._run_in_instance()
         # Clean up temp folder
         if self.cleanup:
             try:
@@ -134,6 +252,22 @@ class Aermod(object):
 
         return output
 
+    def _run_in_instance(self):
+        with open(os.path.join(self.instance_path, 'aermod.inp'), 'w') as f:
+            unit_count = self.write_inp_file(f)
+        self.call_aermod(unit_count)
+        # Format output
+        if self.polar:
+            output = self._interpolate_polar(self.read_output())
+            output['exposure'] /= PRECISION_SCALE  # Re-scale exposure
+        elif self.reducer is None:
+            output = self.read_output()
+            output['exposure'] /= PRECISION_SCALE  # Re-scale exposure
+        else:
+            output = self.reducer(self.postfile_path(), self.receptorDF)
+            output /= PRECISION_SCALE
+        return output
+
     def prep_aermod_directory(self):
         try:
             inst_path = tempfile.mkdtemp(dir=SCRATCH_PATH)
@@ -148,78 +282,534 @@ class Aermod(object):
         return inst_path
 
     def make_inp_file(self):
-
+        """Return contents of 'aermod.inp' as a string, and the unit count."""
+        buf = StringIO.StringIO()
+        unit_count = self.write_inp_file(buf)
+        return buf.getvalue(), unit_count
+
+    def write_inp_file(self, f):
+        """
+        Write 'aermod.inp' to open file `f` block by block, so the full input
+        is never held in memory. Returns unit count (stacks x receptors).
+        """
         inp_variables = self.sourceDF.iloc[0, :].to_dict()
-
-        # Receptors
-        receptor_list = [RECEPTOR_TEMPLATE.format(**row.to_dict())
-                         for idx, row in self.receptorDF.iterrows()]
-        inp_variables['receptors'] = ''.join(receptor_list)
-
-        # Sources
-        source_list = []    # Gather all the strings
-        source_id = 1       # To name the stacks uniquely
-        for idx, sourcerow in self.sourceDF.iterrows():
-            source_list.append(
-                STACK_TEMPLATE.format(id=source_id, **sourcerow.to_dict()))
-            source_id += 1
-        inp_variables['sources'] = ''.join(source_list)
-
         # Metfiles
         inp_variables['met_file_path'] = PATH_FOR_MET
         inp_variables['aermod_output'] = AERMOD_OUTPUT_FILE
 
-        unit_count = len(source_list) * len(receptor_list)
-        return INP_TEMPLATE.format(**inp_variables), unit_count
+        head, rest = INP_TEMPLATE.split('{sources}')
+        middle, tail = rest.split('{receptors}')
+
+        f.write(head.format(**inp_variables))
+        # Sources
+        num_stacks = self.sourceDF.shape[0]
+        source_id = np.arange(1, num_stacks + 1)    # To name stacks uniquely
+        stack_cols = [source_id, 'utm_east', 'utm_north',
+                      source_id, 'emit_share'] + STACKVARS
+        _write_lines(f, STACK_LINE, _object_block(self.sourceDF, stack_cols))
+        f.write(middle.format(**inp_variables))
+        # Receptors
+        if self.polar:
+            f.write('\n' + self._polar_block())
+            num_receptors = len(self.polar_radii) * self._polar_dirs()
+        else:
+            receptors = self.receptorDF[['utm_east', 'utm_north']].values
+            _write_lines(f, RECEPTOR_LINE, receptors)
+            num_receptors = receptors.shape[0]
+        f.write(tail.format(**inp_variables))
+
+        unit_count = num_stacks * num_receptors
+        return unit_count
+
+    def _polar_dirs(self):
+        return int(round(360. / self.polar_step))
+
+    def _polar_block(self):
+        radii = [str(r) for r in self.polar_radii]
+        dist_lines = ''.join(
+            POLAR_DIST_LINE.format(' '.join(
+                radii[i:i + POLAR_DISTS_PER_LINE]))
+            for i in xrange(0, len(radii), POLAR_DISTS_PER_LINE))
+        return POLAR_TEMPLATE.format(orig_east=self.polar_origin[0],
+                                     orig_north=self.polar_origin[1],
+                                     radii=dist_lines,
+                                     radial_bins=self._polar_dirs(),
+                                     deg_start=self.polar_step,
+                                     deg_step=self.polar_step)
+
+    def _receptor_dists(self):
+        """Receptors' (dx, dy) and distance (meters) from `polar_origin`."""
+        dx = self.receptorDF['utm_east'].values - self.polar_origin[0]
+        dy = self.receptorDF['utm_north'].values - self.polar_origin[1]
+        return dx, dy, np.sqrt(dx ** 2 + dy ** 2)
+
+    def _interpolate_polar(self, polar_output):
+        """
+        Put Aermod's polar grid output on a (ring x spoke x month) array and
+        interpolate to `receptorDF`. Returns frame in `read_output` format,
+        months in order, receptors in `receptorDF` order within month.
+        """
+        num_dirs = self._polar_dirs()
+        months = np.unique(polar_output['month'].values)
+        grid = np.full((len(self.polar_radii), num_dirs, len(months)), np.nan,
+                       dtype=np.float32)
+        # Find each output point's ring and spoke
+        dx = polar_output['utm_east'].values - self.polar_origin[0]
+        dy = polar_output['utm_north'].values - self.polar_origin[1]
+        ring_mids = (self.polar_radii[1:] + self.polar_radii[:-1]) / 2
+        ring = np.searchsorted(ring_mids, np.sqrt(dx ** 2 + dy ** 2))
+        spoke = np.around(
+            (_compass_deg(dx, dy) - self.polar_step) / self.polar_step)
+        spoke = spoke.astype(int) % num_dirs
+        month_idx = np.searchsorted(months, polar_output['month'].values)
+        grid[ring, spoke, month_idx] = polar_output['exposure'].values
+
+        rec_dx, rec_dy, __ = self._receptor_dists()
+        interp = polar_bilinear(grid, self.polar_radii, self.polar_step,
+                                self.polar_step, rec_dx, rec_dy)
+
+        N = len(self.receptorDF)
+        output = pd.DataFrame({
+            'utm_east': np.tile(
+                self.receptorDF['utm_east'].values.astype(np.int32),
+                len(months)),
+            'utm_north': np.tile(
+                self.receptorDF['utm_north'].values.astype(np.int32),
+                len(months)),
+            'exposure': interp.T.ravel().astype(np.float32),
+            'month': np.repeat(months, N).astype(np.int8),
+        }, columns=['utm_east', 'utm_north', 'exposure', 'month'])
+        return output
 
     def call_aermod(self, unit_count=0):
+        # Run with `cwd` instead of `os.chdir` so multiple instances can run
+        # at once from the same Python process (see `AermodPool`)
+        command = os.path.join(self.instance_path, BIN_NAME)
+        # Raise instead of `sys.exit` so a failure in an `AermodPool` worker
+        # thread reaches the caller; only the scripts exit.
         start = time.time()
-        working_dir = os.getcwd()
-        os.chdir(self.instance_path)
         try:
             if self.quiet:
                 with open(os.devnull, 'w') as fnull:
-                    subprocess.call(COMMAND, stdout=fnull)
+                    returncode = subprocess.call(command, stdout=fnull,
+                                                 cwd=self.instance_path)
             else:
-                subprocess.call(COMMAND)
-        except KeyboardInterrupt:
-            os.chdir(working_dir)
-            raise
-        except:
-            print "Aermod failed unexpectedly: ", sys.exc_info()[0]
-            sys.exit(1)
-        finally:
-            os.chdir(working_dir)
+                returncode = subprocess.call(command, cwd=self.instance_path)
+        except OSError as e:
+            raise RuntimeError("Aermod failed to start in {}: {}".format(
+                self.instance_path, e))
+        if returncode != 0:
+            raise RuntimeError("Aermod in {} exited with code {}".format(
+                self.instance_path, returncode))
         end = time.time()
         if unit_count > 0:
             time_per_unit = (end - start) / unit_count
-            print "{} units, {:.4f} sec per unit".format(unit_count,
-                                                         time_per_unit)
+            # Parsed by `atmods.timing.parse_timing_lines`, keep in sync
+            num_stacks = self.sourceDF.shape[0]
+            print TIMING_LINE.format(
+                units=unit_count, sec_per_unit=time_per_unit,
+                stacks=num_stacks, receptors=unit_count // num_stacks,
+                stack_ht=self.sourceDF['stack_ht'].mean(),
+                metsite=self.sourceDF['metsite_code'].iloc[0])
             sys.stdout.flush()
 
-    def read_output(self):
+    def read_output(self, chunksize=None):
+        """
+        Read Aermod's POSTFILE. See `read_postfile` for output format and
+        `chunksize`.
+        """
+        return read_postfile(self.postfile_path(), chunksize=chunksize)
+
+    def postfile_path(self):
         aermod_results_path = os.path.join(self.instance_path,
                                            AERMOD_OUTPUT_FILE)
 
         if os.path.getsize(aermod_results_path) < 1:
             raise IOError('Aermod did not run! Output is Empty!')
 
-        columns = ['utm_east', 'utm_north', 'exposure',
-                   'crap1',     # ex: 22.00
-                   'crap2',     # ex: 22.00
-                   'crap3',     # ex: 0.00
-                   'crap4',     # ex: MONTH
-                   'crap5',     # ex: ALL
-                   'rawdate']
-        usecols = ['utm_east', 'utm_north', 'exposure', 'rawdate']
-        raw_output = pd.read_table(aermod_results_path,
-                                   sep='\s*', engine='python',
-                                   names=columns, usecols=usecols)
-
-        # Time unit for reported averages set in 'aermod.inp' file
-        raw_output['month'] = raw_output['rawdate'].apply(
-            lambda x: int(str(x)[-6:-4])
-        )
-        del raw_output['rawdate']
-
-        return raw_output
+        return aermod_results_path
+
+
+def read_postfile(filepath, chunksize=None):
+    """
+    Read Aermod POSTFILE (MONTH averages, PLOT format, NOHEADER) at
+    `filepath` with pandas' C parser, keeping only UTM, exposure, and the
+    month.
+
+    Returns DataFrame with columns
+        'utm_east', 'utm_north' (int32), 'exposure' (float32), 'month' (int8)
+    If `chunksize` is set, returns an iterator of such DataFrames with
+    `chunksize` rows each, for files too big to read at once.
+    """
+    reader = pd.read_csv(filepath, delim_whitespace=True, header=None,
+                         usecols=POSTFILE_USECOLS.keys(),
+                         dtype=POSTFILE_USECOLS, engine='c',
+                         chunksize=chunksize)
+    if chunksize is None:
+        return _typed_postfile(reader)
+    else:
+        return (_typed_postfile(chunk) for chunk in reader)
+
+
+def _typed_postfile(raw):
+    out = pd.DataFrame({
+        # UTM read from aermod as float, change to int
+        'utm_east': raw[POSTFILE_UTM_EAST].values.astype(np.int32),
+        'utm_north': raw[POSTFILE_UTM_NORTH].values.astype(np.int32),
+        'exposure': raw[POSTFILE_EXPOSURE].values,
+        # Date is YYMMDDHH, time unit for averages set in 'aermod.inp' file
+        'month': (raw[POSTFILE_DATE].values // 10000 % 100).astype(np.int8),
+    }, columns=['utm_east', 'utm_north', 'exposure', 'month'])
+    return out
+
+
+class AermodPool(object):
+    """
+    Pool of warm Aermod instance folders, reused across many runs.
+
+    Each folder gets the Aermod binary (hard-linked, symlinked, or copied, in
+    that order of preference) once, when the pool is created. After each run
+    the folder is emptied of everything but the binary and handed back to the
+    pool. Because `Aermod.call_aermod` runs the binary with `cwd`, up to
+    `size` instances can run at once from one Python process (see
+    `run_many`).
+
+    Use as a context manager so the folders are removed when done:
+
+        with AermodPool(4) as pool:
+            out = pool.run(receptorDF, sourceDF)
+    """
+
+    def __init__(self, size=1, scratch_path=SCRATCH_PATH):
+        self.size = size
+        self.scratch_path = scratch_path
+        self._paths = []
+        self._idle = Queue.Queue()
+        for __ in xrange(size):
+            inst_path = self._make_instance()
+            self._paths.append(inst_path)
+            self._idle.put(inst_path)
+
+    def _make_instance(self):
+        try:
+            inst_path = tempfile.mkdtemp(dir=self.scratch_path)
+        except:
+            print 'Scratch directory creation failed!'
+            raise
+        _link_binary(AERMOD_SRC_PATH, os.path.join(inst_path, BIN_NAME))
+        return inst_path
+
+    def acquire(self):
+        """Block until an instance folder is free, then return its path."""
+        return self._idle.get()
+
+    def release(self, inst_path):
+        """Empty `inst_path` (except the binary) and return it to the pool."""
+        _clear_instance(inst_path)
+        self._idle.put(inst_path)
+
+    def run(self, receptorDF, sourceDF, **kwargs):
+        return Aermod(receptorDF, sourceDF, pool=self, **kwargs).runModel()
+
+    def run_many(self, jobs, **kwargs):
+        """
+        Run list of (`receptorDF`, `sourceDF`) pairs concurrently, `size` at
+        a time. Returns list of outputs in the same order as `jobs`.
+        """
+        def _run(job):
+            return self.run(job[0], job[1], **kwargs)
+        threads = ThreadPool(self.size)
+        try:
+            outputs = threads.map(_run, jobs)
+        finally:
+            threads.close()
+            threads.join()
+        return outputs
+
+    def close(self):
+        while self._paths:
+            inst_path = self._paths.pop()
+            try:
+                shutil.rmtree(inst_path)
+            except OSError:
+                print "Err deleting tmp folder: {}".format(inst_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _link_binary(src, dst):
+    """Link Aermod binary into instance folder, copy if links unsupported."""
+    try:
+        os.link(src, dst)
+        return
+    except (OSError, AttributeError):
+        pass
+    try:
+        os.symlink(src, dst)
+        return
+    except (OSError, AttributeError):
+        pass
+    try:
+        shutil.copy2(src, dst)
+    except:
+        print 'Aermod source copy failed!'
+        raise
+
+
+def _clear_instance(inst_path):
+    """Delete everything in `inst_path` except the Aermod binary."""
+    for fname in os.listdir(inst_path):
+        if fname == BIN_NAME:
+            continue
+        fpath = os.path.join(inst_path, fname)
+        if os.path.isdir(fpath):
+            shutil.rmtree(fpath)
+        else:
+            os.remove(fpath)
+
+
+def run_linear(receptorDF, sourceDF, unit_receptors=None, **kwargs):
+    """
+    Same output as `Aermod(receptorDF, sourceDF, **kwargs).runModel()`, but
+    built from one unit-emission run per unique stack geometry (see
+    `unit_stack_sources`), weighted by `emit_share`.
+
+    Aermod concentrations are linear in the emission rate, so with a `cache`
+    in `kwargs` the unit runs are stored and later changes to `emit_share`
+    only redo the weighted sum. If `kwargs` has a `pool`, unit runs go
+    through `AermodPool.run_many`.
+
+    `unit_receptors` is an optional list of receptor frames, one per unit
+    source, each a superset of `receptorDF`, to run the unit sources on
+    instead (e.g., so other firms' runs of the same stack are cache hits).
+    Each output is then cut down to `receptorDF`, so it needs a `reducer`
+    that indexes output by UTM.
+    """
+    unit_sources, weights = unit_stack_sources(sourceDF)
+    if unit_receptors is None:
+        unit_receptors = [receptorDF] * len(unit_sources)
+    elif kwargs.get('reducer') is None:
+        raise ValueError("`unit_receptors` needs a `reducer`")
+    elif len(unit_receptors) != len(unit_sources):
+        raise ValueError("Need one `unit_receptors` per unit source")
+    jobs = [(unit_receptors[i], unit_sources.iloc[[i]])
+            for i in xrange(len(unit_sources))]
+    pool = kwargs.pop('pool', None)
+    if pool is not None:
+        unit_outputs = pool.run_many(jobs, **kwargs)
+    else:
+        unit_outputs = [Aermod(receptors, source, **kwargs).runModel()
+                        for receptors, source in jobs]
+    if any(receptors is not receptorDF for receptors in unit_receptors):
+        unit_outputs = [_restrict_to_receptors(output, receptorDF)
+                        for output in unit_outputs]
+    return combine_unit_runs(unit_outputs, weights)
+
+
+def _restrict_to_receptors(output, receptorDF):
+    """Rows of UTM-indexed `output` at `receptorDF`'s receptors."""
+    wanted = pd.MultiIndex.from_arrays(
+        [receptorDF[x].values.astype(np.int32)
+         for x in ('utm_east', 'utm_north')])
+    keep = output.index.isin(wanted)
+    if keep.sum() != len(wanted.unique()):
+        raise ValueError("Unit run doesn't cover every receptor!")
+    return output[keep]
+
+
+def unit_stack_sources(sourceDF):
+    """
+    Collapse `sourceDF` to unique `STACK_GEOMETRY`s with `emit_share` 1.
+
+    Returns the unit-emission sources (with the first source's met and
+    population info, as `Aermod` uses) and array of each geometry's summed
+    `emit_share`.
+    """
+    if isinstance(sourceDF, pd.Series):
+        sourceDF = sourceDF.to_frame().T
+    sourceDF = sourceDF.reset_index(drop=True)
+    geometry = sourceDF[STACK_GEOMETRY].astype(float)
+    geometry_id = geometry.groupby(STACK_GEOMETRY, sort=False).ngroup()
+    weights = sourceDF['emit_share'].astype(float).groupby(
+        geometry_id.values).sum().values
+
+    first = ~geometry_id.duplicated()
+    unit_sources = sourceDF[first.values].reset_index(drop=True)
+    for col in unit_sources.columns.difference(STACK_GEOMETRY):
+        unit_sources[col] = sourceDF[col].iloc[0]
+    unit_sources['emit_share'] = 1.
+    unit_sources['facid'] = UNIT_FACID
+
+    return unit_sources, weights
+
+
+def combine_unit_runs(unit_outputs, weights):
+    """
+    Weighted sum of unit-emission Aermod outputs. Outputs can be long
+    (`read_output` format, 'exposure' column) or all-exposure frames (e.g.,
+    from a `reducer`), but must share the same rows.
+    """
+    first = unit_outputs[0]
+    long_format = 'exposure' in first.columns
+    for output in unit_outputs[1:]:
+        if not output.index.equals(first.index):
+            raise ValueError("Unit runs' outputs don't line up!")
+        if long_format:
+            utm = ['utm_east', 'utm_north', 'month']
+            if not (output[utm].values == first[utm].values).all():
+                raise ValueError("Unit runs' outputs don't line up!")
+
+    if long_format:
+        stacked = np.stack([x['exposure'].values for x in unit_outputs])
+    else:
+        stacked = np.stack([x.values for x in unit_outputs])
+    combined = np.tensordot(np.asarray(weights, dtype=stacked.dtype),
+                            stacked, axes=1)
+
+    output = first.copy()
+    if long_format:
+        output['exposure'] = combined
+    else:
+        output[:] = combined
+    return output
+
+
+def default_polar_radii(max_dist):
+    """
+    Polar ring distances (meters): every 100 m out to 1 km, every 250 m out
+    to 5 km, then every 500 m past `max_dist`.
+    """
+    far_edge = max(max_dist, 5000) + 500
+    radii = np.concatenate((np.arange(100, 1000, 100),
+                            np.arange(1000, 5000, 250),
+                            np.arange(5000, far_edge + 1, 500)))
+    return radii
+
+
+def polar_bilinear(grid, radii, deg_start, deg_step, dx, dy):
+    """
+    Bilinear interpolation in polar coordinates.
+
+    `grid` is (ring x spoke x ...) values on rings `radii` (meters, sorted)
+    and spokes at `deg_start + k * deg_step` degrees clockwise from north.
+    `dx`, `dy` are target points relative to the grid's origin. Returns
+    (target x ...) array. Targets inside the first ring or outside the last
+    are clamped to that ring; spokes wrap around at 360.
+    """
+    radii = np.asarray(radii, dtype=float)
+    if len(radii) < 2:
+        raise ValueError("Polar grid needs at least 2 rings.")
+    num_dirs = grid.shape[1]
+    # Ring weights
+    r = np.clip(np.sqrt(dx ** 2 + dy ** 2), radii[0], radii[-1])
+    i0 = np.clip(np.searchsorted(radii, r, side='right') - 1,
+                 0, len(radii) - 2)
+    i1 = i0 + 1
+    t = (r - radii[i0]) / (radii[i1] - radii[i0])
+    # Spoke weights
+    spoke_pos = ((_compass_deg(dx, dy) - deg_start) / deg_step) % num_dirs
+    j0 = np.floor(spoke_pos).astype(int) % num_dirs
+    j1 = (j0 + 1) % num_dirs
+    u = spoke_pos - np.floor(spoke_pos)
+
+    extra_dims = (slice(None),) + (None,) * (grid.ndim - 2)
+    t, u = t[extra_dims], u[extra_dims]
+    interp = ((1 - t) * (1 - u) * grid[i0, j0] +
+              t * (1 - u) * grid[i1, j0] +
+              (1 - t) * u * grid[i0, j1] +
+              t * u * grid[i1, j1])
+    return interp
+
+
+def _compass_deg(dx, dy):
+    """Direction in degrees clockwise from north, [0, 360)."""
+    return np.degrees(np.arctan2(dx, dy)) % 360
+
+
+def _write_lines(f, line_fmt, arr):
+    """
+    Write `line_fmt % row` for each row of 2D array `arr` to `f`, formatting
+    `WRITE_BLOCK_ROWS` rows at a time with a single `%` call.
+    """
+    for start in xrange(0, arr.shape[0], WRITE_BLOCK_ROWS):
+        block = arr[start:start + WRITE_BLOCK_ROWS]
+        f.write((line_fmt * block.shape[0]) % tuple(block.ravel().tolist()))
+
+
+def _object_block(df, cols):
+    """
+    Stack `cols` (names in `df` or arrays) into a 2D object array, keeping
+    each column's own type (so ints print as ints, like `str.format` would).
+    """
+    arr = np.empty((df.shape[0], len(cols)), dtype=object)
+    for j, col in enumerate(cols):
+        if isinstance(col, str):
+            col = df[col].values
+        arr[:, j] = col
+    return arr
+
+
+def run_sharded(receptorDF, sourceDF, shards, processes=None, **kwargs):
+    """
+    Split `receptorDF` into `shards` spatial shards, run each shard as its own
+    Aermod process on a local process pool, and merge the output.
+
+    Output is the same as `Aermod.runModel`, including row order (month, then
+    receptor in `receptorDF` order). `kwargs` are passed to `Aermod`. If
+    `kwargs` has a `reducer`, its outputs are assumed to be indexed by
+    receptor and are stacked and sorted by index.
+    """
+    receptorDF = receptorDF.reset_index(drop=True)
+    shard_positions = shard_receptors(receptorDF, sourceDF, shards)
+    jobs = [(receptorDF.iloc[pos], sourceDF, kwargs)
+            for pos in shard_positions]
+
+    if processes is None:
+        processes = min(len(jobs), mp.cpu_count())
+    workers = mp.Pool(processes)
+    try:
+        outputs = workers.map(_run_shard, jobs)
+    finally:
+        workers.close()
+        workers.join()
+
+    if kwargs.get('reducer') is not None:
+        return pd.concat(outputs).sort_index()
+
+    # Aermod output is month by month, receptors in input order within month,
+    # so output row `i` is shard receptor `i % shard_size`
+    for output, pos in zip(outputs, shard_positions):
+        output['_pos'] = np.tile(pos, len(output) // len(pos))
+    merged = pd.concat(outputs, ignore_index=True)
+    merged = merged.sort_values(['month', '_pos'])
+    del merged['_pos']
+    merged.reset_index(drop=True, inplace=True)
+
+    return merged
+
+
+def _run_shard(job):
+    receptorDF, sourceDF, kwargs = job
+    return Aermod(receptorDF, sourceDF, **kwargs).runModel()
+
+
+def shard_receptors(receptorDF, sourceDF, shards):
+    """
+    Return list of `shards` arrays of row positions in `receptorDF`. Shards are
+    equal-sized angular sectors around the sources' centroid, so each is a
+    compact wedge of the receptor field. Positions within a shard are sorted.
+    """
+    shards = max(1, min(shards, len(receptorDF)))
+    source_utm = sourceDF[['utm_east', 'utm_north']].values.astype(float)
+    if source_utm.ndim == 2:
+        center = source_utm.mean(axis=0)
+    else:
+        center = source_utm
+    dx = receptorDF['utm_east'].values - center[0]
+    dy = receptorDF['utm_north'].values - center[1]
+    by_angle = np.argsort(np.arctan2(dy, dx), kind='mergesort')
+    return [np.sort(pos) for pos in np.array_split(by_angle, shards)]
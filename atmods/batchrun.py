@@ -1,17 +1,48 @@
+import os
 import sys
 import subprocess
 from os.path import expanduser
 from time import sleep
+from datetime import datetime
 
 import numpy as np
+import pandas as pd
 
 from econtools import confirmer
 
+from util.system import data_path
+from atmods.env import JOB_OUT_PATH
 from atmods.io import normed_firmexp_fname, parse_firm_info
 from atmods.wrapperargs import Sbatch
-from atmods.chunktools import calc_resources, calc_aermod_units
+from atmods.chunktools import (calc_resources, calc_aermod_units,
+                               plan_unique_sources, dedup_report,
+                               SOURCE_CONFIG)
 from atmods.check_jobs import jobs_to_run
 from atmods.run_and_write import run_and_write
+from atmods.executors import Executor, LocalExecutor, FirmChunk
+
+# Replace with a stand-in to test submission without Slurm
+SBATCH_COMMAND = 'sbatch'
+# Job arrays round time requests up to one of these (minutes) so firm-chunks
+# share a few arrays
+ARRAY_TIME_CLASSES = (30, 60, 120, 240, 480, 960, 1440)
+# Target run time (minutes) of jobs packed from small firm-chunks
+PACK_MINUTES = 120.
+MANIFEST_PATH = data_path('manifests')
+
+SBATCH_HEADER = (
+    '#!/usr/bin/env bash\n'
+    '#SBATCH --job-name {jobname}\n'
+    '#SBATCH --output {job_out}/{logname}.out\n'
+    '#SBATCH --error {job_out}/{logname}.err\n'
+    '#SBATCH -p {partition}\n'
+    '#SBATCH -n 1\n'
+    '#SBATCH -c {shards}\n'
+    '#SBATCH -t {time}\n'
+    '#SBATCH --mem={mem}\n'
+    '#SBATCH --mail-type={mail}\n'
+    '#SBATCH --mail-user=dsulivan\n'
+)
 
 
 def main():
@@ -31,14 +62,22 @@ def batch_aermod(geounit, firm_list=None, **kwargs):
     MODEL = 'aermod'
     bypass_confirm = kwargs.pop('yes')
     altmaxdist = kwargs.get('altmaxdist')
+    executor = make_executor(kwargs.pop('executor', 'slurm'),
+                             procs=kwargs.pop('procs', None),
+                             mem_budget=kwargs.pop('mem_budget', None),
+                             array=kwargs.pop('array', True),
+                             pack_minutes=kwargs.pop('pack_minutes',
+                                                     PACK_MINUTES))
 
     units = calc_aermod_units(geounit, altmaxdist=altmaxdist)
-    jobs_needed = jobs_to_run(geounit, MODEL, units=units,
-                              cli_firm_list=firm_list, altmaxdist=altmaxdist)
+    jobs_needed = set(jobs_to_run(geounit, MODEL, units=units,
+                                  cli_firm_list=firm_list,
+                                  altmaxdist=altmaxdist))
     master_job_list = calc_resources(units, cli_facid_list=firm_list,
-                                     altmaxdist=altmaxdist)
+                                     altmaxdist=altmaxdist, geounit=geounit)
+    master_job_list['mem'] = _request_ram(geounit)
 
-    scripts_to_submit = []
+    firm_chunks = []
     for facid, firms_res in master_job_list.iterrows():
         num_chunks = int(firms_res['num_chunks'])
         for chunk_id in xrange(1, num_chunks + 1):
@@ -48,11 +87,56 @@ def batch_aermod(geounit, firm_list=None, **kwargs):
                                            int(firms_res['firm_id']),
                                            chunk_info=(chunk_id, num_chunks))
             if jobname in jobs_needed:
-                scripts_to_submit.append(
-                    sbatch_script(geounit, facid, jobname, firms_res, **kwargs)
-                )
+                firm_chunks.append(FirmChunk(jobname, facid,
+                                             (chunk_id, num_chunks),
+                                             firms_res))
 
-    job_master(scripts_to_submit, bypass_confirm=bypass_confirm)
+    executor.run(geounit, firm_chunks, bypass_confirm=bypass_confirm,
+                 **kwargs)
+
+
+def make_executor(name, procs=None, mem_budget=None, array=True,
+                  pack_minutes=PACK_MINUTES):
+    if name == 'slurm':
+        return SlurmExecutor(array=array, pack_minutes=pack_minutes)
+    elif name == 'local':
+        return LocalExecutor(procs=procs, mem_budget=mem_budget)
+    else:
+        raise ValueError("Unknown executor '{}'".format(name))
+
+
+class SlurmExecutor(Executor):
+    """
+    Submit firm-chunks as a few job arrays, packing small ones together
+    (see `array_scripts`), or with `array=False`, each as its own sbatch
+    job. With `linear`, an array of their firms' unique stacks (see
+    `unique_sources_script`) goes first and the firm-chunks wait for it.
+    """
+
+    def __init__(self, array=True, pack_minutes=PACK_MINUTES):
+        self.array = array
+        self.pack_minutes = pack_minutes
+
+    def run(self, geounit, firm_chunks, bypass_confirm=False, **kwargs):
+        if self.array:
+            scripts_to_submit = array_scripts(geounit, firm_chunks,
+                                              pack_minutes=self.pack_minutes,
+                                              **kwargs)
+        else:
+            scripts_to_submit = [
+                sbatch_script(geounit, fc.facid, fc.jobname, fc.resources,
+                              **kwargs)
+                for fc in firm_chunks
+            ]
+        if kwargs.get('linear') and firm_chunks:
+            facids = sorted(set(fc.facid for fc in firm_chunks))
+            first = unique_sources_script(geounit, facids,
+                                          pack_minutes=self.pack_minutes,
+                                          **kwargs)
+        else:
+            first = None
+        job_master(scripts_to_submit, bypass_confirm=bypass_confirm,
+                   first=first)
 
 
 def sbatch_script(geounit, facid, jobname, resources, **kwargs):
@@ -66,36 +150,28 @@ def sbatch_script(geounit, facid, jobname, resources, **kwargs):
     overwrite = kwargs.pop('overwrite', False)
     timescale = kwargs.pop('timescale', 1.)
     altmaxdist = kwargs.pop('altmaxdist', True)
+    linear = kwargs.pop('linear', False)
     model = 'aermod'
 
     cmd_str = (
         "python -c "
         "\"from atmods.run_and_write import run_and_write; "
         "run_and_write('{geounit}', '{model}', {facid},"
-        "{chunk_info}, {overwrite}, {altmaxdist})\""
+        "{chunk_info}, {overwrite}, {altmaxdist}, shards={shards}, "
+        "linear={linear})\""
     )
 
-    SBATCH = (
-        '#!/usr/bin/env bash\n'
-        '#SBATCH --job-name {jobname}\n'
-        '#SBATCH --output /n/home08/dsulivan/jobout/{jobname}.out\n'
-        '#SBATCH --error /n/home08/dsulivan/jobout/{jobname}.err\n'
-        '#SBATCH -p {partition}\n'
-        '#SBATCH -n 1\n'
-        '#SBATCH -t {time}\n'
-        '#SBATCH --mem={mem}\n'
-        '#SBATCH --mail-type={mail}\n'
-        '#SBATCH --mail-user=dsulivan\n'
-    ) + cmd_str
+    SBATCH = SBATCH_HEADER + cmd_str
 
     __, chunk_id, num_chunks = parse_firm_info(jobname + '.p')
 
-    time = _request_time(resources['cpu_per_stack'], timescale, geounit)
-    mem = _request_ram(geounit)
+    shards, time, mem = _job_resources(geounit, resources, timescale)
     mail = _set_email_param(mail)
 
     script = SBATCH.format(
         jobname=jobname,
+        logname=jobname + '_%j',    # Re-runs don't overwrite the log
+        job_out=JOB_OUT_PATH,
         partition=partition,
         time=time,
         mem=mem,
@@ -106,10 +182,232 @@ def sbatch_script(geounit, facid, jobname, resources, **kwargs):
         chunk_info=(chunk_id, num_chunks),
         overwrite=overwrite,
         altmaxdist=altmaxdist,
+        shards=shards,
+        linear=linear,
     )
 
     return script
 
+
+def array_scripts(geounit, firm_chunks, pack_minutes=PACK_MINUTES,
+                  **kwargs):
+    """
+    Pack small `firm_chunks` into jobs of about `pack_minutes` (see
+    `pack_firm_chunks`), group the jobs by cores, memory, and time class
+    (`ARRAY_TIME_CLASSES`), and return one job array script per group.
+
+    Each array's manifest (see `write_manifest`) maps `SLURM_ARRAY_TASK_ID`
+    to its firm-chunks (and whether they're run `linear`), which
+    `run_and_write.dispatch` runs in turn. The
+    manifest's path is also the array's Slurm comment, so `check_jobs` can
+    tell which firm-chunks are queued.
+    """
+    partition = kwargs.pop('partition', 'serial_requeue')
+    mail = _set_email_param(kwargs.pop('mail', ['none']))
+    overwrite = kwargs.pop('overwrite', False)
+    timescale = kwargs.pop('timescale', 1.)
+    altmaxdist = kwargs.pop('altmaxdist', True)
+    linear = kwargs.pop('linear', False)
+
+    cmd_str = (
+        "python -c "
+        "\"from atmods.run_and_write import dispatch; "
+        "dispatch('{manifest}', overwrite={overwrite}, "
+        "altmaxdist={altmaxdist})\""
+    )
+    # `check_jobs.queued_jobnames` finds queued firm-chunks via `--comment`
+    SBATCH = (SBATCH_HEADER + '#SBATCH --array=0-{last_task}\n' +
+              '#SBATCH --comment {manifest}\n' + cmd_str)
+
+    groups = {}
+    for pack in pack_firm_chunks(firm_chunks, pack_minutes):
+        shards, time, mem = _pack_resources(geounit, pack, timescale)
+        key = (shards, mem, _time_class(time))
+        groups.setdefault(key, []).append(pack)
+
+    stamp = datetime.now().strftime('%y%m%d%H%M%S')
+    scripts = []
+    for (shards, mem, time), group in sorted(groups.items()):
+        jobname = '{}A_c{}m{}t{}'.format(geounit[0], shards, mem, time)
+        manifest = os.path.join(MANIFEST_PATH,
+                                '{}_{}.csv'.format(jobname, stamp))
+        write_manifest(manifest, geounit, group, linear=linear)
+        scripts.append(SBATCH.format(
+            jobname=jobname,
+            # One log per array task and submission, so `atmods.timing`
+            # doesn't take a later submission's log for one it's read
+            logname=jobname + '_%A_%a',
+            job_out=JOB_OUT_PATH,
+            partition=partition,
+            time=time,
+            mem=mem,
+            mail=mail,
+            shards=shards,
+            last_task=len(group) - 1,
+            manifest=manifest,
+            overwrite=overwrite,
+            altmaxdist=altmaxdist,
+        ))
+
+    return scripts
+
+
+def unique_sources_script(geounit, facids, pack_minutes=PACK_MINUTES,
+                          **kwargs):
+    """
+    Job array script that runs `facids`' unique stack configurations (see
+    `chunktools.plan_unique_sources`) at unit emissions, filling the Aermod
+    cache for `linear` firm-chunks. Configurations are packed into tasks of
+    about `pack_minutes`; the array's manifest lists each task's, for
+    `run_and_write.dispatch_unique_sources`.
+    """
+    partition = kwargs.pop('partition', 'serial_requeue')
+    mail = _set_email_param(kwargs.pop('mail', ['none']))
+    timescale = kwargs.pop('timescale', 1.)
+    altmaxdist = kwargs.pop('altmaxdist', True)
+
+    cmd_str = (
+        "python -c "
+        "\"from atmods.run_and_write import dispatch_unique_sources; "
+        "dispatch_unique_sources('{manifest}')\""
+    )
+    SBATCH = SBATCH_HEADER + '#SBATCH --array=0-{last_task}\n' + cmd_str
+
+    configs, fanout = plan_unique_sources(geounit, cli_facid_list=facids,
+                                          altmaxdist=altmaxdist)
+    dedup_report(configs, fanout)
+    tasks = _first_fit(configs['cpu_per_stack'].values, pack_minutes)
+    task_id = np.zeros(configs.shape[0], dtype=int)
+    for i, positions in enumerate(tasks):
+        task_id[positions] = i
+    task_minutes = max(configs['cpu_per_stack'].values[positions].sum()
+                       for positions in tasks)
+
+    jobname = '{}U'.format(geounit[0])
+    stamp = datetime.now().strftime('%y%m%d%H%M%S')
+    manifest = os.path.join(MANIFEST_PATH,
+                            '{}_{}.csv'.format(jobname, stamp))
+    write_config_manifest(manifest, geounit, configs, task_id)
+
+    return SBATCH.format(
+        jobname=jobname,
+        logname=jobname + '_%A_%a',
+        job_out=JOB_OUT_PATH,
+        partition=partition,
+        time=_request_time(task_minutes, timescale, geounit),
+        mem=_request_ram(geounit),
+        mail=mail,
+        shards=1,
+        last_task=len(tasks) - 1,
+        manifest=manifest,
+    )
+
+
+def write_config_manifest(filepath, geounit, configs, task_id):
+    """
+    Write CSV mapping array index `task_id` (one per row of `configs`) to
+    `geounit` and the configuration's `SOURCE_CONFIG` and `receptor_km`.
+    """
+    manifest = configs[SOURCE_CONFIG + ['receptor_km']].copy()
+    manifest.insert(0, 'geounit', geounit)
+    manifest.index = pd.Index(task_id, name='task_id')
+    manifest.sort_index(kind='mergesort', inplace=True)
+    folder = os.path.dirname(filepath)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    manifest.to_csv(filepath)
+
+
+def pack_firm_chunks(firm_chunks, pack_minutes=PACK_MINUTES):
+    """
+    Return list of packs (lists of `FirmChunk`s) to run as single jobs.
+
+    Single-core firm-chunks shorter than `pack_minutes` (by `cpu_per_stack`,
+    as in `_request_time`) are packed first-fit decreasing into packs of at
+    most `pack_minutes`; the rest get a pack each. `pack_minutes=0` turns
+    packing off.
+    """
+    small, packs = [], []
+    for fc in firm_chunks:
+        is_small = (fc.resources['num_shards'] == 1 and
+                    fc.resources['cpu_per_stack'] < pack_minutes)
+        if is_small:
+            small.append(fc)
+        else:
+            packs.append([fc])
+
+    bins = _first_fit([fc.resources['cpu_per_stack'] for fc in small],
+                      pack_minutes)
+    return packs + [[small[i] for i in positions] for positions in bins]
+
+
+def _first_fit(minutes, pack_minutes):
+    """
+    Pack items taking `minutes` first-fit decreasing into bins of at most
+    `pack_minutes` (an item longer than that gets its own). Returns a list
+    of each bin's item positions.
+    """
+    bins = []   # [minutes, positions]
+    # Stable, so ties keep their order
+    for pos in np.argsort(-np.asarray(minutes, dtype=float), kind='mergesort'):
+        for a_bin in bins:
+            if a_bin[0] + minutes[pos] <= pack_minutes:
+                a_bin[0] += minutes[pos]
+                a_bin[1].append(pos)
+                break
+        else:
+            bins.append([minutes[pos], [pos]])
+
+    return [positions for __, positions in bins]
+
+
+def write_manifest(filepath, geounit, packs, linear=False):
+    """
+    Write CSV mapping array index `task_id` to `geounit`, `facid`,
+    `chunk_id`, `num_chunks`, `shards`, `jobname`, and `linear`, one row
+    per firm-chunk in each of `packs`.
+    """
+    manifest = pd.DataFrame(
+        [(task_id, geounit, fc.facid, fc.chunk_info[0], fc.chunk_info[1],
+          int(fc.resources['num_shards']), fc.jobname, linear)
+         for task_id, pack in enumerate(packs)
+         for fc in pack],
+        columns=['task_id', 'geounit', 'facid', 'chunk_id', 'num_chunks',
+                 'shards', 'jobname', 'linear']).set_index('task_id')
+    folder = os.path.dirname(filepath)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    manifest.to_csv(filepath)
+
+
+def _job_resources(geounit, resources, timescale):
+    """Return (cores, time, memory) to request for a firm-chunk."""
+    shards = int(resources['num_shards'])
+    # Receptor shards run concurrently, so wall time shrinks with `shards`
+    time = _request_time(resources['cpu_per_stack'] / shards, timescale,
+                         geounit, buffer=resources['time_buffer'])
+    mem = int(resources['mem'])
+    return shards, time, mem
+
+
+def _pack_resources(geounit, pack, timescale):
+    """Like `_job_resources`, for firm-chunks run one after another."""
+    if len(pack) == 1:
+        return _job_resources(geounit, pack[0].resources, timescale)
+    resources = pack[0].resources.copy()
+    resources['cpu_per_stack'] = sum(fc.resources['cpu_per_stack']
+                                     for fc in pack)
+    resources['mem'] = max(fc.resources['mem'] for fc in pack)
+    return _job_resources(geounit, resources, timescale)
+
+
+def _time_class(time):
+    for time_class in ARRAY_TIME_CLASSES:
+        if time <= time_class:
+            return time_class
+    return time
+
+
 def _set_email_param(mail):
     if 'none' in mail:
         mail = 'NONE'
@@ -120,14 +418,24 @@ def _set_email_param(mail):
 
     return mail
 
-def _request_time(cpu_per_stack, timescale, geounit):
-    time = np.ceil(cpu_per_stack) * 1.5     # Add 50% buffer
+
+def _request_time(cpu_per_stack, timescale, geounit, buffer=np.nan):
+    """
+    `buffer` is the fitted cost model's padding (see `atmods.timing`). The
+    fit is per geounit, so it already covers coarse units' overhead.
+    """
+    fitted = not np.isnan(buffer)
+    if not fitted:
+        buffer = 1.5                        # Add 50% buffer
+    time = np.ceil(cpu_per_stack) * buffer
     time = max(time, 10)                    # Prevent too small
     time = int(time * timescale)            # CLI buffer
-    if geounit not in ('grid', 'house'):    # Coarser unit, rel. more overhead
+    # Coarser unit, rel. more overhead
+    if not fitted and geounit not in ('grid', 'house'):
         time *= 2
     return time
 
+
 def _request_ram(geounit):
     if geounit == 'house':
         mem = 1200
@@ -138,10 +446,11 @@ def _request_ram(geounit):
     return mem
 
 
-def job_master(scripts_to_submit, bypass_confirm=False):
+def job_master(scripts_to_submit, bypass_confirm=False, first=None):
     """
     `scripts_to_submit` is a list of strings. Each string is a Slurm sbatch
-    script for the associated firm-chunk's job.
+    script for the associated firm-chunk's job. Script `first`, if any, is
+    submitted before them, and they don't start until it's done.
     """
     num_jobs = len(scripts_to_submit)
 
@@ -151,6 +460,9 @@ def job_master(scripts_to_submit, bypass_confirm=False):
 
     # Print sample sbatch script to stdout, get confirmation before submitting
     sbatch_example = scripts_to_submit[0]
+    if first is not None:
+        print first
+        print '\n>>> Then:'
     print sbatch_example
     if bypass_confirm:
         confirmed = True
@@ -166,10 +478,15 @@ def job_master(scripts_to_submit, bypass_confirm=False):
     if not confirmed:
         sys.exit(0)
     else:
+        after = None
+        if first is not None:
+            after = _submit_a_job(first)
+            sleep(1)
         while scripts_to_submit:
-            _submit_a_job(scripts_to_submit.pop())
+            _submit_a_job(scripts_to_submit.pop(), after=after)
             sleep(1)
 
+
 def _save_sbatch_script(sbatch_script):
     """ Write the sbatch script to disk """
     tmp_file = expanduser('~/research/poll-house/code/temp.sbatch')
@@ -177,13 +494,23 @@ def _save_sbatch_script(sbatch_script):
         f.write(sbatch_script)
     print 'Sbatch written as temp.sbatch in case you want it later'
 
-def _submit_a_job(script):
-    """ Submit string `script` to Slurm's `sbatch` command. """
-    p = subprocess.Popen('sbatch',
+
+def _submit_a_job(script, after=None):
+    """
+    Submit string `script` to Slurm's `sbatch` command, to start once job
+    `after` (if any) has finished, and return its job id.
+    """
+    cmd = [SBATCH_COMMAND]
+    if after is not None:
+        # Any end, since firm-chunks run missing unit runs themselves
+        cmd.append('--dependency=afterany:{}'.format(after))
+    p = subprocess.Popen(cmd,
                          stdin=subprocess.PIPE,
                          stdout=subprocess.PIPE)
     p_stdout = p.communicate(input=script)[0]
     print '>>> ' + p_stdout
+    # "Submitted batch job {id}"
+    return p_stdout.split()[-1] if p_stdout.strip() else None
 
 
 def batch_kernel(geounit, model, facid_list, **kwargs):
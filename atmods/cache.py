@@ -0,0 +1,174 @@
+"""
+Content-addressed, on-disk cache of Aermod output.
+
+Entries are keyed on everything that determines Aermod's output: the full
+contents of 'aermod.inp' (sources, receptors, met settings), the identity of
+the Aermod binary, the met files' modification times, and how the output is
+post-processed (`reducer`, polar interpolation targets). The key doesn't
+depend on `facid` (only used in the input file's title), chunk names, or
+where the result is eventually saved.
+
+Eviction walks the whole store, so `put` only does it when no process has
+in the last `EVICT_EVERY_SEC` (tracked by the mtime of a marker file).
+"""
+from __future__ import division
+
+import os
+import copy
+import time
+import hashlib
+import tempfile
+
+import pandas as pd
+
+from util.system import bulk_path
+from atmods.env import AERMOD_SRC_PATH, PATH_FOR_MET
+from atmods.aermod import UNIT_FACID
+
+AERMOD_CACHE_PATH = bulk_path('aermod_cache')
+AERMOD_CACHE_MAX_GB = 50.
+EVICT_EVERY_SEC = 3600
+EVICT_MARKER = '.last_evict'
+
+
+class AermodCache(object):
+    """
+    Store of Aermod output (pickled DataFrames) under `root`, one file per
+    key. When the store grows past `max_gb`, least recently used entries
+    (by modification time, which is refreshed on every hit) are deleted, at
+    most once every `evict_every` seconds.
+    """
+
+    def __init__(self, root=AERMOD_CACHE_PATH, max_gb=AERMOD_CACHE_MAX_GB,
+                 evict_every=EVICT_EVERY_SEC):
+        self.root = root
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        self.evict_every = evict_every
+        if not os.path.isdir(root):
+            try:
+                os.makedirs(root)
+            except OSError:
+                # Another process made it first
+                if not os.path.isdir(root):
+                    raise
+
+    def key(self, model):
+        """Hex digest identifying the output of `atmods.aermod.Aermod` run."""
+        hasher = _HashWriter()
+        # Same title for every firm
+        untitled = copy.copy(model)
+        untitled.sourceDF = model.sourceDF.assign(facid=UNIT_FACID)
+        untitled.write_inp_file(hasher)
+        hasher.write(_file_identity(AERMOD_SRC_PATH))
+        for met_path in _met_paths(model.sourceDF):
+            hasher.write(_file_identity(met_path))
+        # Post-processing
+        reducer = model.reducer
+        if reducer is not None:
+            hasher.write('reducer {}.{}'.format(reducer.__module__,
+                                                reducer.__name__))
+        if model.polar:
+            utm = model.receptorDF[['utm_east', 'utm_north']].values
+            hasher.write('polar ' + utm.astype(float).tostring())
+        return hasher.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + '.p')
+
+    def get(self, key):
+        """Return cached output for `key`, or `None` if not cached."""
+        file_path = self.path(key)
+        try:
+            output = pd.read_pickle(file_path)
+            os.utime(file_path, None)   # Mark as recently used
+        except (IOError, OSError, EOFError):
+            return None
+        return output
+
+    def put(self, key, output):
+        """Save `output` under `key` (atomically), evict if it's time."""
+        file_path = self.path(key)
+        folder = os.path.dirname(file_path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        os.close(fd)
+        try:
+            output.to_pickle(tmp_path)
+            os.rename(tmp_path, file_path)
+        except:
+            os.remove(tmp_path)
+            raise
+        if self._evict_due():
+            self.evict()
+
+    def _evict_due(self):
+        """Claim the next eviction if none in the last `evict_every` sec."""
+        marker = os.path.join(self.root, EVICT_MARKER)
+        try:
+            last = os.path.getmtime(marker)
+        except OSError:
+            last = None
+        if last is not None and time.time() - last < self.evict_every:
+            return False
+        # Other tasks now see a fresh marker and skip the walk
+        with open(marker, 'a'):
+            os.utime(marker, None)
+        return True
+
+    def evict(self):
+        """Delete least recently used entries until under `max_bytes`."""
+        entries = []
+        for dirpath, __, filenames in os.walk(self.root):
+            for fname in filenames:
+                if not fname.endswith('.p'):
+                    continue
+                file_path = os.path.join(dirpath, fname)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file_path))
+
+        total = sum(size for __, size, __ in entries)
+        for __, size, file_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+            total -= size
+
+
+class _HashWriter(object):
+    """File-like object that hashes what's written instead of storing it."""
+
+    def __init__(self):
+        self._hash = hashlib.sha1()
+
+    def write(self, s):
+        self._hash.update(s)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def _file_identity(file_path):
+    """Path, size, and modification time of `file_path`."""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return '{} missing\n'.format(file_path)
+    return '{} {} {}\n'.format(file_path, stat.st_size, stat.st_mtime)
+
+
+def _met_paths(sourceDF):
+    """Surface and profile met files read for `sourceDF` (see `aermod.inp`)"""
+    metsite_code = sourceDF['metsite_code'].iloc[0]
+    stem = '{}{}7'.format(PATH_FOR_MET, metsite_code)
+    return stem + '.sfc', stem + '.pfl'
@@ -1,5 +1,4 @@
 import subprocess
-import StringIO
 from os import path
 import argparse
 
@@ -8,19 +7,20 @@ import pandas as pd
 from econtools import generate_chunks
 
 from util.system import hostname
-from atmods.io import normed_firmexp_path, normed_firmexp_fname
+from atmods.io import normed_firmexp_path, normed_firmexp_fname, list_outputs
 from atmods.chunktools import calc_aermod_units, calc_resources
 
 
-def pretty_out(geounit, model, altmaxdist=False):
-    jobs_needed = jobs_to_run(geounit, model, altmaxdist=altmaxdist)
+def pretty_out(geounit, model, altmaxdist=False, use_manifest=False):
+    jobs_needed = jobs_to_run(geounit, model, altmaxdist=altmaxdist,
+                              use_manifest=use_manifest)
     padded = [jobname.ljust(8) for jobname in jobs_needed]
     for a_line in generate_chunks(padded, 7):
         print ' '.join(a_line) + '\n'
 
 
 def jobs_to_run(geounit, model, units=None, cli_firm_list=None,
-                altmaxdist=False):
+                altmaxdist=False, use_manifest=False):
     """
     Return tuple of job names that need to be run.
 
@@ -31,14 +31,18 @@ def jobs_to_run(geounit, model, units=None, cli_firm_list=None,
 
     `cli_firm_list` is a list of firms to restrict to, passed down from CLI in
         `batchrun`.
+
+    `use_manifest` checks outputs against `atmods.io.OUTPUT_MANIFEST`
+        instead of listing the output folder.
     """
     if units is None:
         units = calc_aermod_units(geounit)
 
     res = calc_resources(units,
                          cli_facid_list=cli_firm_list,
-                         altmaxdist=altmaxdist)
-    not_on_disk = check_storage(geounit, model, res, altmaxdist=altmaxdist)
+                         altmaxdist=altmaxdist, geounit=geounit)
+    not_on_disk = check_storage(geounit, model, res, altmaxdist=altmaxdist,
+                                use_manifest=use_manifest)
     if hostname == 'harvard':
         # Drop job names that are currently running
         in_queue = get_squeue_names()
@@ -50,18 +54,29 @@ def jobs_to_run(geounit, model, units=None, cli_firm_list=None,
     return no_disk_no_queue
 
 
-def check_storage(geounit, model, resources, altmaxdist=False):
-    """Return tuple of job names for `facid`s whose airq data is not on disk"""
+def check_storage(geounit, model, resources, altmaxdist=False,
+                  use_manifest=False):
+    """
+    Return tuple of job names for `facid`s whose airq data is not on disk.
+
+    The chunk folder is listed once (or with `use_manifest`, its manifest
+    read once) instead of checking each file.
+    """
+    # All chunks are in the same folder
+    folder = path.dirname(normed_firmexp_path(geounit, model, 0,
+                                              chunk_info=True,
+                                              altmaxdist=altmaxdist))
+    finished = list_outputs(folder, use_manifest=use_manifest)
 
     # Get `facid`s not on disk
     not_on_disk = []
     unique_data = resources[['firm_id', 'num_chunks']].drop_duplicates()
     for facid, firm_id, num_chunks in unique_data.itertuples():
         for chunk_id in xrange(1, num_chunks + 1):
-            file_path = normed_firmexp_path(geounit, model, facid,
-                                            chunk_info=(chunk_id, num_chunks),
-                                            altmaxdist=altmaxdist)
-            if not path.isfile(file_path):
+            filename = normed_firmexp_fname(
+                geounit, model, facid, chunk_info=(chunk_id, num_chunks)
+            ) + '.p'
+            if filename not in finished:
                 jobname = normed_firmexp_fname(
                     geounit, model, firm_id, chunk_info=(chunk_id, num_chunks)
                 )
@@ -71,11 +86,47 @@ def check_storage(geounit, model, resources, altmaxdist=False):
 
 
 def get_squeue_names():
-    """Return array of job names in squeue"""
-    p = subprocess.Popen(['squeue', '-u', 'dsulivan'], stdout=subprocess.PIPE)
+    """
+    Return set of job names in squeue, including the firm-chunks of queued
+    job array tasks (see `queued_jobnames`).
+    """
+    # No header, one line per array task: job name, task ID, comment
+    p = subprocess.Popen(['squeue', '-h', '-r', '-u', 'dsulivan',
+                          '-o', '%j|%K|%k'],
+                         stdout=subprocess.PIPE)
     p_stdout = p.communicate()[0]
-    df = pd.read_table(StringIO.StringIO(p_stdout), sep='\s+')
-    in_queue = df['NAME'].unique()
+    in_queue = queued_jobnames(p_stdout.splitlines())
+
+    return in_queue
+
+
+def queued_jobnames(squeue_lines):
+    """
+    Return set of job names from `squeue -o '%j|%K|%k'` lines. Job arrays
+    (`batchrun.array_scripts`) are named by resources and have their
+    manifest's path as comment, so a queued array task adds the `jobname`s
+    of its firm-chunks from the manifest.
+    """
+    in_queue = set()
+    manifests = dict()
+    for line in squeue_lines:
+        try:
+            jobname, task_id, comment = line.strip().split('|', 2)
+        except ValueError:
+            continue
+        in_queue.add(jobname)
+        if not (task_id.isdigit() and comment.endswith('.csv')):
+            continue
+        if comment not in manifests:
+            try:
+                manifests[comment] = pd.read_csv(comment,
+                                                 index_col='task_id')
+            except IOError:
+                manifests[comment] = None
+        manifest = manifests[comment]
+        if manifest is not None:
+            is_task = manifest.index == int(task_id)
+            in_queue.update(manifest.loc[is_task, 'jobname'])
 
     return in_queue
 
@@ -87,6 +138,8 @@ def cli_args():
                         help='Geographic unit for model')
     parser.add_argument('model', help='Dispersion model')
     parser.add_argument('--altmaxdist', action='store_true')
+    parser.add_argument('--use-manifest', action='store_true',
+                        help="Check finished outputs against manifest")
     args = parser.parse_args()
     return args
 
@@ -94,4 +147,5 @@ def cli_args():
 if __name__ == '__main__':
     args = cli_args()
     geounit, model, altmaxdist = args.geounit, args.model, args.altmaxdist
-    pretty_out(geounit, model, altmaxdist=altmaxdist)
+    pretty_out(geounit, model, altmaxdist=altmaxdist,
+               use_manifest=args.use_manifest)
@@ -1,27 +1,49 @@
 from __future__ import division
 
 import numpy as np
+import pandas as pd
 
 from econtools import load_or_build_direct
 
 from util import UTM
 from util.system import data_path
-from util.distance import getdist
+from util.distance import SpatialIndex, utm_array
 from clean import load_geounit
 from clean.pr2 import load_stacks, FirmIDXwalk
 from atmods.env import (MAXDIST, ALTMAXDIST, FIRMS_FOR_ALTMAXDIST,
-                        JOB_LIMIT_MIN, CPU_SEC_PER_UNIT)
+                        JOB_LIMIT_MIN, CPU_SEC_PER_UNIT, MAX_SHARDS)
+from atmods.aermod import STACK_GEOMETRY
+from atmods.timing import load_cost_model, predict_sec_per_unit
 
+# Everything that determines a single stack's unit-emission Aermod output
+# (besides receptors, which are set by location)
+SOURCE_CONFIG = STACK_GEOMETRY + ['metsite_code', 'metsite_year', 'metsite_z',
+                                  'pop1990']
+# Unit-emission runs cover receptors within a firm's radius plus a multiple
+# of this many km of the stack (see `unit_receptor_radius`)
+UNIT_RECEPTOR_STEP = 1.
 
-def calc_resources(units, cli_facid_list=None, altmaxdist=False):
+
+def calc_resources(units, cli_facid_list=None, altmaxdist=False,
+                   geounit=None):
     """
     Return frame with unique `facid` index, a `firm_id` column, and sbatch
     job info:
-        num_stacks, units, cpu_per_stack, total_cpu, num_chunks, firm_id
+        num_stacks, units, sec_per_unit, cpu_per_stack, total_cpu,
+        num_chunks, num_shards, time_buffer, firm_id
+
+    `num_shards` is the number of receptor shards (cores) each chunk should
+    run on when splitting by stacks alone can't get under `JOB_LIMIT_MIN`.
+
+    `sec_per_unit` comes from `geounit`'s fitted cost model (see
+    `atmods.timing`), at the stack count of the firm's chunks, if there is
+    one, else `CPU_SEC_PER_UNIT`.
+    `time_buffer` is how much to pad the fitted time by (NaN without a fit).
     """
 
     # In case `units` is str, not DF
     if isinstance(units, str):
+        geounit = units
         units = calc_aermod_units(units, cli_facid_list=cli_facid_list,
                                   altmaxdist=altmaxdist)
     elif cli_facid_list is not None:
@@ -37,14 +59,29 @@ def calc_resources(units, cli_facid_list=None, altmaxdist=False):
     df = stack_count.to_frame('num_stacks').join(
         units.to_frame('units'), how='inner')
 
-    df['cpu_per_stack'] = df['units'] * CPU_SEC_PER_UNIT / 60
-    # scale up by number of stacks
-    df['total_cpu'] = df['cpu_per_stack'] * df['num_stacks']
-    # Number of separate jobs to be under limit
-    raw_chunk_max = np.ceil(df['total_cpu'] / JOB_LIMIT_MIN)
-    # Limit number of chunks to number of stacks
-    df['num_chunks'] = np.minimum(raw_chunk_max,
-                                  df['num_stacks']).astype(int)
+    cost_model = load_cost_model(geounit) if geounit else None
+    if cost_model is None:
+        df['sec_per_unit'] = CPU_SEC_PER_UNIT
+        df['time_buffer'] = np.nan
+        df = _chunk_firms(df)
+    else:
+        by_firm = stack_df.groupby(level='facid')
+        stack_ht = by_firm['stack_ht'].mean().reindex(df.index)
+        metsite = by_firm['metsite_code'].first().reindex(df.index)
+        df['time_buffer'] = cost_model['buffer']
+        # The model is fit on each Aermod run's stacks, i.e., a chunk's, so
+        # chunk at the full stack count, then predict again at that chunk
+        # size
+        df['sec_per_unit'] = predict_sec_per_unit(
+            cost_model, stack_ht, df['units'], stacks=df['num_stacks'],
+            metsite=metsite)
+        df = _chunk_firms(df)
+        chunk_stacks = np.ceil(df['num_stacks'] /
+                               np.maximum(df['num_chunks'], 1))
+        df['sec_per_unit'] = predict_sec_per_unit(
+            cost_model, stack_ht, df['units'], stacks=chunk_stacks,
+            metsite=metsite)
+        df = _chunk_firms(df)
 
     # Add `firm_id` to `resources` frame
     idxwalk = FirmIDXwalk()
@@ -57,6 +94,162 @@ def calc_resources(units, cli_facid_list=None, altmaxdist=False):
     return df
 
 
+def _chunk_firms(df):
+    """
+    Add `cpu_per_stack`, `total_cpu`, `num_chunks`, and `num_shards` to
+    `df` (with `num_stacks`, `units`, and `sec_per_unit`).
+    """
+    df['cpu_per_stack'] = df['units'] * df['sec_per_unit'] / 60
+    # scale up by number of stacks
+    df['total_cpu'] = df['cpu_per_stack'] * df['num_stacks']
+    # Number of separate jobs to be under limit
+    raw_chunk_max = np.ceil(df['total_cpu'] / JOB_LIMIT_MIN)
+    # Limit number of chunks to number of stacks
+    df['num_chunks'] = np.minimum(raw_chunk_max,
+                                  df['num_stacks']).astype(int)
+    # Split the rest by receptors, e.g., for single-stack firms
+    raw_shards = np.ceil(raw_chunk_max / df['num_chunks'])
+    df['num_shards'] = np.minimum(raw_shards, MAX_SHARDS).astype(int)
+    return df
+
+
+def plan_unique_sources(geounit, cli_facid_list=None, altmaxdist=False):
+    """
+    Find duplicate source configurations (`SOURCE_CONFIG`: location, stack
+    parameters, met site) within and across firms.
+
+    Returns (`configs`, `fanout`):
+      `configs` has one row per unique configuration (index `config_id`),
+        with `SOURCE_CONFIG`, `receptor_km` (see `group_source_configs`), a
+        representative `facid`, the `units` and `cpu_per_stack` of its
+        unit-emission run, and `num_uses`, the number of firm stacks that
+        share it.
+      `fanout` is the stacks table from `load_stacks` with each stack's
+        `config_id`, `receptor_km`, `units`, `cpu_per_stack`, and which
+        firm-chunk (`chunk_id`, `num_chunks`) it's run in.
+
+    Each configuration only needs one unit-emission run (see
+    `atmods.aermod.run_linear`); every firm-chunk that uses it can reuse it.
+    """
+    resources = calc_resources(geounit, cli_facid_list=cli_facid_list,
+                               altmaxdist=altmaxdist)
+    stacks = load_stacks(resources.index.tolist()).reset_index(drop=True)
+
+    # Firm-chunk each stack is run in, see `run_and_write.load_chunked_stacks`
+    stacks['num_chunks'] = stacks['facid'].map(resources['num_chunks'])
+    stacks['chunk_id'] = 0
+    for facid, firms_stacks in stacks.groupby('facid'):
+        num_chunks = int(resources.loc[facid, 'num_chunks'])
+        stacks.loc[firms_stacks.index, 'chunk_id'] = stack_chunk_ids(
+            firms_stacks.shape[0], num_chunks)
+    for col in ('units', 'sec_per_unit', 'cpu_per_stack'):
+        stacks[col] = stacks['facid'].map(resources[col])
+
+    stacks = group_source_configs(
+        stacks, receptor_maxdist(geounit, altmaxdist=altmaxdist))
+    by_config = stacks.groupby('config_id')
+    configs = by_config[SOURCE_CONFIG + ['receptor_km', 'facid']].first()
+    # Unit runs are on receptors around the stack, not the firm's
+    receptors = SpatialIndex(load_geounit(geounit)[UTM].drop_duplicates())
+    configs['units'] = 0
+    for radius, same_radius in configs.groupby('receptor_km'):
+        configs.loc[same_radius.index, 'units'] = receptors.count_within(
+            same_radius, radius)
+    configs['cpu_per_stack'] = (configs['units'] *
+                                by_config['sec_per_unit'].max() / 60)
+    configs['num_uses'] = by_config.size()
+
+    return configs, stacks
+
+
+def group_source_configs(stacks, maxdist):
+    """
+    Add `receptor_km` and `config_id` to `stacks` (with `SOURCE_CONFIG` and
+    `facid`), where firms' receptors are within `maxdist` km of their
+    center (see `run_and_write.firm_receptors`).
+
+    A stack's unit-emission run covers receptors within `receptor_km` of
+    the stack (see `unit_receptor_radius`), which is all its firm needs.
+    Stacks with the same `SOURCE_CONFIG` and `receptor_km` get the same
+    Aermod input whichever firm they're from, so share a `config_id`.
+    """
+    stacks = stacks.copy()
+    center = stacks.groupby('facid')[UTM].transform('mean')
+    stacks['receptor_km'] = unit_receptor_radius(stacks[UTM], center,
+                                                 maxdist)
+    config_cols = SOURCE_CONFIG + ['receptor_km']
+    stacks['config_id'] = stacks.groupby(config_cols, sort=False).ngroup()
+    return stacks
+
+
+def unit_receptor_radius(stack_utm, center_utm, maxdist):
+    """
+    Radius (km) around each of `stack_utm` that covers every receptor
+    within `maxdist` km of `center_utm`: `maxdist` plus the stack's distance
+    from the center, rounded up to the next `UNIT_RECEPTOR_STEP`, so firms
+    centered near each other run a shared stack on the same receptors.
+    """
+    diff = utm_array(stack_utm) - utm_array(center_utm)
+    offset = np.sqrt((diff ** 2).sum(axis=1)) / 1000.
+    steps = np.floor(offset / UNIT_RECEPTOR_STEP) + 1
+    return maxdist + steps * UNIT_RECEPTOR_STEP
+
+
+def receptor_maxdist(geounit, altmaxdist=False):
+    """Radius (km) of receptors around a firm's center."""
+    maxdist = ALTMAXDIST if altmaxdist else MAXDIST
+    # XXX: just increase the radius for now instead of grabbing
+    if geounit == 'block':
+        maxdist += 5
+    return maxdist
+
+
+def dedup_report(configs, fanout):
+    """Print and return how much Aermod time `plan_unique_sources` saves."""
+    report = pd.Series({
+        'stack_runs': fanout.shape[0],
+        'unique_runs': configs.shape[0],
+        'cpu_hours': fanout['cpu_per_stack'].sum() / 60,
+        'unique_cpu_hours': configs['cpu_per_stack'].sum() / 60,
+    })
+    report['cpu_hours_saved'] = (report['cpu_hours'] -
+                                 report['unique_cpu_hours'])
+
+    print "Stack runs: {:,.0f} needed, {:,.0f} unique".format(
+        report['stack_runs'], report['unique_runs'])
+    print "Aermod CPU hours: {:,.1f} -> {:,.1f} ({:,.1f} saved)".format(
+        report['cpu_hours'], report['unique_cpu_hours'],
+        report['cpu_hours_saved'])
+
+    return report
+
+
+def stack_chunk_ids(num_stacks, num_chunks):
+    """
+    Return array of 1-indexed chunk ids for a firm's `num_stacks` stacks (in
+    `load_stacks` order), split as evenly as possible into `num_chunks`.
+    """
+    N = num_stacks
+    even_num_per_group = N // num_chunks
+    remainder = N % num_chunks
+    group_sizes = np.ones(num_chunks, dtype=int) * even_num_per_group
+    # Distribute remainder evenly
+    group_sizes[:remainder] += 1
+    # Make array of stacks' chunk_ids
+    stacks_id = np.array([
+        idx + 1     # +1 so chunks are 1-indexed, not 0
+        for idx, group_size in enumerate(group_sizes)
+        for x in range(group_size)  # Repeat `idx` `group_size` times
+    ])
+
+    # Check that result makes sense
+    assert sum(group_sizes) == N        # Every stack is allocated to one group
+    assert len(stacks_id) == N          # stacks' ids align with stackDF
+    assert max(stacks_id) == num_chunks    # Preserved num of chunks
+
+    return stacks_id
+
+
 def calc_aermod_units(geounit, cli_facid_list=None, altmaxdist=False,
                       _load=True, _rebuild=False):
     """
@@ -97,9 +290,9 @@ def calc_aermod_units(geounit, cli_facid_list=None, altmaxdist=False,
 
     firm_utm = load_stacks(real_firm_list).groupby('facid')[UTM].mean()
     geounit_df = load_geounit(geounit)
-    is_close = getdist(geounit_df[UTM].drop_duplicates(), firm_utm,
-                       within=maxdist)
-    aermod_units = is_close.sum()
+    receptors = SpatialIndex(geounit_df[UTM].drop_duplicates())
+    aermod_units = pd.Series(receptors.count_within(firm_utm, maxdist),
+                             index=firm_utm.index)
 
     return aermod_units
 
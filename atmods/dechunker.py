@@ -6,83 +6,129 @@ Currently (2/11/15) meant to be run as __main__.
 import os
 import shutil
 import glob
+import tempfile
 import argparse
+import multiprocessing as mp
 
+import numpy as np
 import pandas as pd
 
 from econtools import confirmer
 
-from atmods.io import normed_firmexp_path, parse_firm_info
+from atmods.io import normed_firmexp_path, parse_firm_info, atomic_pickle
 
 
-def main(geounit, model, altmaxdist=False, clean=False, overwrite=False):
+def main(geounit, model, altmaxdist=False, clean=False, overwrite=False,
+         processes=None):
+    """
+    Combine every firm's chunks into one file, firms spread over
+    `processes` workers (default all cores).
+    """
     raw_file_patt = normed_firmexp_path(geounit, model, '*', chunk_info=True,
                                         altmaxdist=altmaxdist)
-    file_list = glob.glob(raw_file_patt)
-    master_list = tuple(file_list)
+    firms_chunks = group_chunk_files(glob.glob(raw_file_patt))
+
+    jobs = [(geounit, model, firm_id, chunk_paths, altmaxdist, overwrite)
+            for firm_id, chunk_paths in sorted(firms_chunks.items())]
+    pool = mp.Pool(processes)
     print "Handled...",
-    import ipdb
-    while file_list:
-        this_file = file_list.pop()
-        firm_id, __, num_chunks = parse_firm_info(this_file)
-        dst_filepath = normed_firmexp_path(geounit, model, firm_id,
-                                           altmaxdist=altmaxdist)
-        ipdb.set_trace()
-        if os.path.isfile(dst_filepath) and not overwrite:
-            continue
-        if num_chunks == 1:
-            # Specifically not copy2, want new metadata
-            shutil.copy(this_file, dst_filepath)
-        else:
-            combined_df = combine_chunks(geounit, model, firm_id, num_chunks,
-                                         altmaxdist)
-            combined_df.to_pickle(dst_filepath)
-            del combined_df
-            file_list = update_filelist(file_list, firm_id)
-        print '\t{}'.format(firm_id)
+    try:
+        for firm_id, status in pool.imap_unordered(_dechunk_firm, jobs):
+            print '\t{} {}'.format(firm_id, status)
+    finally:
+        pool.close()
+        pool.join()
     print "Done!"
     if clean:
-        clean_up(master_list)
+        # Only delete chunks that went into a combined file
+        clean_up([this_file for chunk_paths in firms_chunks.values()
+                  for this_file in chunk_paths])
+
+
+def group_chunk_files(file_list):
+    """
+    Return dict of `firm_id` to list of its chunks' file paths (in chunk
+    order), in one pass over `file_list`. Firms without exactly one complete
+    set of chunks are left out.
+    """
+    by_firm = dict()
+    for this_file in file_list:
+        firm_id, chunk_id, num_chunks = parse_firm_info(this_file)
+        by_firm.setdefault(firm_id, dict()).setdefault(num_chunks, dict())
+        by_firm[firm_id][num_chunks][chunk_id] = this_file
+
+    firms_chunks = dict()
+    for firm_id, chunkings in by_firm.iteritems():
+        # Left-over chunks from an old `num_chunks` only matter if the
+        # current chunking isn't done
+        complete = [num_chunks for num_chunks, chunks in chunkings.iteritems()
+                    if len(chunks) == num_chunks]
+        if len(complete) != 1:
+            err_str = "Skip Firm {}, {} complete sets of chunks ({})"
+            print err_str.format(firm_id, len(complete), _chunk_counts(
+                chunkings))
+            continue
+        chunks = chunkings[complete[0]]
+        firms_chunks[firm_id] = [chunks[chunk_id]
+                                 for chunk_id in sorted(chunks)]
 
+    return firms_chunks
 
-def combine_chunks(geounit, model, firm_id, num_chunks, altmaxdist):
 
-    dfs = dict()  # dict to track chunk_id later and track errors
-    for chunk_id in range(1, num_chunks + 1):
-        this_path = normed_firmexp_path(geounit, model, firm_id,
-                                        chunk_info=(chunk_id, num_chunks),
-                                        altmaxdist=altmaxdist)
-        dfs[chunk_id] = pd.read_pickle(this_path)
+def _chunk_counts(chunkings):
+    return ', '.join('{} of {}'.format(len(chunks), num_chunks)
+                     for num_chunks, chunks in sorted(chunkings.items()))
 
-    # Do we have all the chunks?
-    try:
-        assert len(dfs) == num_chunks
-    except AssertionError:
-        err_str = "Firm {} only had {} out of {} chunks!"
-        raise AssertionError(err_str.format(firm_id, len(dfs), num_chunks))
-
-    # Make sure the chunked DataFrames are exactly the same shape, etc.
-    first_index, first_columns = dfs[1].index, dfs[1].columns
-    for chunk_id in dfs.keys():
+
+def _dechunk_firm(args):
+    geounit, model, firm_id, chunk_paths, altmaxdist, overwrite = args
+    dst_filepath = normed_firmexp_path(geounit, model, firm_id,
+                                       altmaxdist=altmaxdist)
+    if os.path.isfile(dst_filepath) and not overwrite:
+        return firm_id, 'exists'
+    if len(chunk_paths) == 1:
+        _atomic_copy(chunk_paths[0], dst_filepath)
+    else:
+        combined_df = combine_chunks(chunk_paths, firm_id)
+        atomic_pickle(combined_df, dst_filepath)
+    return firm_id, 'done'
+
+
+def combine_chunks(chunk_paths, firm_id):
+    """
+    Sum the chunks in `chunk_paths` into one array as each is read, so only
+    the total and one chunk are in memory at once.
+    """
+    first_df = pd.read_pickle(chunk_paths[0])
+    index, columns = first_df.index, first_df.columns
+    total = first_df.values.copy()
+    del first_df
+
+    for chunk_id, this_path in enumerate(chunk_paths[1:], start=2):
+        df = pd.read_pickle(this_path)
+        # Make sure the chunked DataFrames are exactly the same shape, etc.
         try:
-            assert first_index.equals(dfs[chunk_id].index)
-            assert first_columns.equals(dfs[chunk_id].columns)
+            assert index.equals(df.index)
+            assert columns.equals(df.columns)
         except AssertionError:
             err_str = "Firm {}'s 1st and {}th chunk have different shapes!"
             raise AssertionError(err_str.format(firm_id, chunk_id))
+        np.add(total, df.values, out=total)
+        del df
 
-    # Combine them
-    combo_df = dfs.pop(1)
-    for chunk_id in dfs.keys():
-        combo_df = combo_df.add(dfs[chunk_id])
+    return pd.DataFrame(total, index=index, columns=columns)
 
-    return combo_df
 
-
-def update_filelist(file_list, firm_id):
-    """ Removes firm_id's file names from the list."""
-    new_file_list = [x for x in file_list if parse_firm_info(x)[0] != firm_id]
-    return new_file_list
+def _atomic_copy(src, dst):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst), suffix='.tmp')
+    os.close(fd)
+    try:
+        # Specifically not copy2, want new metadata
+        shutil.copy(src, tmp_path)
+        os.rename(tmp_path, dst)
+    except:
+        os.remove(tmp_path)
+        raise
 
 
 def clean_up(file_list):
@@ -105,6 +151,8 @@ def cli():
     parser.add_argument('--altmaxdist', action='store_true')
     parser.add_argument('--clean', action='store_true')
     parser.add_argument('--overwrite', action='store_true')
+    parser.add_argument('--processes', type=int, default=None,
+                        help="Worker processes (default: all cores)")
 
     return vars(parser.parse_args())
 
@@ -0,0 +1,132 @@
+"""
+Dense, memory-mapped (facid x year x quarter) table of one pollutant's raw
+emissions, so a firm's emissions are a row lookup instead of a reshape of
+the full emissions data.
+
+A cube is a folder of `.npy` arrays plus 'meta.json':
+    facids      (F,) int64, sorted
+    cube        (F, Y, Q) float32, NaN where a firm has no emissions
+with the years and quarters in 'meta.json', and the `source` data it was
+built from (see `atmods.io.emissions_cube`). Annual pollutants have one
+"quarter". Units are the source data's (tons or lbs), see
+`atmods.io.formatted_firms_emission_grams_sec`.
+"""
+from __future__ import division
+
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+CUBE_VERSION = 1
+VALUE_DTYPE = np.float32
+
+
+class EmissionsCube(object):
+
+    def __init__(self, cube_path):
+        self.path = cube_path
+        self._meta = None
+        self._facids = None
+        self._values = None
+        self._facid_row = None
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, 'meta.json'))
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            with open(os.path.join(self.path, 'meta.json')) as f:
+                self._meta = json.load(f)
+        return self._meta
+
+    @property
+    def source(self):
+        return self.meta.get('source')
+
+    @property
+    def years(self):
+        return self.meta['years']
+
+    @property
+    def quarters(self):
+        return self.meta['quarters']
+
+    @property
+    def facids(self):
+        if self._facids is None:
+            self._facids = np.load(os.path.join(self.path, 'facids.npy'))
+        return self._facids
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = np.load(os.path.join(self.path, 'cube.npy'),
+                                   mmap_mode='r')
+        return self._values
+
+    def __contains__(self, facid):
+        return facid in self._rows()
+
+    def _rows(self):
+        if self._facid_row is None:
+            self._facid_row = {facid: row
+                               for row, facid in enumerate(self.facids)}
+        return self._facid_row
+
+    def firm(self, facid):
+        """`facid`'s (year x quarter) emissions. KeyError if not in cube."""
+        return self.values[self._rows()[facid]]
+
+
+def write_cube(cube_path, emit, years, quarters=None, source=None):
+    """
+    Build a cube at `cube_path` from Series `emit`, indexed (facid, year,
+    quarter), or (facid, year) for annual data (`quarters` None). Years not
+    in `years` are dropped. `source` is kept in the meta to tell when the
+    cube is out of date.
+    """
+    facids, facid_pos = np.unique(emit.index.get_level_values('facid'),
+                                  return_inverse=True)
+    year_pos = pd.Index(years).get_indexer(
+        emit.index.get_level_values('year'))
+    if quarters is None:
+        quarter_pos = np.zeros(len(emit), dtype=np.int64)
+        num_q = 1
+    else:
+        quarter_pos = pd.Index(quarters).get_indexer(
+            emit.index.get_level_values('quarter'))
+        num_q = len(quarters)
+    keep = (year_pos >= 0) & (quarter_pos >= 0)
+
+    cube = np.empty((len(facids), len(years), num_q), dtype=VALUE_DTYPE)
+    cube.fill(np.nan)
+    cube[facid_pos[keep], year_pos[keep], quarter_pos[keep]] = (
+        emit.values[keep])
+
+    meta = {'version': CUBE_VERSION,
+            'source': source,
+            'years': [int(y) for y in years],
+            'quarters': None if quarters is None else [int(q)
+                                                       for q in quarters]}
+
+    parent = os.path.dirname(os.path.abspath(cube_path))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp_path = tempfile.mkdtemp(dir=parent, suffix='.tmp')
+    try:
+        np.save(os.path.join(tmp_path, 'facids.npy'),
+                facids.astype(np.int64))
+        np.save(os.path.join(tmp_path, 'cube.npy'), cube)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if os.path.isdir(cube_path):
+            shutil.rmtree(cube_path)
+        os.rename(tmp_path, cube_path)
+    except:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
@@ -24,6 +24,10 @@ ALTMAXDIST = 30
 # CPU speed
 JOB_LIMIT_MIN = 210.
 CPU_SEC_PER_UNIT = 0.065
+# Max number of receptor shards (cores) for a single firm-chunk job
+MAX_SHARDS = 8
+# Slurm job logs, parsed for run times by `atmods.timing`
+JOB_OUT_PATH = os.path.normpath('/n/home08/dsulivan/jobout')
 
 FIRMS_FOR_ALTMAXDIST = (
     800089,     # Just west of County
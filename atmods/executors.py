@@ -0,0 +1,184 @@
+"""
+Backends that run a batch of Aermod firm-chunks, see `batchrun`.
+
+An executor's `run(geounit, firm_chunks, bypass_confirm=False, **kwargs)`
+takes a list of `FirmChunk`s and `batchrun`'s CLI options. `batchrun`
+defines `SlurmExecutor`; `LocalExecutor` runs firm-chunks in processes on
+this machine.
+"""
+from __future__ import division
+
+import os
+import sys
+import time
+import multiprocessing as mp
+from collections import namedtuple
+
+from econtools import confirmer
+
+from util.system import data_path
+from atmods.aermod import AermodPool
+from atmods.run_and_write import run_and_write, run_unique_sources
+
+# `resources` is the firm's row of `calc_resources` plus `mem` (MB)
+FirmChunk = namedtuple('FirmChunk', ['jobname', 'facid', 'chunk_info',
+                                     'resources'])
+
+LOCAL_LOG_PATH = data_path('jobout')
+POLL_SEC = 1.
+
+
+class Executor(object):
+    """
+    Abstract base for executors. Subclasses implement `run(geounit,
+    firm_chunks, bypass_confirm=False, **kwargs)`, which runs (or submits)
+    every `FirmChunk` in `firm_chunks`; `kwargs` are `batchrun`'s CLI
+    options.
+    """
+
+    def run(self, geounit, firm_chunks, bypass_confirm=False, **kwargs):
+        raise NotImplementedError("Executor subclasses implement `run`")
+
+
+class LocalExecutor(Executor):
+    """
+    Run firm-chunks concurrently on this machine.
+
+    Jobs start longest first (by estimated CPU time) as long as their cores
+    (`num_shards`) fit in `procs` and their memory fits in `mem_budget` (MB,
+    defaults to physical memory). A job too big for the budget runs alone.
+    Each job's output goes to `log_dir`/{jobname}.out, like Slurm's, so
+    `atmods.timing` can ingest it.
+
+    Finished firm-chunks are written atomically and `batchrun` only passes
+    firm-chunks that aren't on disk, so an interrupted batch resumes by
+    running `batchrun` again.
+
+    With `linear`, the firms' unique stacks are run first (see
+    `run_and_write.run_unique_sources`) on all `procs`.
+    """
+
+    def __init__(self, procs=None, mem_budget=None, log_dir=LOCAL_LOG_PATH):
+        self.procs = procs or mp.cpu_count()
+        self.mem_budget = mem_budget or _physical_mem()
+        self.log_dir = log_dir
+
+    def run(self, geounit, firm_chunks, bypass_confirm=False, **kwargs):
+        if not firm_chunks:
+            print "No jobs to run!"
+            return []
+
+        pending = sorted(firm_chunks, key=_est_cpu, reverse=True)
+        est_hours = sum(_est_cpu(fc) for fc in pending) / 60
+        print "{} jobs, est. {:,.1f} CPU hours on {} cores, {:,} MB".format(
+            len(pending), est_hours, self.procs, self.mem_budget)
+        if not bypass_confirm and not confirmer('>>> Run locally?'):
+            sys.exit(0)
+
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        if kwargs.get('linear'):
+            facids = sorted(set(fc.facid for fc in pending))
+            with AermodPool(self.procs) as pool:
+                run_unique_sources(geounit, facids,
+                                   altmaxdist=kwargs.get('altmaxdist', True),
+                                   quiet=kwargs.get('quiet', False),
+                                   pool=pool)
+
+        failed = []
+        running = {}    # jobname -> (FirmChunk, Process)
+        try:
+            while pending or running:
+                to_start = self._startable(pending, running.values())
+                for fc in to_start:
+                    running[fc.jobname] = (fc, self._start(geounit, fc,
+                                                           kwargs))
+                started = set(fc.jobname for fc in to_start)
+                pending = [fc for fc in pending if fc.jobname not in started]
+                time.sleep(POLL_SEC)
+                for fc, proc in running.values():
+                    if proc.is_alive():
+                        continue
+                    proc.join()
+                    del running[fc.jobname]
+                    status = 'done' if proc.exitcode == 0 else 'FAILED'
+                    if proc.exitcode != 0:
+                        failed.append(fc.jobname)
+                    print "{} {} ({} left)".format(
+                        fc.jobname, status, len(pending) + len(running))
+                    sys.stdout.flush()
+        except KeyboardInterrupt:
+            print "Interrupted, stopping {} jobs".format(len(running))
+            for __, proc in running.values():
+                proc.terminate()
+                proc.join()
+            raise
+
+        if failed:
+            print "Failed jobs (see {}): {}".format(self.log_dir,
+                                                   ' '.join(failed))
+        return failed
+
+    def _startable(self, pending, running):
+        """
+        Jobs from `pending` (longest first) that fit next to `running`, a
+        list of (FirmChunk, Process).
+        """
+        free_procs = self.procs - sum(_cores(fc) for fc, __ in running)
+        free_mem = self.mem_budget - sum(_mem(fc) for fc, __ in running)
+        to_start = []
+        for fc in pending:
+            too_big = _cores(fc) > self.procs or _mem(fc) > self.mem_budget
+            if too_big:
+                # Would never fit, so run alone
+                fits = not running and not to_start
+            else:
+                fits = _cores(fc) <= free_procs and _mem(fc) <= free_mem
+            if fits:
+                to_start.append(fc)
+                free_procs -= _cores(fc)
+                free_mem -= _mem(fc)
+        return to_start
+
+    def _start(self, geounit, fc, kwargs):
+        log_path = os.path.join(self.log_dir, fc.jobname + '.out')
+        proc = mp.Process(target=_run_firm_chunk,
+                          args=(geounit, fc, log_path, kwargs),
+                          name=fc.jobname)
+        proc.start()
+        return proc
+
+
+def _run_firm_chunk(geounit, fc, log_path, kwargs):
+    # Send this process's output (incl. Aermod's) to the job log
+    with open(log_path, 'a') as log:
+        sys.stdout.flush()
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+    run_and_write(geounit, 'aermod', fc.facid,
+                  chunk_info=fc.chunk_info,
+                  overwrite=kwargs.get('overwrite', False),
+                  altmaxdist=kwargs.get('altmaxdist', True),
+                  quiet=kwargs.get('quiet', False),
+                  shards=_cores(fc),
+                  linear=kwargs.get('linear', False))
+
+
+def _est_cpu(fc):
+    """Estimated CPU minutes of firm-chunk `fc`."""
+    return fc.resources['total_cpu'] / fc.resources['num_chunks']
+
+
+def _cores(fc):
+    return int(fc.resources['num_shards'])
+
+
+def _mem(fc):
+    return fc.resources['mem']
+
+
+def _physical_mem():
+    """Physical memory in MB."""
+    return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') //
+            1024 ** 2)
@@ -2,9 +2,10 @@ from __future__ import division
 
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
 
 from util import UTM
-from util.distance import getdist
+from util.distance import SpatialIndex, utm_index
 
 
 def interpolate(source_df, target_df, cutoff_km=15, method='invd', cv=False):
@@ -21,23 +22,28 @@ def interpolate(source_df, target_df, cutoff_km=15, method='invd', cv=False):
     ))
     # Drop source if it's missing values for some times (balance the panel)
     source_wide = source_wide[source_wide.notnull().all(axis=1)]
-    # Get dists for each set of unique UTM's (just need source UTM in cols)
-    dist = getdist(target_df,
-                   source_wide.iloc[:, 0].to_frame('dum').reset_index())
+    # Get (target, source) pairs closer than `cutoff_km` (sparse)
+    sources = SpatialIndex(source_wide.index)
+    target_pos, source_pos, dist = sources.within(target_df, cutoff_km)
+    keep = dist < cutoff_km
     if cv:
-        dist[dist <= 1e-3] = cutoff_km * 1.1
+        keep &= dist > 1e-3
+    target_pos, source_pos, dist = (target_pos[keep], source_pos[keep],
+                                    dist[keep])
 
-    assert dist.shape[1] == source_wide.shape[0]
-    assert dist.shape[0] == target_df.shape[0]
-
-    # Pass dist to invdist to get weights
-    dist = dist.applymap(lambda x: 1 / x if x < cutoff_km else 0)  # Invert dist
-    dist = dist.divide(dist.sum(axis=1), axis=0)    # Re-scale to 1
+    # Pass dist to invdist to get weights, re-scale to 1
+    num_targets = len(utm_index(target_df))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = sp.csr_matrix((1 / dist, (target_pos, source_pos)),
+                                shape=(num_targets, len(sources)))
+        weight_sums = np.asarray(weights.sum(axis=1)).ravel()
+        weights = sp.diags(1 / weight_sums).dot(weights)
 
     # Multiply weight matrix by wide source_df: done!
-    interpolated = pd.DataFrame(np.dot(dist.values, source_wide.values),
-                                columns=source_wide.columns,
-                                index=dist.index)
+    values = weights.dot(source_wide.values)
+    values[weight_sums == 0] = np.nan     # No sources within `cutoff_km`
+    interpolated = pd.DataFrame(values, columns=source_wide.columns,
+                                index=utm_index(target_df))
 
     return interpolated
 
@@ -1,26 +1,36 @@
 from __future__ import division
 
+import os
 import os.path as path
 import re
+import json
+import time
+import hashlib
+import shutil
+import tempfile
 import multiprocessing as mp
+from collections import namedtuple
 
 from econtools import (int2base, base2int, load_or_build, load_or_build_direct,
-                       force_iterable, generate_chunks,)
+                       force_iterable,)
 
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
 
 from util import UTM
 from util.system import hostname, data_path, BULK_DATA
 from clean import (load_geounit, load_blocks_wzip, load_monitors,
                    load_houses_utm)
-from clean.fake_grid import round_nearest, GRID_SIZE
+from clean.fake_grid import GRID_SIZE
 from clean.pr2 import load_stacks, emissions, elec_facids
 from clean.pr3.toxics import load_named_toxic_emissions
 from atmods.env import FIRMS_FOR_ALTMAXDIST
 from atmods.kernels import KERNELS
 from atmods.chunktools import calc_aermod_units
 from atmods.interpolate import interpolate
+from atmods.store import ExposureStore
+from atmods.emitcube import EmissionsCube, write_cube
 
 AIRQ_PATH_STEM = 'airq'
 AIRQ_PATH = data_path(AIRQ_PATH_STEM)
@@ -29,6 +39,19 @@ LOCAL_CHUNK_PATH = path.join(AIRQ_PATH, 'from_regal')
 BULK_CHUNK_PATH = path.join(BULK_DATA, 'airq')
 
 CHUNK_ID_BASE = 62
+# Log of finished firm(chunk) files in each output folder, see `record_output`
+OUTPUT_MANIFEST = '_completed.jsonl'
+
+# > any UTM northing, see `utm_keys`
+GRID_KEY_BASE = 10 ** 7
+# Receptors interpolated at once by `_bilinear_cells`
+BILINEAR_CHUNK = 50000
+
+# RAM (MB) to leave each `sum_allfirms_exposure_mp` worker for one firm
+MP_WORKER_MB = 2048
+# `load_or_build` files of `emissions` and `load_named_toxic_emissions`
+EMISSIONS_SOURCES = {'nox': data_path('pr2_nox.p'),
+                     'toxics': data_path('pr3_toxics.pkl')}
 # `pr2` nox is not a balanced panel w/ nan's, so can't pull years from firms
 PR2_YEARS = range(1994, 2006 + 1)
 
@@ -54,6 +77,16 @@ def normed_firmexp_path(geounit, model, facid, chunk_info=None,
 
     return full_path
 
+def normed_store_path(geounit, model, altmaxdist=False):
+    """Folder of `geounit`/`model`'s `atmods.store.ExposureStore`."""
+    folder = _normed_firmexp_folder(altmaxdist=altmaxdist)
+    return path.join(folder, '{}_{}_store'.format(geounit, model))
+
+
+def exposure_matrices_path(geounit, model):
+    """Folder of `geounit`/`model`'s saved `load_exposure_matrices`."""
+    return path.join(AIRQ_PATH, '{}_{}_matrices'.format(geounit, model))
+
 def _normed_firmexp_folder(chunk_info=None, altmaxdist=False):
     if chunk_info and hostname == 'harvard':
         # For pulling from regal on cluster
@@ -127,6 +160,73 @@ def parse_firm_info(filename):
     return facid, chunk_id, num_chunks
 
 
+def atomic_pickle(df, filepath):
+    """
+    Pickle `df` to `filepath` via a temp file and rename, so an interrupted
+    write never leaves a partial file that looks finished.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.dirname(filepath), suffix='.tmp')
+    os.close(fd)
+    try:
+        df.to_pickle(tmp_path)
+        os.rename(tmp_path, filepath)
+    except:
+        os.remove(tmp_path)
+        raise
+
+def record_output(filepath):
+    """
+    Append `filepath`'s name, size, and md5 to its folder's `OUTPUT_MANIFEST`.
+    Each entry is one short `O_APPEND` write, so concurrent jobs don't
+    interleave entries.
+    """
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            md5.update(block)
+    entry = json.dumps({'file': path.basename(filepath),
+                        'size': path.getsize(filepath),
+                        'md5': md5.hexdigest(),
+                        'time': int(time.time())})
+    manifest = path.join(path.dirname(filepath), OUTPUT_MANIFEST)
+    fd = os.open(manifest, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, entry + '\n')
+    finally:
+        os.close(fd)
+
+def load_output_manifest(folder):
+    """
+    Return dict of filename to latest `record_output` entry for `folder`.
+    Only files written since manifests were introduced are listed.
+    """
+    entries = {}
+    manifest = path.join(folder, OUTPUT_MANIFEST)
+    if not path.isfile(manifest):
+        return entries
+    with open(manifest) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue    # Partial line from a killed writer
+            entries[entry['file']] = entry
+    return entries
+
+def list_outputs(folder, use_manifest=False):
+    """
+    Return set of filenames finished in `folder`, from one directory listing
+    or, with `use_manifest`, from its `OUTPUT_MANIFEST` without touching the
+    directory.
+    """
+    if use_manifest:
+        return set(load_output_manifest(folder))
+    try:
+        return set(os.listdir(folder))
+    except OSError:
+        return set()
+
+
 def filepath_airqdata(geounit, model, elec=None):
     filename = "{geounit}s_{model}".format(geounit=geounit, model=model)
     # Add electric suffix if necessary
@@ -278,103 +378,302 @@ def load_patzip_full_exposure(model):
 
 
 def _load_full_exposure_guts(geounit, model, use_grids=False, use_mp=False,
-                             **kwargs):
-    """ Build `geounit`s Aermod or kernel exposure (`model`) from all firms """
-
-    if geounit != 'grid' and use_grids:
+                             use_sparse=False, bilinear=False, **kwargs):
+    """
+    Build `geounit`s Aermod or kernel exposure (`model`) from all firms.
+    `bilinear` interpolates from the grid's exposure (with `use_grids`),
+    saved separately from the nearest-cell version.
+    """
+    filepath = filepath_airqdata(geounit, model)
+    if bilinear and not (geounit != 'grid' and use_grids):
+        raise ValueError("`bilinear` only works with `use_grids`")
+
+    if bilinear:
+        filepath = filepath_airqdata(geounit, model + '_bilinear')
+        def buildfunc(geounit, model):
+            return pull_geounit_exposure_from_grids(geounit, model,
+                                                    bilinear=True)
+    elif geounit != 'grid' and use_grids:
         buildfunc = pull_geounit_exposure_from_grids
+    elif use_sparse:
+        buildfunc = sum_allfirms_exposure_sparse
     elif use_mp:
         buildfunc = sum_allfirms_exposure_mp
     else:
         buildfunc = sum_allfirms_exposure
 
-    @load_or_build(filepath_airqdata(geounit, model))
+    @load_or_build(filepath)
     def build_full_exposure(*args):
         return buildfunc(*args)
 
     return build_full_exposure(geounit, model, **kwargs)
 
 
-def pull_geounit_exposure_from_grids(geounit, model, **kwargs):
+def pull_geounit_exposure_from_grids(geounit, model, bilinear=False,
+                                     **kwargs):
     """
     The 'grid' geounit is a superset of all other geounits. This function
     creates data for `geounit` from the grid's data to avoid using
     `sum_allfirms_exposure` directly since it takes forever.
+
+    Each of `geounit`'s receptors gets the exposure of the grid cell it
+    rounds to (houses must be on a cell), looked up by `utm_keys` in the
+    memory-mapped `grid_exposure_cells`. With `bilinear`, it gets the
+    bilinear interpolation of the four cells around it instead. Receptors
+    off the grid are dropped.
+    """
+    cells = grid_exposure_cells(model)
+    utm = _geounits_utm(geounit)
+    east, north = utm[UTM[0]].values, utm[UTM[1]].values
+
+    if bilinear:
+        values, found = _bilinear_cells(cells, east, north)
+        return _cells_frame(values, east[found], north[found], cells)
+
+    grid_east, grid_north = snap_to_grid(east), snap_to_grid(north)
+    pos, found = _find_cells(cells.keys, utm_keys(grid_east, grid_north))
+    if geounit == 'house':
+        # House UTM's are grid cells, only exact matches
+        found &= (grid_east == east) & (grid_north == north)
+    values = cells.values[pos[found]]
+
+    return _cells_frame(values, east[found], north[found], cells)
+
+def _find_cells(cell_keys, keys):
+    """ Positions of `keys` in sorted `cell_keys`, and which were found. """
+    pos = np.searchsorted(cell_keys, keys)
+    pos[pos == len(cell_keys)] = 0
+    found = cell_keys[pos] == keys
+    return pos, found
+
+def _bilinear_cells(cells, east, north):
+    """
+    Bilinear interpolation of `cells`' values at (`east`, `north`) from the
+    four cells around each point, done `BILINEAR_CHUNK` points at a time.
+    Missing cells (or NaN values) are left out and the other corners'
+    weights rescaled. Returns the (found point, quarter, year) values and
+    which points had any data.
+    """
+    east = np.asarray(east, dtype=np.float64)
+    north = np.asarray(north, dtype=np.float64)
+    west_edge = np.floor(east / GRID_SIZE).astype(np.int64) * GRID_SIZE
+    south_edge = np.floor(north / GRID_SIZE).astype(np.int64) * GRID_SIZE
+    frac_east = (east - west_edge) / GRID_SIZE
+    frac_north = (north - south_edge) / GRID_SIZE
+
+    values = np.empty((len(east),) + cells.values.shape[1:])
+    for start in xrange(0, len(east), BILINEAR_CHUNK):
+        chunk = slice(start, start + BILINEAR_CHUNK)
+        num_pts = len(east[chunk])
+        weighted_sum = np.zeros((num_pts,) + cells.values.shape[1:])
+        weight_sum = np.zeros_like(weighted_sum)
+        for d_east, d_north in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            weight = ((frac_east[chunk] if d_east else 1 - frac_east[chunk]) *
+                      (frac_north[chunk] if d_north else
+                       1 - frac_north[chunk]))
+            pos, found = _find_cells(
+                cells.keys, utm_keys(west_edge[chunk] + d_east * GRID_SIZE,
+                                     south_edge[chunk] + d_north * GRID_SIZE))
+            corner = np.zeros_like(weighted_sum)
+            corner[found] = cells.values[pos[found]]
+            has_data = found[:, np.newaxis, np.newaxis] & ~np.isnan(corner)
+            weight = np.where(has_data, weight[:, np.newaxis, np.newaxis], 0)
+            weighted_sum += weight * np.where(has_data, corner, 0)
+            weight_sum += weight
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values[chunk] = np.where(weight_sum > 0,
+                                     weighted_sum / weight_sum, np.nan)
+
+    found = ~np.isnan(values).all(axis=2).all(axis=1)
+    return values[found], found
+
+def _cells_frame(values, east, north, cells):
     """
-    grids, grids_orig_cols = _prep_grids_df(model)
-    geounits_utm_idx = _geounits_utm_idx(geounit)
-    geounits_model = grids.join(geounits_utm_idx, how='inner')
-    # Non-house geounits don't necessarily have rounded UTM values. Their
-    # 'real' UTM's are merged in as columns, now replace rounded UTM in index
-    # with real values.
-    if geounit != 'house':
-        for utm in UTM:
-            geounits_model.rename(columns={'{}_real'.format(utm): utm},
-                                  inplace=True)
-        geounits_model.set_index(UTM, inplace=True)
-    # Put quarter back in index (was moved out by `_prep_grids_df`
-    geounits_model.set_index('quarter', append=True, inplace=True)
-    geounits_model.sort_index(inplace=True)
-    geounits_model.columns = grids_orig_cols
-    return geounits_model
-
-def _prep_grids_df(model):
-    grids = load_full_exposure('grid', model)
-    grids_orig_cols = grids.columns     # Merge/join wrecks multicolumns, save
-                                        # these for after the merge
-    grids.columns = grids.columns.droplevel('model')
-    grids.reset_index('quarter', inplace=True)  # Want to merge on UTM only
-    return grids, grids_orig_cols
-
-def _geounits_utm_idx(geounit):
+    Frame of (receptor, quarter, year) `values` for receptors at `east`,
+    `north`, indexed like the grid's exposure.
+    """
+    num_q = values.shape[1]
+    arrays = [east.repeat(num_q), north.repeat(num_q)]
+    names = list(UTM)
+    if cells.quarters is not None:
+        arrays.append(np.tile(np.asarray(cells.quarters), len(east)))
+        names.append('quarter')
+    index = pd.MultiIndex.from_arrays(arrays, names=names)
+    df = pd.DataFrame(values.reshape(len(index), -1), index=index,
+                      columns=cells.columns)
+    # Cells missing a quarter (not in the grid's data)
+    df = df[df.notnull().any(axis=1)]
+    df.sort_index(inplace=True)
+    return df
+
+def _geounits_utm(geounit):
     if geounit == 'monitor':
         df = load_monitors(fullcover=False)
     else:
         df = load_geounit(geounit)
-    df = df[UTM].drop_duplicates()
-    # Non-house geounits don't necessarily have rounded UTM values.
-    if geounit != 'house':
-        for utm in UTM:
-            df['{}_real'.format(utm)] = df[utm]
-            df[utm] = df[utm].apply(round_nearest, args=(GRID_SIZE,))
-    utm_idx = df.set_index(UTM)
-    return utm_idx
+    return df[UTM].drop_duplicates()
+
+def utm_keys(east, north):
+    """ One int64 key per integer (east, north); sorts like the pairs. """
+    return (np.asarray(east, dtype=np.int64) * GRID_KEY_BASE +
+            np.asarray(north, dtype=np.int64))
+
+def snap_to_grid(utm):
+    """ Vectorized `round_nearest(utm, GRID_SIZE)`. """
+    utm = np.asarray(utm, dtype=np.float64)
+    return (np.around(utm / GRID_SIZE) * GRID_SIZE).astype(np.int64)
+
+GridCells = namedtuple('GridCells', ['keys', 'values', 'quarters',
+                                     'columns'])
+
+def grid_exposure_cells(model, _rebuild=False):
+    """
+    The grid's `model` exposure as `GridCells`: sorted `utm_keys` of every
+    cell and a memory-mapped (cell, quarter, year) `values` array, with the
+    grid exposure's `quarters` (None if annual) and `columns`. Built from
+    `load_full_exposure('grid', model)` and rebuilt when that file changes.
+    """
+    grid_path = filepath_airqdata('grid', model)
+    cells_path = path.splitext(grid_path)[0] + '_cells'
+    meta_path = path.join(cells_path, 'meta.json')
+    meta = None
+    if not _rebuild and path.isfile(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['source'] != file_fingerprint(grid_path):
+            meta = None
+    if meta is None:
+        grids = load_full_exposure('grid', model)
+        meta = _write_grid_cells(cells_path, grids,
+                                 source=file_fingerprint(grid_path))
+        del grids
+
+    columns = pd.MultiIndex.from_tuples([tuple(c) for c in meta['columns']],
+                                        names=meta['columns_names'])
+    return GridCells(np.load(path.join(cells_path, 'keys.npy')),
+                     np.load(path.join(cells_path, 'values.npy'),
+                             mmap_mode='r'),
+                     meta['quarters'], columns)
+
+def _write_grid_cells(cells_path, grids, source=None):
+    east = grids.index.get_level_values(UTM[0]).values
+    north = grids.index.get_level_values(UTM[1]).values
+    keys, cell_pos = np.unique(utm_keys(east, north), return_inverse=True)
+    if 'quarter' in grids.index.names:
+        row_q = grids.index.get_level_values('quarter').values
+        quarters = np.unique(row_q)
+        q_pos = np.searchsorted(quarters, row_q)
+        quarters = [int(q) for q in quarters]
+    else:
+        quarters = None
+        q_pos = np.zeros(len(grids), dtype=np.int64)
+    num_q = 1 if quarters is None else len(quarters)
+
+    parent = path.dirname(path.abspath(cells_path))
+    tmp_path = tempfile.mkdtemp(dir=parent, suffix='.tmp')
+    try:
+        np.save(path.join(tmp_path, 'keys.npy'), keys)
+        values = np.lib.format.open_memmap(
+            path.join(tmp_path, 'values.npy'), mode='w+', dtype=np.float64,
+            shape=(len(keys), num_q, grids.shape[1]))
+        values[:] = np.nan
+        values[cell_pos, q_pos] = grids.values
+        values.flush()
+        del values
+        meta = {'source': source,
+                'quarters': quarters,
+                'columns': [list(c) for c in grids.columns.tolist()],
+                'columns_names': list(grids.columns.names)}
+        with open(path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if path.isdir(cells_path):
+            shutil.rmtree(cells_path)
+        os.rename(tmp_path, cells_path)
+    except:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return meta
+
+def file_fingerprint(filepath):
+    """ 'size:mtime' of `filepath`, or None if it doesn't exist. """
+    if not path.isfile(filepath):
+        return None
+    stat = os.stat(filepath)
+    return '{}:{!r}'.format(stat.st_size, stat.st_mtime)
 
 
 # Building/aux methods
-def sum_allfirms_exposure_mp(geounit, model, firm_list=None):
-    """ Multi-processing version of `sum_allfirms_exposure` """
-    CORES = 2 if geounit == 'grid' else 4   # 'grid' uses a lot of RAM
-    # Break `firm_list` into number of cores
+def sum_allfirms_exposure_mp(geounit, model, firm_list=None, processes=None):
+    """
+    Multi-processing version of `sum_allfirms_exposure`. Workers take firms
+    one at a time from a pool and add them straight into one shared total,
+    so memory is one total plus a firm per worker. `processes` defaults to
+    as many as fit in available RAM at `MP_WORKER_MB` each, up to the
+    number of cores.
+    """
     if firm_list is None:
         firm_list = _get_all_facids(geounit, model)
-    list_chunk_size = int(np.ceil(len(firm_list) / CORES))
-    firm_list_chunks = list(generate_chunks(firm_list, list_chunk_size))
-    # Get the jobs going
-    output = mp.Queue()
-    processes = [
-        mp.Process(
-            target=_mp_wrapper,
-            args=(geounit, model, this_firm_list, output)
-        )
-        for this_firm_list in firm_list_chunks
-    ]
-    print "Starting {} processes!".format(len(processes))
-    for p in processes:
-        p.start()
-    for p in processes:
-        p.join(1)
-
-    results = [output.get() for p in processes]
-    full_scaled = results.pop()
-    while results:
-        full_scaled = full_scaled.add(results.pop(), fill_value=0)
-
-    return full_scaled
-
-def _mp_wrapper(geounit, model, this_firm_list, q):
-    result = sum_allfirms_exposure(geounit, model, this_firm_list)
-    q.put(result)
+    else:
+        firm_list = force_iterable(firm_list)
+
+    __, idx, col_idx = _allfirms_exp_index(geounit, model)
+    shape = (len(idx), len(col_idx))
+    shared_tot = mp.RawArray('d', shape[0] * shape[1])
+    lock = mp.Lock()
+    allfirms_emit_gs = formatted_firms_emission_grams_sec(model=model)
+
+    if processes is None:
+        processes = _mp_processes(shape[0] * shape[1] * 8)
+    print "Starting {} processes!".format(processes)
+    pool = mp.Pool(processes, initializer=_init_sum_worker,
+                   initargs=(geounit, model, allfirms_emit_gs, idx, col_idx,
+                             shared_tot, lock))
+    try:
+        for fid in pool.imap_unordered(_sum_worker, firm_list):
+            print str(fid)
+    finally:
+        pool.close()
+        pool.join()
+
+    running_tot = np.frombuffer(shared_tot).reshape(shape)
+    return pd.DataFrame(running_tot, index=idx, columns=col_idx)
+
+def _mp_processes(total_bytes):
+    free_mb = _available_mem() - total_bytes // 1024 ** 2
+    return int(max(1, min(mp.cpu_count(), free_mb // MP_WORKER_MB)))
+
+def _available_mem():
+    """Available (free + reclaimable) memory in MB."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except IOError:
+        pass
+    return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') //
+            1024 ** 2)
+
+_SUM_WORKER = dict()
+
+def _init_sum_worker(geounit, model, allfirms_emit_gs, idx, col_idx,
+                     shared_tot, lock):
+    # Inherited through fork, so only set up once per worker
+    shape = (len(idx), len(col_idx))
+    _SUM_WORKER.update(geounit=geounit, model=model,
+                       allfirms_emit_gs=allfirms_emit_gs, idx=idx,
+                       col_idx=col_idx, lock=lock,
+                       running_tot=np.frombuffer(shared_tot).reshape(shape))
+
+def _sum_worker(fid):
+    w = _SUM_WORKER
+    firms_scaled = load_firm_exposure(w['geounit'], w['model'], fid,
+                                      allfirms_emit_gs=w['allfirms_emit_gs'])
+    if firms_scaled is not None:
+        with w['lock']:
+            _add_firm_exposure(w['running_tot'], w['idx'], w['col_idx'],
+                               firms_scaled)
+    return fid
 
 def _get_all_facids(geounit, model):
     if model == 'aermod':
@@ -397,7 +696,8 @@ def sum_allfirms_exposure(geounit, model, firm_list=None):
 
     allfirms_emit_gs = formatted_firms_emission_grams_sec(model=model)
 
-    running_tot = _prep_allfirms_exp_df(geounit, model)
+    __, idx, col_idx = _allfirms_exp_index(geounit, model)
+    running_tot = np.zeros((len(idx), len(col_idx)))
     for fid in firm_list:
         print str(fid)
         firms_scaled = load_firm_exposure(geounit, model, fid,
@@ -405,13 +705,29 @@ def sum_allfirms_exposure(geounit, model, firm_list=None):
                                           )
         if firms_scaled is None:
             continue
-        temp_df = firms_scaled.reindex(index=running_tot.index).fillna(0)
-        running_tot += temp_df
-        del firms_scaled, temp_df
+        _add_firm_exposure(running_tot, idx, col_idx, firms_scaled)
+        del firms_scaled
 
-    return running_tot
+    return pd.DataFrame(running_tot, index=idx, columns=col_idx)
 
-def _prep_allfirms_exp_df(geounit, model):
+def _add_firm_exposure(running_tot, idx, col_idx, firms_scaled):
+    """
+    Add `firms_scaled` into array `running_tot` (rows `idx`, columns
+    `col_idx`) in place, touching only the firm's own receptors. Receptors
+    not in `idx` are dropped, like `reindex`.
+    """
+    rows = idx.get_indexer(firms_scaled.index)
+    cols = col_idx.get_indexer(firms_scaled.columns)
+    in_idx = rows >= 0
+    values = firms_scaled.values[in_idx][:, cols >= 0]
+    # A firm's receptors are unique, so plain fancy-index add is safe
+    running_tot[np.ix_(rows[in_idx], cols[cols >= 0])] += values
+
+def _allfirms_exp_index(geounit, model):
+    """
+    Return `geounit`'s UTM index, the all-firm exposure frame's row index
+    (UTM, or UTM x quarter), and its columns (years).
+    """
     # Get UTM index
     utm = load_geounit(geounit)[UTM].drop_duplicates()
     utm_idx = utm.astype(np.int32).set_index(UTM).index
@@ -427,10 +743,237 @@ def _prep_allfirms_exp_df(geounit, model):
 
     # Add years wide
     col_idx = exposure_df_column_idx(PR2_YEARS, model)
-    df_shape = (len(idx), len(col_idx))
-    df = pd.DataFrame(np.zeros(df_shape), index=idx, columns=col_idx)
 
-    return df
+    return utm_idx, idx, col_idx
+
+
+def sum_allfirms_exposure_sparse(geounit, model, firm_list=None):
+    """
+    Same as `sum_allfirms_exposure`, as sparse (receptor x facid) exposure
+    matrices (see `load_exposure_matrices`) times dense (facid x year)
+    emissions. Per-firm rounding to
+    5 decimals is done once on the sum instead, so results can differ by
+    about 1e-5 per firm.
+    """
+    if firm_list is None:
+        firm_list = _get_all_facids(geounit, model)
+    else:
+        firm_list = force_iterable(firm_list)
+
+    normed_model = 'aermod' if 'aermod' in model else model
+    __, idx, col_idx = _allfirms_exp_index(geounit, model)
+    __, facids, matrices = load_exposure_matrices(geounit, normed_model,
+                                                  firm_list)
+    emit_gs = formatted_firms_emission_grams_sec(model=model)
+
+    def emit_matrix(emit):
+        # facid x year, missing emissions are 0 (like `load_firm_exposure`)
+        emit = emit.unstack('year').reindex(index=facids, columns=PR2_YEARS)
+        return emit.fillna(0).values
+
+    if model == 'aermod_nox':
+        by_quarter = [matrices[q - 1].dot(emit_matrix(emit_gs[q]))
+                      for q in xrange(1, 4 + 1)]
+        exposure = np.stack(by_quarter, axis=1).reshape(len(idx), -1)
+    elif 'aermod' in model:
+        # Non-NOx AERMOD is annual emissions
+        annual = sum(matrices) / len(matrices)
+        exposure = annual.dot(emit_matrix(emit_gs))
+    else:
+        # Kernels don't vary by quarter, only firm emissions do
+        by_quarter = [matrices[0].dot(emit_matrix(emit_gs[q]))
+                      for q in xrange(1, 4 + 1)]
+        exposure = np.stack(by_quarter, axis=1).reshape(len(idx), -1) * 1e7
+
+    if 'aermod' in model:
+        # Round to 5 decimals (AERMOD's actual limit)
+        exposure = np.around(exposure * 1e5) / 1e5
+
+    return pd.DataFrame(exposure, index=idx, columns=col_idx)
+
+
+def firm_exposure_matrices(geounit, model, firm_list, utm_idx):
+    """
+    Return (`facids`, `matrices`), where `matrices` has one sparse CSC
+    (len(`utm_idx`) x len(`facids`)) normed exposure matrix per column of
+    the normed data (quarters for Aermod, one for kernels). ValueError if
+    `firm_list` is empty. Firms are read
+    straight from the `ExposureStore`s when they're up to date there (see
+    `firm_store`), otherwise from their pickles.
+    """
+    firm_list = pd.Index(firm_list).unique()
+    if firm_list.empty:
+        # Number of columns comes from the firms' data
+        raise ValueError("No firms to build exposure matrices from")
+    pieces = []     # (facids, [coo per column])
+    stored = set()
+    for altmaxdist in (False, True):
+        store = open_store(geounit, model, altmaxdist=altmaxdist)
+        if store is None:
+            continue
+        # Firms use the radius `load_firm_normed_exp` would default to
+        in_store = [facid for facid in firm_list
+                    if (facid in FIRMS_FOR_ALTMAXDIST) == altmaxdist and
+                    firm_store(geounit, model, facid,
+                               altmaxdist=altmaxdist) is not None]
+        if not in_store:
+            continue
+        row_map = utm_idx.get_indexer(store.receptor_index())
+        indptr, rows = store.array('indptr'), store.array('rows')
+        values = store.array('values')
+        cols = store.positions(in_store)
+        columns = []
+        for q in xrange(values.shape[1]):
+            mat = sp.csc_matrix((values[:, q], rows, indptr),
+                                shape=(len(store.receptors), len(indptr) - 1))
+            columns.append(_remap_rows(mat[:, cols].tocoo(), row_map,
+                                       len(utm_idx)))
+        pieces.append((in_store, columns))
+        stored.update(in_store)
+
+    for facid in firm_list:
+        if facid in stored:
+            continue
+        normed_exp = load_firm_normed_exp(geounit, model, facid)
+        if normed_exp.ndim == 1:
+            normed_exp = normed_exp.to_frame()
+        row_map = utm_idx.get_indexer(normed_exp.index)
+        columns = []
+        for q in xrange(normed_exp.shape[1]):
+            mat = sp.coo_matrix(normed_exp.iloc[:, [q]].fillna(0).values)
+            columns.append(_remap_rows(mat, row_map, len(utm_idx)))
+        pieces.append(([facid], columns))
+
+    facids = [facid for piece_facids, __ in pieces
+              for facid in piece_facids]
+    num_cols = len(pieces[0][1])
+    matrices = [sp.hstack([columns[q] for __, columns in pieces],
+                          format='csc', dtype=np.float64)
+                for q in xrange(num_cols)]
+
+    return facids, matrices
+
+
+def load_exposure_matrices(geounit, model, firm_list=None):
+    """
+    `firm_exposure_matrices` of `firm_list` (default all firms) over all of
+    `geounit`'s receptors, as (`utm_idx`, `facids`, `matrices`).
+
+    The matrices are saved in `exposure_matrices_path`, with where each
+    firm's normed exposure came from (see `_normed_source`). Only firms
+    that are new or whose normed exposure changed since are read again.
+    """
+    if firm_list is None:
+        firm_list = _get_all_facids(geounit, model)
+    firm_list = pd.Index(force_iterable(firm_list)).unique()
+    if firm_list.empty:
+        raise ValueError("No firms to build exposure matrices from")
+    utm_idx = _allfirms_exp_index(geounit, model)[0]
+    mats_path = exposure_matrices_path(geounit, model)
+
+    saved = _read_exposure_matrices(mats_path, utm_idx)
+    if saved is None:
+        facids, sources, matrices = [], [], None
+    else:
+        facids, sources, matrices = saved
+    saved_sources = dict(zip(facids, sources))
+    stale = [facid for facid in firm_list
+             if saved_sources.get(facid) is None or
+             saved_sources[facid] != _normed_source(geounit, model, facid)]
+
+    if stale:
+        print "Reading {} firms' normed exposure".format(len(stale))
+        new_facids, new_matrices = firm_exposure_matrices(geounit, model,
+                                                          stale, utm_idx)
+        # After reading, e.g., house pickles built from grids now exist
+        new_sources = [_normed_source(geounit, model, facid)
+                       for facid in new_facids]
+        keep = [i for i, facid in enumerate(facids) if facid not in
+                set(new_facids)]
+        if matrices is None:
+            matrices = new_matrices
+        else:
+            matrices = [sp.hstack([old[:, keep], new], format='csc')
+                        for old, new in zip(matrices, new_matrices)]
+        facids = [facids[i] for i in keep] + list(new_facids)
+        sources = [sources[i] for i in keep] + new_sources
+        _write_exposure_matrices(mats_path, utm_idx, facids, sources,
+                                 matrices)
+
+    cols = pd.Index(facids).get_indexer(firm_list)
+    return utm_idx, firm_list.tolist(), [mat[:, cols] for mat in matrices]
+
+
+def _normed_source(geounit, model, facid):
+    """
+    Where `load_firm_normed_exp` reads `facid` from, and when that was
+    written: its `ExposureStore` or its pickle's `file_fingerprint`. None if
+    neither exists yet.
+    """
+    altmaxdist = facid in FIRMS_FOR_ALTMAXDIST
+    store = firm_store(geounit, model, facid, altmaxdist=altmaxdist)
+    if store is not None:
+        return 'store:{!r}'.format(store.mtime())
+    fingerprint = file_fingerprint(
+        normed_firmexp_path(geounit, model, facid, altmaxdist=altmaxdist))
+    return None if fingerprint is None else 'file:' + fingerprint
+
+
+def _read_exposure_matrices(mats_path, utm_idx):
+    """
+    (`facids`, `sources`, `matrices`) saved in `mats_path`, or None if there
+    aren't any or they're over different receptors than `utm_idx`.
+    """
+    meta_path = path.join(mats_path, 'meta.json')
+    if not path.isfile(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    for level, utm in enumerate(UTM):
+        saved_utm = np.load(path.join(mats_path, utm + '.npy'))
+        if not np.array_equal(saved_utm, utm_idx.get_level_values(level)):
+            return None
+    facids = np.load(path.join(mats_path, 'facids.npy')).tolist()
+    matrices = [sp.load_npz(path.join(mats_path, 'matrix{}.npz'.format(i)))
+                for i in xrange(meta['num_matrices'])]
+    return facids, meta['sources'], matrices
+
+
+def _write_exposure_matrices(mats_path, utm_idx, facids, sources, matrices):
+    parent = path.dirname(path.abspath(mats_path))
+    if not path.isdir(parent):
+        os.makedirs(parent)
+    tmp_path = tempfile.mkdtemp(dir=parent, suffix='.tmp')
+    try:
+        for level, utm in enumerate(UTM):
+            np.save(path.join(tmp_path, utm + '.npy'),
+                    utm_idx.get_level_values(level).values)
+        np.save(path.join(tmp_path, 'facids.npy'),
+                np.asarray(facids, dtype=np.int64))
+        for i, mat in enumerate(matrices):
+            sp.save_npz(path.join(tmp_path, 'matrix{}.npz'.format(i)), mat,
+                        compressed=False)
+        with open(path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'sources': sources, 'num_matrices': len(matrices)},
+                      f)
+        if path.isdir(mats_path):
+            shutil.rmtree(mats_path)
+        os.rename(tmp_path, mats_path)
+    except:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def _remap_rows(coo, row_map, num_rows):
+    """
+    Move `coo`'s rows to `row_map[row]`, dropping rows mapped to -1. Missing
+    exposure is 0, as in `load_firm_exposure`.
+    """
+    new_rows = row_map[coo.row]
+    keep = new_rows >= 0
+    data = np.nan_to_num(coo.data[keep])
+    return sp.coo_matrix((data, (new_rows[keep], coo.col[keep])),
+                         shape=(num_rows, coo.shape[1]))
 
 
 def load_firm_exposure(geounit, model, facid, allfirms_emit_gs=None,
@@ -460,8 +1003,13 @@ def load_firm_exposure(geounit, model, facid, allfirms_emit_gs=None,
     # Load raw air quality exposure data
     normed_model = 'aermod' if 'aermod' in model else model
     normed_exp = load_firm_normed_exp(geounit, normed_model, facid,
-                                      altmaxdist=altmaxdist).sort_index()
+                                      altmaxdist=altmaxdist)
+
+    return scale_firm_exposure(normed_exp, firms_emit_gs, model)
 
+def scale_firm_exposure(normed_exp, firms_emit_gs, model):
+    """ Scale one firm's normed exposure by its emissions (g/s). """
+    normed_exp = normed_exp.sort_index()
     if model == 'aermod_nox':
         actual_exp = _firms_aermod_exp(normed_exp, firms_emit_gs, model)
     elif 'aermod' in model:
@@ -477,22 +1025,26 @@ def load_firm_exposure(geounit, model, facid, allfirms_emit_gs=None,
 
 
 def _firms_aermod_exp(normed_exp, firms_noxgs, model):
-    """ Outer product of normed exp and actual emissions for each quarter. """
+    """
+    Normed exp times actual emissions for each quarter, long (UTM, quarter)
+    x year. Missing exposure or emissions give 0.
+    """
     columns = exposure_df_column_idx(firms_noxgs.index, model)
-    pn = pd.Panel(np.zeros((4, len(normed_exp), len(columns))),
-                  items=range(1, 4 + 1),
-                  major_axis=normed_exp.index,
-                  minor_axis=columns)
-    pn.items.name = 'quarter'
-    for q in xrange(1, 4+1):
-        pn[q].update(_cross_df(normed_exp[q], firms_noxgs[q], columns))
-
-    actual_exp = pn.transpose(2, 1, 0).to_frame()
+    quarters = range(1, 4 + 1)
+    # (receptor, quarter, 1) * (1, quarter, year)
+    normed = normed_exp[quarters].values
+    emit = firms_noxgs[quarters].values.T
+    arr = (normed[:, :, np.newaxis] * emit[np.newaxis, :, :]).reshape(
+        -1, len(columns))
+    arr[np.isnan(arr)] = 0
 
     # Round to 5 decimals (AERMOD's actual limit)
-    actual_exp = np.around(actual_exp * 1e5) / 1e5
+    arr *= 1e5
+    np.around(arr, out=arr)
+    arr /= 1e5
 
-    return actual_exp
+    index = _long_utm_quarter_index(normed_exp.index, quarters)
+    return pd.DataFrame(arr, index=index, columns=columns)
 
 
 def _firms_aermod_not_nox_exp(normed_exp, firms_noxgs, model):
@@ -511,12 +1063,20 @@ def _firms_aermod_not_nox_exp(normed_exp, firms_noxgs, model):
 def _firms_kernel_exp(normed_exp, firms_noxgs, model):
     """ Outer product of normed exp and actual emissions for each quarter.  """
     # Kernels don't vary by quarter, only firm emissions do,
-    # so do quarters all at once
-    long_noxgs = firms_noxgs.stack('quarter', dropna=False)
-    wide_scaled = _cross_df(normed_exp, long_noxgs, long_noxgs.index)
-    # Reshape to (UTM, quarter) x (year)
-    actual_exp = wide_scaled.stack('quarter').sort_index(axis=1)
-    actual_exp.columns = exposure_df_column_idx(actual_exp.columns, model)
+    # so do quarters all at once: (receptor, 1, 1) * (1, quarter, year)
+    firms_noxgs = firms_noxgs.sort_index()
+    quarters = firms_noxgs.columns.tolist()
+    normed = np.asarray(normed_exp, dtype=np.float64).reshape(-1)
+    emit = firms_noxgs.values.T
+    arr = (normed[:, np.newaxis, np.newaxis] * emit[np.newaxis, :, :]).reshape(
+        -1, len(firms_noxgs))
+    index = _long_utm_quarter_index(normed_exp.index, quarters)
+    # Drop (UTM, quarter)'s with no data in any year, like `stack`
+    has_data = ~np.isnan(arr).all(axis=1)
+    if not has_data.all():
+        arr, index = arr[has_data], index[has_data]
+    columns = exposure_df_column_idx(firms_noxgs.index, model)
+    actual_exp = pd.DataFrame(arr, index=index, columns=columns)
 
     # This is the correct way, but still needs ad hoc adjustment...
     if 0 == 1:
@@ -533,6 +1093,20 @@ def _firms_kernel_exp(normed_exp, firms_noxgs, model):
     return actual_exp
 
 
+def _long_utm_quarter_index(utm_index, quarters):
+    """ Each row of `utm_index` repeated for every quarter in `quarters`. """
+    num_q = len(quarters)
+    # Re-use `utm_index`'s levels instead of re-factorizing repeated values
+    codes = getattr(utm_index, 'codes', None)
+    if codes is None:
+        codes = utm_index.labels
+    codes = [np.asarray(c).repeat(num_q) for c in codes]
+    codes.append(np.tile(np.arange(num_q), len(utm_index)))
+    levels = list(utm_index.levels) + [pd.Index(quarters)]
+    names = list(utm_index.names) + ['quarter']
+    return pd.MultiIndex(levels, codes, names=names, verify_integrity=False)
+
+
 def _cross_df(raw, emit, columns):
     """ Outer product of normed exposure and emissions """
     arr = np.outer(raw, emit)
@@ -540,38 +1114,43 @@ def _cross_df(raw, emit, columns):
     return scaled
 
 
-def formatted_firms_emission_grams_sec(facid=None, model='aermod_nox'):
-    # Get correct emissions data
-    print(model)
-    aermod_not_nox = 'aermod' in model and model != 'aermod_nox'
-    if aermod_not_nox:
-        print("aermod not nox")
-        emit = load_named_toxic_emissions(name=model.replace('aermod_', ''))
-    else:
-        print("std aermod")
-        emit = emissions()
-
-    if facid:
-        emit = emit.loc[facid]
+def formatted_firms_emission_grams_sec(facid=None, model='aermod_nox',
+                                       stacked=False):
+    """
+    Emissions (g/s) for `model`'s pollutant, from its `EmissionsCube`.
 
-    # NOx data are quarterly, toxics are annual
-    if aermod_not_nox:
-        pass
-    else:
-        emit = emit.unstack('quarter')
+    NOx (quarterly) is (facid, year) x quarter, or year x quarter for one
+    `facid`; toxics (annual) are a Series on (facid, year), or on year.
+    Firms without data in a year (or quarter) are NaN. `stacked` returns
+    all firms as a Series on (facid, year, quarter) instead.
+    """
+    aermod_not_nox = 'aermod' in model and model != 'aermod_nox'
+    pollutant = model.replace('aermod_', '') if aermod_not_nox else 'nox'
+    cube = emissions_cube(pollutant)
+    years = pd.Index(cube.years, name='year')
 
-    # Some firms don't have all years (or quarters). Fill with nan
     if facid:
-        emit = emit.reindex(PR2_YEARS)
-        if not aermod_not_nox:
-            emit = emit.reindex(columns=range(1, 4 + 1))
-    elif aermod_not_nox:
-        emit = (emit
-                .unstack('year')
-                .reindex(columns=PR2_YEARS)
-                .stack('year', dropna=False))
+        emit = np.array(cube.firm(facid), dtype=np.float64)
+        if aermod_not_nox:
+            emit = pd.Series(emit[:, 0], index=years, name=pollutant)
+        else:
+            emit = pd.DataFrame(emit, index=years, columns=pd.Index(
+                cube.quarters, name='quarter'))
     else:
-        emit = emit.to_panel().to_frame(filter_observations=False)
+        emit = np.array(cube.values, dtype=np.float64)
+        levels, names = [cube.facids, cube.years], ['facid', 'year']
+        if stacked and not aermod_not_nox:
+            levels.append(cube.quarters)
+            names.append('quarter')
+        index = pd.MultiIndex.from_product(levels, names=names)
+        if aermod_not_nox:
+            emit = pd.Series(emit.reshape(-1), index=index, name=pollutant)
+        elif stacked:
+            emit = pd.Series(emit.reshape(-1), index=index)
+        else:
+            emit = pd.DataFrame(emit.reshape(len(index), -1), index=index,
+                                columns=pd.Index(cube.quarters,
+                                                 name='quarter'))
 
     # Criteria pollutants measured tons/year, toxics lbs/year
     criteria_pollutant = (
@@ -584,6 +1163,36 @@ def formatted_firms_emission_grams_sec(facid=None, model='aermod_nox'):
 
     return firms_emit_gs
 
+def emissions_cube(pollutant, _rebuild=False):
+    """
+    Return `pollutant`'s `EmissionsCube` ('nox', or a toxic's name), built
+    from `emissions` or `load_named_toxic_emissions`. Like
+    `grid_exposure_cells`, it's rebuilt when their data file
+    (`EMISSIONS_SOURCES`) has changed since.
+    """
+    cube_path = path.join(AIRQ_PATH, 'emissions_{}'.format(pollutant))
+    source_path = EMISSIONS_SOURCES['nox' if pollutant == 'nox' else 'toxics']
+    source = file_fingerprint(source_path)
+    cube = _OPEN_CUBES.get(cube_path)
+    if cube is None or not cube.exists() or cube.source != source:
+        # Maybe another process already rebuilt it
+        cube = EmissionsCube(cube_path)
+    if _rebuild or not cube.exists() or cube.source != source:
+        if pollutant == 'nox':
+            emit = emissions()
+            quarters = range(1, 4 + 1)
+        else:
+            emit = load_named_toxic_emissions(name=pollutant)
+            quarters = None
+        # Built by the loader if it wasn't there
+        write_cube(cube_path, emit, PR2_YEARS, quarters=quarters,
+                   source=file_fingerprint(source_path))
+        cube = EmissionsCube(cube_path)
+    _OPEN_CUBES[cube_path] = cube
+    return cube
+
+_OPEN_CUBES = dict()
+
 def _tonsperyq_to_gramspersec(tons_nox, quarterly=True):
     """Convert tons per year (or quarter) to grams per second."""
     tpy_to_gps = (2000. * 453.59237             # Lbs/ton * grams/lbs
@@ -601,21 +1210,31 @@ def _lbs_per_yr_to_grams_per_sec(lbs_emit):
 
 
 
-def load_firm_normed_exp(geounit, model, facid, altmaxdist=None, **lobkwargs):
+def load_firm_normed_exp(geounit, model, facid, altmaxdist=None,
+                         use_store=True, **lobkwargs):
     """
     Load unscaled exposure data for a single firm.
     Aermod in N x 4 (quarters) DataFrame, kernels in N x 0 Series.
 
     `altmaxdist` is switch for which Aermod radius to use for `facid`. `None`
       is default and defers to list in `atmods.env`.
+    `use_store` reads `facid` from the (geounit, model) `ExposureStore` if
+      it's there and up to date (see `firm_store`), else from its own
+      pickle.
     """
 
     # Use `altmaxdist` for selected firms by default
     if altmaxdist is None:
         altmaxdist = facid in FIRMS_FOR_ALTMAXDIST
 
+    if use_store:
+        store = firm_store(geounit, model, facid, altmaxdist=altmaxdist)
+    else:
+        store = None
+    if store is not None:
+        df = store.load_firm(facid)
     # Independent 'house_aermod_FIRM' files are no longer used
-    if geounit == 'house' and model == 'aermod':
+    elif geounit == 'house' and model == 'aermod':
         df = _get_houses_rawexp_from_grids(facid, altmaxdist=altmaxdist,
                                            **lobkwargs)
     else:
@@ -630,6 +1249,10 @@ def load_firm_normed_exp(geounit, model, facid, altmaxdist=None, **lobkwargs):
             )
             raise IOError(errstr.format(filepath))
 
+    return format_normed_exp(df)
+
+def format_normed_exp(df):
+    """ Normed exposure as read from disk to `load_firm_normed_exp`'s. """
     if df.shape[1] == 1:
         # If shape[1] == 1, then this is a kernel or Aermod in long format.
         # Convert to Series (`squeeze` will turn 1-row DF into float)
@@ -642,6 +1265,39 @@ def load_firm_normed_exp(geounit, model, facid, altmaxdist=None, **lobkwargs):
     return df
 
 
+def open_store(geounit, model, altmaxdist=False):
+    """
+    Return `geounit`/`model`'s `ExposureStore`, or None if it hasn't been
+    built. Opened stores are reused, so their memmaps are only opened once.
+    """
+    store_path = normed_store_path(geounit, model, altmaxdist=altmaxdist)
+    if store_path not in _OPEN_STORES:
+        store = ExposureStore(store_path)
+        if not store.exists():
+            return None
+        _OPEN_STORES[store_path] = store
+    return _OPEN_STORES[store_path]
+
+_OPEN_STORES = dict()
+
+
+def firm_store(geounit, model, facid, altmaxdist=False):
+    """
+    Return `geounit`/`model`'s `ExposureStore` if `facid`'s normed exposure
+    should be read from it, else None (read its pickle). A firm whose
+    pickle is newer than the store, i.e., re-run since `atmods.migrate_store`,
+    is read from the pickle.
+    """
+    store = open_store(geounit, model, altmaxdist=altmaxdist)
+    if store is None or facid not in store:
+        return None
+    filepath = normed_firmexp_path(geounit, model, facid,
+                                   altmaxdist=altmaxdist)
+    if path.isfile(filepath) and path.getmtime(filepath) > store.mtime():
+        return None
+    return store
+
+
 def _get_houses_rawexp_from_grids(facid, altmaxdist=False, houses_utm=None,
                                   _load=True, _rebuild=False):
     """ `altmaxdist` is switch for which radius to use for `facid` """
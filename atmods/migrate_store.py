@@ -0,0 +1,79 @@
+"""
+Convert a (geounit, model)'s per-firm normed exposure pickles into an
+`atmods.store.ExposureStore`. The pickles are left in place.
+"""
+from __future__ import division
+
+import re
+import glob
+import argparse
+from os import path
+
+import numpy as np
+
+from atmods.io import (normed_firmexp_path, normed_firmexp_fname,
+                       normed_store_path, load_firm_normed_exp, open_store)
+from atmods.store import write_store
+
+
+def migrate_store(geounit, model, altmaxdist=False, verify=False):
+    """
+    Build the store from every firm pickle in `altmaxdist`'s folder. With
+    `verify`, check every firm in the store against its pickle.
+    """
+    facids = pickled_facids(geounit, model, altmaxdist=altmaxdist)
+    print "Storing {} firms".format(len(facids))
+
+    def load_firm(facid):
+        return load_firm_normed_exp(geounit, model, facid,
+                                    altmaxdist=altmaxdist, use_store=False)
+
+    store_path = normed_store_path(geounit, model, altmaxdist=altmaxdist)
+    write_store(store_path, facids, load_firm)
+    print "Wrote {}".format(store_path)
+
+    if verify:
+        store = open_store(geounit, model, altmaxdist=altmaxdist)
+        for facid in facids:
+            from_pickle = load_firm(facid)
+            from_store = load_firm_normed_exp(geounit, model, facid,
+                                              altmaxdist=altmaxdist)
+            max_diff = np.abs(from_store.reindex(from_pickle.index).values -
+                              from_pickle.values).max()
+            # float32 storage
+            if not max_diff <= 1e-6 * np.abs(from_pickle.values).max():
+                raise AssertionError("Firm {} differs by {}".format(facid,
+                                                                   max_diff))
+        print "Verified {} firms in {}".format(len(facids), store.path)
+
+
+def pickled_facids(geounit, model, altmaxdist=False):
+    """`facid`s with a normed exposure pickle in `altmaxdist`'s folder."""
+    pattern = normed_firmexp_path(geounit, model, '*', altmaxdist=altmaxdist)
+    prefix = normed_firmexp_fname(geounit, model, '')
+    facid_re = re.compile(r'^{}(\d+)\.p$'.format(re.escape(prefix)))
+    facids = []
+    for filepath in glob.glob(pattern):
+        match = facid_re.match(path.basename(filepath))
+        if match:
+            facids.append(int(match.group(1)))
+    return sorted(facids)
+
+
+def cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('geounit',
+                        choices=['house', 'monitor', 'block', 'grid'],
+                        help='Geographic unit for model')
+    parser.add_argument('model')
+    parser.add_argument('--altmaxdist', action='store_true')
+    parser.add_argument('--verify', action='store_true',
+                        help="Check stored firms against their pickles")
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    kwargs = cli()
+    geounit = kwargs.pop('geounit')
+    model = kwargs.pop('model')
+    migrate_store(geounit, model, **kwargs)
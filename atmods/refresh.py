@@ -0,0 +1,273 @@
+"""
+Update a (geounit, model)'s summed exposure (`load_full_exposure`'s file)
+for only the firms whose normed exposure or emissions changed, instead of
+re-summing every firm.
+
+Next to the summed file, '{file}.firms/' keeps
+    manifest.json   fingerprints of the normed exposure and emissions each
+                    firm was summed with, the emissions themselves, and a
+                    fingerprint of the summed file
+    snapshots/      hard links to the normed exposure each firm was summed
+                    with (a firm's pickle, or a whole `ExposureStore`)
+Re-run firms are written to new files (`atomic_pickle`, `write_store`), so
+the snapshot still holds the old data. A refresh subtracts changed and
+dropped firms' old contributions and adds their new ones. If the summed
+file doesn't match the manifest (or `full=True`), every firm is re-summed
+from zero.
+
+Run as `python -m atmods.refresh geounit model [--full]`.
+"""
+from __future__ import division
+
+import os
+import json
+import shutil
+import hashlib
+import argparse
+from os import path
+
+import numpy as np
+import pandas as pd
+
+from atmods.env import FIRMS_FOR_ALTMAXDIST
+from atmods.store import ExposureStore
+from atmods.io import (filepath_airqdata, normed_firmexp_path,
+                       load_firm_normed_exp, open_store, firm_store,
+                       format_normed_exp, formatted_firms_emission_grams_sec,
+                       scale_firm_exposure, atomic_pickle, file_fingerprint,
+                       _get_all_facids, _allfirms_exp_index,
+                       _add_firm_exposure)
+
+MANIFEST_VERSION = 1
+
+
+def refresh_full_exposure(geounit, model, firm_list=None, full=False):
+    """
+    Bring `geounit`'s summed `model` exposure up to date with `firm_list`
+    (default all firms) and return it.
+    """
+    if firm_list is None:
+        firm_list = _get_all_facids(geounit, model)
+    firm_list = sorted(set(int(facid) for facid in firm_list))
+    normed_model = 'aermod' if 'aermod' in model else model
+
+    filepath = filepath_airqdata(geounit, model)
+    state_path = filepath + '.firms'
+    snapshot_path = path.join(state_path, 'snapshots')
+    manifest = _load_manifest(state_path)
+    if (full or manifest is None or
+            manifest['total'] != file_fingerprint(filepath)):
+        print "Summing all {} firms".format(len(firm_list))
+        __, idx, col_idx = _allfirms_exp_index(geounit, model)
+        running_tot = np.zeros((len(idx), len(col_idx)))
+        old_firms = dict()
+    else:
+        df = pd.read_pickle(filepath)
+        idx, col_idx, running_tot = df.index, df.columns, df.values
+        del df
+        old_firms = manifest['firms']
+
+    if not path.isdir(snapshot_path):
+        os.makedirs(snapshot_path)
+
+    new_firms = dict()
+    changed = 0
+    for facid in firm_list:
+        key = str(facid)
+        entry = _firm_entry(geounit, normed_model, model, facid)
+        old_entry = old_firms.pop(key, None)
+        if old_entry is not None and _same_inputs(old_entry, entry):
+            new_firms[key] = old_entry
+            continue
+        changed += 1
+        print "Firm {}".format(facid)
+        if old_entry is not None:
+            _add_contribution(running_tot, idx, col_idx, old_entry,
+                              snapshot_path, model, sign=-1)
+        entry['snapshot'] = _take_snapshot(geounit, normed_model, facid,
+                                           entry, snapshot_path)
+        _add_contribution(running_tot, idx, col_idx, entry, snapshot_path,
+                          model)
+        new_firms[key] = entry
+    # Firms no longer in `firm_list`
+    for key, old_entry in old_firms.items():
+        changed += 1
+        print "Drop firm {}".format(key)
+        _add_contribution(running_tot, idx, col_idx, old_entry,
+                          snapshot_path, model, sign=-1)
+    print "{} of {} firms changed".format(changed, len(firm_list))
+
+    total = pd.DataFrame(running_tot, index=idx, columns=col_idx)
+    atomic_pickle(total, filepath)
+    _write_manifest(state_path, {'version': MANIFEST_VERSION,
+                                 'total': file_fingerprint(filepath),
+                                 'firms': new_firms})
+    _prune_snapshots(snapshot_path, new_firms)
+
+    return total
+
+
+def _firm_entry(geounit, normed_model, model, facid):
+    """ Fingerprints of `facid`'s current normed exposure and emissions. """
+    altmaxdist = facid in FIRMS_FOR_ALTMAXDIST
+    # Same source as `load_firm_normed_exp`
+    store = firm_store(geounit, normed_model, facid, altmaxdist=altmaxdist)
+    if store is not None:
+        rows, values = store.firm_arrays(facid)
+        normed = 'store:' + _md5(rows, values)
+    else:
+        filepath = normed_firmexp_path(geounit, normed_model, facid,
+                                       altmaxdist=altmaxdist)
+        if not path.isfile(filepath):
+            # Let `load_firm_normed_exp` build it or raise
+            load_firm_normed_exp(geounit, normed_model, facid,
+                                 altmaxdist=altmaxdist)
+        normed = 'file:' + file_fingerprint(filepath)
+
+    try:
+        emit = formatted_firms_emission_grams_sec(facid=facid, model=model)
+    except KeyError:
+        emit = None     # No emissions, contributes nothing
+    return {'facid': facid,
+            'normed': normed,
+            'emit_hash': None if emit is None else _md5(emit.values),
+            'emit': _emit_to_json(emit)}
+
+
+def _same_inputs(old_entry, entry):
+    return (old_entry['normed'] == entry['normed'] and
+            old_entry['emit_hash'] == entry['emit_hash'])
+
+
+def _take_snapshot(geounit, normed_model, facid, entry, snapshot_path):
+    """
+    Hard link the normed data `entry` fingerprinted, return its name in
+    `snapshot_path`. A store is linked once, shared by its firms.
+    """
+    altmaxdist = facid in FIRMS_FOR_ALTMAXDIST
+    if entry['normed'].startswith('store:'):
+        store = open_store(geounit, normed_model, altmaxdist=altmaxdist)
+        name = 'store_{}'.format(file_fingerprint(
+            path.join(store.path, 'values.npy')).replace(':', '_'))
+        dst = path.join(snapshot_path, name)
+        if not path.isdir(dst):
+            tmp_dst = dst + '.tmp'
+            shutil.rmtree(tmp_dst, ignore_errors=True)
+            os.makedirs(tmp_dst)
+            for fname in os.listdir(store.path):
+                _link(path.join(store.path, fname), path.join(tmp_dst, fname))
+            os.rename(tmp_dst, dst)
+    else:
+        filepath = normed_firmexp_path(geounit, normed_model, facid,
+                                       altmaxdist=altmaxdist)
+        name = '{}_{}.p'.format(facid,
+                                hashlib.md5(entry['normed']).hexdigest())
+        dst = path.join(snapshot_path, name)
+        if not path.isfile(dst):
+            _link(filepath, dst)
+    return name
+
+
+def _add_contribution(running_tot, idx, col_idx, entry, snapshot_path, model,
+                      sign=1):
+    """ Add (`sign`=1) or subtract (-1) the firm in `entry`'s exposure. """
+    emit = _emit_from_json(entry['emit'])
+    if emit is None:
+        return
+    snapshot = path.join(snapshot_path, entry['snapshot'])
+    if path.isdir(snapshot):
+        store = ExposureStore(snapshot)
+        normed_exp = format_normed_exp(store.load_firm(entry['facid']))
+    else:
+        normed_exp = format_normed_exp(pd.read_pickle(snapshot))
+    firms_scaled = scale_firm_exposure(normed_exp, emit, model)
+    if sign < 0:
+        firms_scaled = -firms_scaled
+    _add_firm_exposure(running_tot, idx, col_idx, firms_scaled)
+
+
+def _prune_snapshots(snapshot_path, firms):
+    in_use = set(entry['snapshot'] for entry in firms.values())
+    for name in os.listdir(snapshot_path):
+        if name in in_use:
+            continue
+        this_path = path.join(snapshot_path, name)
+        if path.isdir(this_path):
+            shutil.rmtree(this_path)
+        else:
+            os.remove(this_path)
+
+
+def _emit_to_json(emit):
+    """ A firm's emissions (year Series or year x quarter) as a dict. """
+    if emit is None:
+        return None
+    is_frame = isinstance(emit, pd.DataFrame)
+    return {'years': [int(y) for y in emit.index],
+            'columns': ([int(q) for q in emit.columns] if is_frame
+                        else None),
+            'name': None if is_frame else emit.name,
+            'values': emit.values.tolist()}
+
+
+def _emit_from_json(emit_json):
+    if emit_json is None:
+        return None
+    years = pd.Index(emit_json['years'], name='year')
+    values = np.array(emit_json['values'], dtype=np.float64)
+    if emit_json['columns'] is None:
+        return pd.Series(values, index=years, name=emit_json['name'])
+    columns = pd.Index(emit_json['columns'], name='quarter')
+    return pd.DataFrame(values, index=years, columns=columns)
+
+
+def _load_manifest(state_path):
+    manifest_path = path.join(state_path, 'manifest.json')
+    if not path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def _write_manifest(state_path, manifest):
+    manifest_path = path.join(state_path, 'manifest.json')
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.rename(tmp_path, manifest_path)
+
+
+def _md5(*arrays):
+    digest = hashlib.md5()
+    for arr in arrays:
+        digest.update(np.ascontiguousarray(arr).tobytes())
+    return digest.hexdigest()
+
+
+def _link(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Different filesystem, etc.
+        shutil.copy(src, dst)
+
+
+def cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('geounit',
+                        choices=['house', 'monitor', 'block', 'grid'],
+                        help='Geographic unit for model')
+    parser.add_argument('model')
+    parser.add_argument('--full', action='store_true',
+                        help="Re-sum every firm")
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    kwargs = cli()
+    geounit = kwargs.pop('geounit')
+    model = kwargs.pop('model')
+    refresh_full_exposure(geounit, model, **kwargs)
@@ -1,6 +1,8 @@
 from __future__ import division
 
 import os
+import sys
+import traceback
 
 import pandas as pd
 import numpy as np
@@ -11,31 +13,41 @@ from util import UTM
 from util.distance import center_data
 from clean import load_geounit
 from clean.pr2 import load_stacks
-from atmods.io import normed_firmexp_path, parse_kernmodel
-from atmods.aermod import Aermod
-from atmods.env import MAXDIST, ALTMAXDIST
+from atmods.io import (normed_firmexp_path, parse_kernmodel, atomic_pickle,
+                       record_output)
+from atmods.aermod import (Aermod, read_postfile, run_linear,
+                           unit_stack_sources)
+from atmods.cache import AermodCache
 from atmods.wrapperargs import ModelArgs
+from atmods.chunktools import (stack_chunk_ids, plan_unique_sources,
+                               dedup_report, receptor_maxdist,
+                               unit_receptor_radius, SOURCE_CONFIG)
 from atmods.kernels import polar_kernel
 
+# POSTFILE rows read at a time by `_reduce_aermodout`
+POSTFILE_CHUNKSIZE = 500000
+
 
 def run_and_write(geounit, model, facid, chunk_info=None, overwrite=False,
                   altmaxdist=True,
-                  quiet=False, save=True):
+                  quiet=False, save=True, shards=1, polar=False,
+                  use_cache=True, linear=False, receptorDF=None):
+    """
+    `receptorDF` is `geounit`'s receptors (see `load_receptors`), to share
+    one load across several calls.
+    """
 
-    # Load receptor data
-    receptorDF = load_geounit(geounit)
-    # Restrict columns for memory efficiency
     grab = None     # XXX Not sure if I'll want to re-implement, hold for now
-    if grab:
-        receptorDF = receptorDF[UTM + [grab]].drop_duplicates()
-    else:
-        receptorDF = receptorDF[UTM].drop_duplicates()
+    if receptorDF is None:
+        receptorDF = load_receptors(geounit, grab=grab)
 
     if model == 'aermod':
         sourceDF = load_chunked_stacks(facid, chunk_info)
+        cache = AermodCache() if use_cache else None
         run_a_firm(geounit, model, facid, receptorDF, sourceDF, grab,
                    chunk_info=chunk_info, overwrite=overwrite, quiet=quiet,
-                   save=save, altmaxdist=altmaxdist)
+                   save=save, altmaxdist=altmaxdist, shards=shards,
+                   polar=polar, cache=cache, linear=linear)
     else:
         stacks = load_stacks()
 
@@ -49,6 +61,114 @@ def run_and_write(geounit, model, facid, chunk_info=None, overwrite=False,
             run_a_firm(geounit, model, fid, receptorDF, sourceDF, grab,
                        overwrite=overwrite)
 
+
+def load_receptors(geounit, grab=None):
+    receptorDF = load_geounit(geounit)
+    # Restrict columns for memory efficiency
+    if grab:
+        receptorDF = receptorDF[UTM + [grab]].drop_duplicates()
+    else:
+        receptorDF = receptorDF[UTM].drop_duplicates()
+    return receptorDF
+
+
+def dispatch(manifest_path, task_id=None, overwrite=False, altmaxdist=True,
+             quiet=False):
+    """
+    Run the firm-chunks at `task_id` of a job array manifest (see
+    `batchrun.write_manifest`) one after another, loading receptors once,
+    with `linear` if the manifest says so.
+    `task_id` defaults to `SLURM_ARRAY_TASK_ID`. Each firm-chunk is saved
+    as soon as it's done; if any fail, the rest still run and the job
+    exits with an error.
+    """
+    if task_id is None:
+        task_id = int(os.environ['SLURM_ARRAY_TASK_ID'])
+    manifest = pd.read_csv(manifest_path, index_col='task_id')
+    tasks = manifest.loc[[task_id]]
+
+    receptors = {}
+    failed = []
+    for __, task in tasks.iterrows():
+        # Manifests from before `linear` ran everything directly
+        linear = bool(task['linear']) if 'linear' in task else False
+        print "Task {}: {}".format(task_id, task['jobname'])
+        geounit = task['geounit']
+        if geounit not in receptors:
+            receptors[geounit] = load_receptors(geounit)
+        try:
+            run_and_write(geounit, 'aermod', int(task['facid']),
+                          chunk_info=(int(task['chunk_id']),
+                                      int(task['num_chunks'])),
+                          overwrite=overwrite, altmaxdist=altmaxdist,
+                          quiet=quiet, shards=int(task['shards']),
+                          linear=linear, receptorDF=receptors[geounit])
+        except Exception:
+            traceback.print_exc()
+            failed.append(task['jobname'])
+        sys.stdout.flush()
+
+    if failed:
+        print "Failed: {}".format(' '.join(failed))
+        sys.exit(1)
+
+
+def run_unique_sources(geounit, facid_list=None, altmaxdist=True,
+                       quiet=False, pool=None):
+    """
+    Run each unique source configuration (see
+    `chunktools.plan_unique_sources`) once at unit emissions, filling the
+    Aermod cache. Firm-chunks run afterwards with `linear=True` then only
+    combine cached unit runs instead of running Aermod.
+    """
+    configs, fanout = plan_unique_sources(geounit, cli_facid_list=facid_list,
+                                          altmaxdist=altmaxdist)
+    dedup_report(configs, fanout)
+    run_source_configs(geounit, configs, quiet=quiet, pool=pool)
+
+
+def dispatch_unique_sources(manifest_path, task_id=None, quiet=False):
+    """
+    Run the source configurations at `task_id` of a unique-sources manifest
+    (see `batchrun.unique_sources_script`). `task_id` defaults to
+    `SLURM_ARRAY_TASK_ID`.
+    """
+    if task_id is None:
+        task_id = int(os.environ['SLURM_ARRAY_TASK_ID'])
+    # Stack parameters must round trip exactly to hit the same cache keys
+    manifest = pd.read_csv(manifest_path, index_col='task_id',
+                           float_precision='round_trip')
+    configs = manifest.loc[[task_id]]
+    print "Task {}: {} source configs".format(task_id, configs.shape[0])
+    run_source_configs(configs['geounit'].iloc[0], configs, quiet=quiet)
+
+
+def run_source_configs(geounit, configs, quiet=False, pool=None):
+    """
+    Run each row of `configs` (`SOURCE_CONFIG` and `receptor_km`, as in
+    `chunktools.plan_unique_sources`) at unit emissions on the receptors
+    within `receptor_km` of the stack, the same run
+    `unit_run_receptors` sets up for a firm, so its output is cached.
+    """
+    receptorDF = load_receptors(geounit)
+    cache = AermodCache()
+    jobs = []
+    for i in xrange(configs.shape[0]):
+        config = configs.iloc[[i]]
+        unit_source, __ = unit_stack_sources(
+            config[SOURCE_CONFIG].assign(emit_share=1.))
+        receptors = stack_receptors(receptorDF, unit_source.iloc[0],
+                                    config['receptor_km'].iloc[0])
+        jobs.append((receptors, unit_source))
+
+    aermod_kwargs = dict(quiet=quiet, cache=cache, reducer=_reduce_aermodout)
+    if pool is not None:
+        pool.run_many(jobs, **aermod_kwargs)
+    else:
+        for receptors, unit_source in jobs:
+            Aermod(receptors, unit_source, **aermod_kwargs).runModel()
+
+
 def load_chunked_stacks(facid, chunk_info):
     """
     Return the chunk of `facid`s stacks corresponding to `chunk_info`.
@@ -71,30 +191,16 @@ def load_chunked_stacks(facid, chunk_info):
         err_str = "Chunk's id {} is out of bounds for num of chunks {}"
         raise ValueError(err_str.format(chunk_id, num_chunks))
 
-    N = firms_stacks.shape[0]
-    even_num_per_group = N // num_chunks
-    remainder = N % num_chunks
-    group_sizes = np.ones(num_chunks, dtype=int) * even_num_per_group
-    # Distribute remainder evenly
-    group_sizes[:remainder] += 1
-    # Make array of stacks' chunk_ids
-    stacks_id = np.array([
-        idx + 1     # +1 so chunks are 1-indexed, not 0
-        for idx, group_size in enumerate(group_sizes)
-        for x in range(group_size)  # Repeat `idx` `group_size` times
-    ])
-
-    # Check that result makes sense
-    assert sum(group_sizes) == N        # Every stack is allocated to one group
-    assert len(stacks_id) == N          # stacks' ids align with stackDF
-    assert max(stacks_id) == num_chunks    # Preserved num of chunks
+    stacks_id = stack_chunk_ids(firms_stacks.shape[0], num_chunks)
 
     return firms_stacks[stacks_id == chunk_id]
 
 
 def run_a_firm(geounit, model, facid, receptorDF, sourceDF, grab,
                altmaxdist=False,
-               chunk_info=None, overwrite=False, quiet=False, save=True):
+               chunk_info=None, overwrite=False, quiet=False, save=True,
+               pool=None, shards=1, polar=False, cache=None,
+               linear=False):
 
     file_path = normed_firmexp_path(geounit, model, facid,
                                     chunk_info=chunk_info,
@@ -105,30 +211,93 @@ def run_a_firm(geounit, model, facid, receptorDF, sourceDF, grab,
         print "Skip Firm {}, file {} exists.".format(facid, file_path)
         return None
 
+    if linear and not polar:
+        # Same receptors as `run_unique_sources`'s unit runs
+        unit_receptors = unit_run_receptors(geounit, facid, receptorDF,
+                                            sourceDF, altmaxdist=altmaxdist)
+    else:
+        unit_receptors = None
     # Center receptors around source
-    maxdist = ALTMAXDIST if altmaxdist else MAXDIST
-    # XXX: just increase the radius for now instead of grabbing
-    if geounit == 'block':
-        maxdist += 5
-    center_firm_utm = load_stacks(facid)[UTM].mean()
-    receptorDF = center_data(receptorDF, center_firm_utm, maxdist, grab=grab)
-    receptorDF = receptorDF[UTM].drop_duplicates()
+    receptorDF = firm_receptors(geounit, facid, receptorDF, grab=grab,
+                                altmaxdist=altmaxdist)
     # Run the model
-    rawexposure = drive_model(receptorDF, sourceDF, model, quiet=quiet)
+    rawexposure = drive_model(receptorDF, sourceDF, model, quiet=quiet,
+                              pool=pool, shards=shards, polar=polar,
+                              cache=cache, linear=linear,
+                              unit_receptors=unit_receptors)
     # Write to disk
     if save:
         print "Writing {} for Firm {}".format(model, facid)
-        rawexposure.to_pickle(file_path)
+        atomic_pickle(rawexposure, file_path)
+        record_output(file_path)
 
     return rawexposure
 
 
-def drive_model(receptorDF, sourceDF, model, quiet=False):
+def firm_receptors(geounit, facid, receptorDF, grab=None, altmaxdist=False):
+    """Restrict `receptorDF` to those within `MAXDIST` of `facid`."""
+    maxdist = receptor_maxdist(geounit, altmaxdist=altmaxdist)
+    center_firm_utm = load_stacks(facid)[UTM].mean()
+    receptorDF = center_data(receptorDF, center_firm_utm, maxdist, grab=grab)
+    receptorDF = receptorDF[UTM].drop_duplicates()
+    return receptorDF
+
+
+def stack_receptors(receptorDF, stack, radius):
+    """Restrict `receptorDF` to those within `radius` km of `stack`."""
+    receptorDF = center_data(receptorDF, stack[UTM], radius)
+    return receptorDF[UTM].drop_duplicates()
+
+
+def unit_run_receptors(geounit, facid, receptorDF, sourceDF,
+                       altmaxdist=False):
+    """
+    Receptors for each of `sourceDF`'s unit-emission runs (see
+    `atmods.aermod.unit_stack_sources`), centered on the stack with the
+    radius `chunktools.plan_unique_sources` uses, so other firms' runs of
+    the same stack are cache hits.
+    """
+    unit_sources, __ = unit_stack_sources(sourceDF)
+    center_firm_utm = load_stacks(facid)[UTM].mean()
+    radii = unit_receptor_radius(
+        unit_sources[UTM], center_firm_utm,
+        receptor_maxdist(geounit, altmaxdist=altmaxdist))
+    return [stack_receptors(receptorDF, unit_sources.iloc[i], radius)
+            for i, radius in enumerate(radii)]
+
+
+def drive_model(receptorDF, sourceDF, model, quiet=False, pool=None,
+                shards=1, polar=False, cache=None, linear=False,
+                unit_receptors=None):
+    """
+    `pool` is an optional `atmods.aermod.AermodPool` to run Aermod in.
+    `shards` splits receptors across that many concurrent Aermod processes.
+    `polar` runs Aermod on a polar grid and interpolates to the receptors.
+    `cache` is an optional `atmods.cache.AermodCache`; on a hit Aermod isn't
+      run at all.
+    `linear` runs each stack geometry at unit emissions and sums them up
+      weighted by `emit_share` (see `atmods.aermod.run_linear`), on
+      `unit_receptors` if passed.
+    """
 
     # Call model
     if model == 'aermod':
-        rawexposure = Aermod(receptorDF, sourceDF, quiet=quiet).runModel()
-        rawexposure = _format_aermodout(rawexposure)
+        aermod_kwargs = dict(quiet=quiet, pool=pool, cache=cache)
+        if polar:
+            aermod_kwargs['polar'] = True
+        else:
+            aermod_kwargs.update(shards=shards, reducer=_reduce_aermodout)
+
+        if linear:
+            rawexposure = run_linear(receptorDF, sourceDF,
+                                     unit_receptors=unit_receptors,
+                                     **aermod_kwargs)
+        else:
+            rawexposure = Aermod(receptorDF, sourceDF,
+                                 **aermod_kwargs).runModel()
+
+        if polar:
+            rawexposure = _format_aermodout(rawexposure)
     else:
         # Handle kernel info
         kern, bandwidth = parse_kernmodel(model)
@@ -142,8 +311,55 @@ def drive_model(receptorDF, sourceDF, model, quiet=False):
 
     return rawexposure
 
+
+def _reduce_aermodout(postfile_path, receptorDF,
+                      chunksize=POSTFILE_CHUNKSIZE):
+    """
+    Stream Aermod's POSTFILE straight to wide (UTM x quarter) mean exposure,
+    same as `_format_aermodout`, without building the month-level frame.
+
+    Aermod writes all receptors for month 1, then month 2, etc., in
+    `receptorDF` order, so POSTFILE row `i` is receptor `i % N`. Quarterly
+    sums and counts are accumulated by receptor position in (N x 4) float32
+    arrays, one chunk of rows at a time.
+    """
+    receptors = receptorDF[UTM].values
+    N = receptors.shape[0]
+    sums = np.zeros(N * 4, dtype=np.float32)
+    counts = np.zeros(N * 4, dtype=np.float32)
+
+    row = 0
+    for chunk in read_postfile(postfile_path, chunksize=chunksize):
+        rec_pos = np.arange(row, row + chunk.shape[0]) % N
+        # Make sure output is in receptor order (up to Aermod's rounding)
+        for j, utm in enumerate(UTM):
+            if (np.abs(chunk[utm].values - receptors[rec_pos, j]) > 1).any():
+                raise ValueError("Aermod output not in receptor order!")
+        quarter = (chunk['month'].values - 1) // 3
+        flat_idx = rec_pos * 4 + quarter
+        sums += np.bincount(flat_idx, weights=chunk['exposure'].values,
+                            minlength=N * 4)
+        counts += np.bincount(flat_idx, minlength=N * 4)
+        row += chunk.shape[0]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts   # Quarters w/o data are nan
+    collapsed = pd.DataFrame(
+        means.reshape(N, 4),
+        index=pd.MultiIndex.from_arrays(
+            [receptors[:, 0].astype(np.int32),
+             receptors[:, 1].astype(np.int32)], names=UTM),
+        columns=pd.Index(range(1, 4 + 1), name='quarter'))
+    collapsed.sort_index(inplace=True)
+
+    return collapsed
+
+
 def _format_aermodout(rawexposure):
-    """Expect rawexposure to have columns UTM, exposure, month"""
+    """
+    Expect rawexposure to have columns UTM, exposure, month. For Aermod
+    output already in memory; `drive_model` uses `_reduce_aermodout`.
+    """
     df = rawexposure
     # UTM read from aermod as float, change to int
     df[UTM] = df[UTM].astype(np.int32)
@@ -174,4 +390,13 @@ def fake_aermod(sources_receptors):
 if __name__ == '__main__':
     # Get command line args
     args = ModelArgs()
-    run_and_write(**args)
+    try:
+        if args.pop('unique_sources'):
+            run_unique_sources(args['geounit'],
+                               altmaxdist=args['altmaxdist'],
+                               quiet=args['quiet'])
+        else:
+            run_and_write(**args)
+    except RuntimeError as e:
+        print e
+        sys.exit(1)
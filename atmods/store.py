@@ -0,0 +1,211 @@
+"""
+Columnar, memory-mapped store of all firms' normed exposure for one
+(geounit, model).
+
+A store is a folder of `.npy` arrays plus 'meta.json':
+    receptors   (N,) sorted (utm_east, utm_north) records shared by all firms
+    facids      (F,) int64, sorted
+    indptr      (F + 1,) int64, firm `i`'s entries are `indptr[i]:indptr[i+1]`
+    rows        (nnz,) int32 receptor row of each entry
+    values      (nnz, Q) float32, one column per quarter (or kernel model)
+Arrays are opened with `mmap_mode='r'`, so reading a firm only touches its
+own slice. Values are stored as float32, which keeps ~7 significant digits;
+Aermod's output is only good to 5 decimals anyway.
+
+Stores are built from the per-firm pickles by `atmods.migrate_store`. A
+firm re-run since then is read from its (newer) pickle instead (see
+`atmods.io.firm_store`) until the store is rebuilt.
+"""
+from __future__ import division
+
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from util import UTM
+
+STORE_VERSION = 1
+VALUE_DTYPE = np.float32
+ROW_DTYPE = np.int32
+
+
+class ExposureStore(object):
+
+    def __init__(self, store_path):
+        self.path = store_path
+        self._arrays = dict()
+        self._meta = None
+        self._facid_pos = None
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, 'meta.json'))
+
+    def mtime(self):
+        """When the store was built (its 'meta.json' is written last)."""
+        return os.path.getmtime(os.path.join(self.path, 'meta.json'))
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            with open(os.path.join(self.path, 'meta.json')) as f:
+                self._meta = json.load(f)
+        return self._meta
+
+    def array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(
+                os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self._arrays[name]
+
+    @property
+    def facids(self):
+        return self.array('facids')
+
+    @property
+    def receptors(self):
+        return self.array('receptors')
+
+    def __contains__(self, facid):
+        return facid in self._positions()
+
+    def positions(self, facids):
+        """
+        Array of `facids`' positions in the store (in `facids`, and which
+        `indptr` slice is theirs). KeyError if one isn't in the store.
+        """
+        facid_pos = self._positions()
+        return np.array([facid_pos[facid] for facid in facids],
+                        dtype=np.int64)
+
+    def _positions(self):
+        if self._facid_pos is None:
+            self._facid_pos = {facid: pos
+                               for pos, facid in enumerate(self.facids)}
+        return self._facid_pos
+
+    def firm_arrays(self, facid):
+        """Return `facid`'s receptor rows and values, as memmap slices."""
+        pos = self._positions()[facid]
+        indptr = self.array('indptr')
+        start, end = indptr[pos], indptr[pos + 1]
+        return self.array('rows')[start:end], self.array('values')[start:end]
+
+    def receptor_index(self, rows=None):
+        """MultiIndex of receptors (at `rows`, default all)."""
+        receptors = self.receptors if rows is None else self.receptors[rows]
+        return pd.MultiIndex.from_arrays(
+            [receptors[utm] for utm in UTM], names=self.meta['index_names'])
+
+    def columns(self):
+        return pd.Index(self.meta['columns'], name=self.meta['columns_name'])
+
+    def load_firm(self, facid):
+        """`facid`'s exposure as the DataFrame it was written from."""
+        rows, values = self.firm_arrays(facid)
+        return pd.DataFrame(np.array(values), index=self.receptor_index(rows),
+                            columns=self.columns())
+
+
+def write_store(store_path, facids, load_firm):
+    """
+    Build a store at `store_path` from firms `facids`. `load_firm(facid)`
+    returns a firm's exposure DataFrame (index UTM, one column per quarter)
+    or Series; it's called twice per firm (receptors, then values) so only
+    one firm is in memory at a time. The store is built in a temp folder
+    and moved into place when done.
+    """
+    facids = np.sort(np.asarray(facids, dtype=np.int64))
+
+    # Pass 1: shared receptor index, entries per firm
+    receptors = None
+    counts = np.zeros(len(facids), dtype=np.int64)
+    columns = None
+    for i, facid in enumerate(facids):
+        df = _as_frame(load_firm(facid))
+        if columns is None:
+            columns, index_names = df.columns, list(df.index.names)
+            utm_dtype = _receptor_keys(df.index[:0]).dtype[0]
+        keys = _receptor_keys(df.index, dtype=utm_dtype)
+        receptors = (np.unique(keys) if receptors is None
+                     else np.union1d(receptors, keys))
+        counts[i] = len(keys)
+        del df
+    if columns is None:
+        raise ValueError("No firms to store")
+
+    indptr = np.zeros(len(facids) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(counts)
+    nnz, num_cols = indptr[-1], len(columns)
+
+    parent = os.path.dirname(os.path.abspath(store_path))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp_path = tempfile.mkdtemp(dir=parent, suffix='.tmp')
+    try:
+        np.save(os.path.join(tmp_path, 'receptors.npy'), receptors)
+        np.save(os.path.join(tmp_path, 'facids.npy'), facids)
+        np.save(os.path.join(tmp_path, 'indptr.npy'), indptr)
+        rows = np.lib.format.open_memmap(os.path.join(tmp_path, 'rows.npy'),
+                                         mode='w+', dtype=ROW_DTYPE,
+                                         shape=(nnz,))
+        values = np.lib.format.open_memmap(
+            os.path.join(tmp_path, 'values.npy'), mode='w+',
+            dtype=VALUE_DTYPE, shape=(nnz, num_cols))
+
+        # Pass 2: fill in each firm's slice, sorted by receptor row
+        for i, facid in enumerate(facids):
+            df = _as_frame(load_firm(facid))
+            if not df.columns.equals(columns):
+                err_str = "Firm {}'s columns don't match Firm {}'s"
+                raise ValueError(err_str.format(facid, facids[0]))
+            firm_rows = np.searchsorted(
+                receptors, _receptor_keys(df.index, dtype=utm_dtype))
+            order = np.argsort(firm_rows, kind='mergesort')
+            start, end = indptr[i], indptr[i + 1]
+            rows[start:end] = firm_rows[order]
+            values[start:end] = df.values[order]
+            del df
+        rows.flush()
+        values.flush()
+        del rows, values
+
+        meta = {'version': STORE_VERSION,
+                'columns': columns.tolist(),
+                'columns_name': columns.name,
+                'index_names': index_names}
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        if os.path.isdir(store_path):
+            shutil.rmtree(store_path)
+        os.rename(tmp_path, store_path)
+    except:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def _as_frame(df):
+    if isinstance(df, pd.Series):
+        df = df.to_frame()
+    return df
+
+
+def _receptor_keys(index, dtype=None):
+    """
+    Sortable (utm_east, utm_north) records of `index`, as int64 or float64
+    (if UTM isn't whole numbers) unless `dtype` is given.
+    """
+    east = index.get_level_values(UTM[0]).values
+    north = index.get_level_values(UTM[1]).values
+    if dtype is None:
+        is_int = (np.issubdtype(east.dtype, np.integer) and
+                  np.issubdtype(north.dtype, np.integer))
+        dtype = np.int64 if is_int else np.float64
+    keys = np.empty(len(east), dtype=[(UTM[0], dtype), (UTM[1], dtype)])
+    keys[UTM[0]] = east
+    keys[UTM[1]] = north
+    return keys
@@ -0,0 +1,86 @@
+"""
+Micro-benchmark for writing 'aermod.inp': `Aermod.make_inp_file` against the
+old `iterrows` version (kept here as `legacy_make_inp_file`).
+
+Run as `python -m atmods.tests.bench_aermod_inp [num_receptors ...]`.
+"""
+from __future__ import division
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from atmods.aermod import (Aermod, INP_TEMPLATE, RECEPTOR_TEMPLATE,
+                           STACK_TEMPLATE, PATH_FOR_MET, AERMOD_OUTPUT_FILE)
+
+
+def legacy_make_inp_file(model):
+    """`Aermod.make_inp_file` as it was, formatting one row at a time."""
+    inp_variables = model.sourceDF.iloc[0, :].to_dict()
+
+    # Receptors
+    receptor_list = [RECEPTOR_TEMPLATE.format(**row.to_dict())
+                     for idx, row in model.receptorDF.iterrows()]
+    inp_variables['receptors'] = ''.join(receptor_list)
+
+    # Sources
+    source_list = []    # Gather all the strings
+    source_id = 1       # To name the stacks uniquely
+    for idx, sourcerow in model.sourceDF.iterrows():
+        source_list.append(
+            STACK_TEMPLATE.format(id=source_id, **sourcerow.to_dict()))
+        source_id += 1
+    inp_variables['sources'] = ''.join(source_list)
+
+    # Metfiles
+    inp_variables['met_file_path'] = PATH_FOR_MET
+    inp_variables['aermod_output'] = AERMOD_OUTPUT_FILE
+
+    unit_count = len(source_list) * len(receptor_list)
+    return INP_TEMPLATE.format(**inp_variables), unit_count
+
+
+def fake_inputs(num_receptors, num_stacks=5):
+    source = pd.DataFrame(
+        {'facid': 1,
+         'utm_east': 378647,
+         'utm_north': 3782677,
+         'pop1990': 8863164,
+         'metsite_code': 'burk',
+         'metsite_z': 175,
+         'metsite_year': 9,
+         'emit_share': 1. / num_stacks,
+         'stack_ht': 33.528,
+         'stack_diam': 2.4384,
+         'stack_veloc': 12.90829,
+         'stack_temp': 413.3352}, index=range(num_stacks))
+    offsets = np.random.randint(-20000, 20000, size=(num_receptors, 2))
+    receptors = pd.DataFrame(
+        offsets + source[['utm_east', 'utm_north']].values[0],
+        columns=['utm_east', 'utm_north']).astype(np.float64)
+    return receptors, source
+
+
+def bench(num_receptors):
+    receptors, source = fake_inputs(num_receptors)
+    model = Aermod(receptors, source)
+
+    start = time.time()
+    legacy = legacy_make_inp_file(model)
+    legacy_sec = time.time() - start
+
+    start = time.time()
+    new = model.make_inp_file()
+    new_sec = time.time() - start
+
+    assert legacy == new
+    print "{:>9,} receptors: iterrows {:8.3f}s, bulk {:8.3f}s ({:.0f}x)".format(
+        num_receptors, legacy_sec, new_sec, legacy_sec / new_sec)
+
+
+if __name__ == '__main__':
+    sizes = [int(x) for x in sys.argv[1:]] or [1000, 10000, 100000]
+    for num_receptors in sizes:
+        bench(num_receptors)
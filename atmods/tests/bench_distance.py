@@ -0,0 +1,61 @@
+"""
+Micro-benchmark for neighbor queries: `util.distance.SpatialIndex` against
+the dense `getdist` matrix, for the queries its callers make (nearest
+target, targets within a radius, count within a radius). Checks that both
+give the same answers.
+
+Run as `python -m atmods.tests.bench_distance [num_base ...]`.
+"""
+from __future__ import division
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from util import UTM
+from util.distance import getdist, SpatialIndex
+
+NUM_TARGETS = 200
+RADIUS_KM = 3.
+
+
+def fake_points(num_points, name):
+    utm = np.random.randint(0, 40000, size=(num_points, 2)) + [370000, 3730000]
+    df = pd.DataFrame(utm, columns=UTM)
+    df.index.name = name
+    return df
+
+
+def bench(num_base):
+    base = fake_points(num_base, 'base_id')
+    target = fake_points(NUM_TARGETS, 'facid')
+
+    start = time.time()
+    dist = getdist(base, target)
+    nearest_dense = dist.min(axis=1).values
+    close_dense = (dist <= RADIUS_KM).values
+    dense_sec = time.time() - start
+
+    start = time.time()
+    index = SpatialIndex(target)
+    nearest, __ = index.nearest(base)
+    base_pos, target_pos, __ = index.within(base, RADIUS_KM)
+    counts = SpatialIndex(base).count_within(target, RADIUS_KM)
+    tree_sec = time.time() - start
+
+    np.testing.assert_allclose(nearest, nearest_dense)
+    close = np.zeros_like(close_dense)
+    close[base_pos, target_pos] = True
+    assert (close == close_dense).all()
+    np.testing.assert_array_equal(counts, close_dense.sum(axis=0))
+    print ("{:>9,} x {} points: getdist {:8.3f}s, KD-tree {:8.3f}s "
+           "({:.0f}x)").format(num_base, NUM_TARGETS, dense_sec, tree_sec,
+                               dense_sec / tree_sec)
+
+
+if __name__ == '__main__':
+    sizes = [int(x) for x in sys.argv[1:]] or [1000, 10000, 100000]
+    for num_base in sizes:
+        bench(num_base)
@@ -0,0 +1,101 @@
+"""
+Micro-benchmark for scaling one firm's normed exposure by its emissions
+(`load_firm_exposure`'s hot path), for each kind of model: the broadcast
+versions in `atmods.io` against the old `pd.Panel`/`stack` versions (kept
+here as `legacy_*`, skipped if this pandas has no `Panel`).
+
+Run as `python -m atmods.tests.bench_io [num_receptors ...]`.
+"""
+from __future__ import division
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+
+from atmods.io import (_firms_aermod_exp, _firms_aermod_not_nox_exp,
+                       _firms_kernel_exp, _cross_df, exposure_df_column_idx)
+
+YEARS = range(1995, 2005 + 1)
+
+
+def legacy_firms_aermod_exp(normed_exp, firms_noxgs, model):
+    """`_firms_aermod_exp` as it was, via `pd.Panel`."""
+    columns = exposure_df_column_idx(firms_noxgs.index, model)
+    pn = pd.Panel(np.zeros((4, len(normed_exp), len(columns))),
+                  items=range(1, 4 + 1),
+                  major_axis=normed_exp.index,
+                  minor_axis=columns)
+    pn.items.name = 'quarter'
+    for q in xrange(1, 4+1):
+        pn[q].update(_cross_df(normed_exp[q], firms_noxgs[q], columns))
+
+    actual_exp = pn.transpose(2, 1, 0).to_frame()
+    actual_exp = np.around(actual_exp * 1e5) / 1e5
+    return actual_exp
+
+
+def legacy_firms_kernel_exp(normed_exp, firms_noxgs, model):
+    """`_firms_kernel_exp` as it was, via `stack`."""
+    long_noxgs = firms_noxgs.stack('quarter', dropna=False)
+    wide_scaled = _cross_df(normed_exp, long_noxgs, long_noxgs.index)
+    actual_exp = wide_scaled.stack('quarter').sort_index(axis=1)
+    actual_exp.columns = exposure_df_column_idx(actual_exp.columns, model)
+    actual_exp *= 1e7
+    return actual_exp
+
+
+def fake_inputs(num_receptors):
+    utm = np.random.randint(0, 10 ** 6, size=(num_receptors, 2)) * 100
+    utm_idx = pd.MultiIndex.from_arrays([utm[:, 0], utm[:, 1]],
+                                        names=['utm_east', 'utm_north'])
+    quarters = pd.Index(range(1, 4 + 1), name='quarter')
+    normed_exp = pd.DataFrame(np.random.rand(num_receptors, 4) / 100,
+                              index=utm_idx, columns=quarters).sort_index()
+    years = pd.Index(YEARS, name='year')
+    noxgs = pd.DataFrame(np.random.rand(len(years), 4), index=years,
+                         columns=quarters)
+    noxgs.iloc[0, :] = np.nan   # Missing year
+    kernel_exp = normed_exp[1]
+    toxic_gs = noxgs[1]
+    return normed_exp, noxgs, kernel_exp, toxic_gs
+
+
+def _time(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def bench(num_receptors):
+    normed_exp, noxgs, kernel_exp, toxic_gs = fake_inputs(num_receptors)
+    has_panel = hasattr(pd, 'Panel')
+    cases = (
+        ('aermod_nox', _firms_aermod_exp, legacy_firms_aermod_exp,
+         normed_exp, noxgs),
+        ('aermod_benz', _firms_aermod_not_nox_exp, None, normed_exp,
+         toxic_gs),
+        ('tria5', _firms_kernel_exp, legacy_firms_kernel_exp, kernel_exp,
+         noxgs),
+    )
+    for model, func, legacy_func, normed, emit in cases:
+        new, new_sec = _time(func, normed, emit, model)
+        if legacy_func is None or (legacy_func is legacy_firms_aermod_exp and
+                                   not has_panel):
+            print "{:>9,} receptors, {:<11}: {:8.3f}s".format(
+                num_receptors, model, new_sec)
+            continue
+        legacy, legacy_sec = _time(legacy_func, normed, emit, model)
+        # `load_firm_exposure` fills missing with 0 after scaling
+        assert_frame_equal(legacy.fillna(0), new.fillna(0))
+        print ("{:>9,} receptors, {:<11}: legacy {:8.3f}s, broadcast {:8.3f}s "
+               "({:.0f}x)").format(num_receptors, model, legacy_sec, new_sec,
+                                   legacy_sec / new_sec)
+
+
+if __name__ == '__main__':
+    sizes = [int(x) for x in sys.argv[1:]] or [1000, 10000, 100000]
+    for num_receptors in sizes:
+        bench(num_receptors)
@@ -1,10 +1,19 @@
+import os
+import shutil
+import tempfile
+
 import nose
+from nose.tools import assert_raises
 from pandas.util.testing import assert_frame_equal
 
 import numpy as np
 import pandas as pd
 
-from atmods.aermod import Aermod
+from atmods.aermod import (Aermod, AermodPool, shard_receptors,
+                           read_postfile, polar_bilinear, run_linear,
+                           unit_stack_sources, combine_unit_runs)
+from atmods.env import BIN_NAME
+from atmods.tests.bench_aermod_inp import legacy_make_inp_file
 
 
 class TestAermod(object):
@@ -87,7 +96,7 @@ class TestAermod(object):
             ],
             columns=cols
         )
-        return df1, df2
+        return _postfile_dtypes(df1), _postfile_dtypes(df2)
 
     def teardown(self):
         pass
@@ -116,6 +125,190 @@ class TestAermod(object):
         expected = self.expected_single
         assert_frame_equal(expected, result)
 
+    def test_pool_reuse(self):
+        expected = self.expected_single
+        with AermodPool(2) as pool:
+            results = pool.run_many([(self.receptor, self.source)] * 3,
+                                    quiet=True)
+        for result in results:
+            assert_frame_equal(expected, result)
+
+    def test_sharded(self):
+        expected = self.expected_double
+        result = Aermod(self.receptors_2, self.source, quiet=True,
+                        shards=2).runModel()
+        assert_frame_equal(expected, result)
+
+    def test_failed_run_raises(self):
+        inst_path = tempfile.mkdtemp()
+        try:
+            binary = os.path.join(inst_path, BIN_NAME)
+            with open(binary, 'w') as f:
+                f.write('#!/bin/sh\nexit 3\n')
+            os.chmod(binary, 0755)
+            model = Aermod(self.receptor, self.source, quiet=True)
+            model.instance_path = inst_path
+            assert_raises(RuntimeError, model.call_aermod)
+        finally:
+            shutil.rmtree(inst_path)
+
+    def test_shard_receptors_cover(self):
+        receptors = pd.DataFrame(np.random.randint(-500, 500, size=(50, 2)),
+                                 columns=['utm_east', 'utm_north'])
+        receptors += self.source[['utm_east', 'utm_north']].values
+        shards = shard_receptors(receptors, self.source, 4)
+        assert len(shards) == 4
+        np.testing.assert_array_equal(np.sort(np.concatenate(shards)),
+                                      np.arange(50))
+
+    def test_inp_file_matches_legacy(self):
+        many_sources = pd.concat([self.source] * 3)
+        model = Aermod(self.receptors_2, many_sources)
+        expected = legacy_make_inp_file(model)
+        result = model.make_inp_file()
+        assert expected == result
+
+
+class TestPostfile(object):
+
+    def setUp(self):
+        self.raw = (
+            "  379647.00  3783677.00      16.43396     22.00     22.00"
+            "      0.00  MONTH    ALL      09013124\n"
+            "  377647.00  3781677.00       8.47337     22.00     22.00"
+            "      0.00  MONTH    ALL      09013124\n"
+            "  379647.00  3783677.00      21.45677     22.00     22.00"
+            "      0.00  MONTH    ALL      09022824\n"
+            "  377647.00  3781677.00       4.99748     22.00     22.00"
+            "      0.00  MONTH    ALL      09123124\n"
+        )
+        self.expected = _postfile_dtypes(pd.DataFrame(
+            [[379647, 3783677, 16.43396, 1],
+             [377647, 3781677, 8.47337, 1],
+             [379647, 3783677, 21.45677, 2],
+             [377647, 3781677, 4.99748, 12]],
+            columns=['utm_east', 'utm_north', 'exposure', 'month']))
+        fd, self.filepath = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.raw)
+
+    def tearDown(self):
+        os.remove(self.filepath)
+
+    def test_read(self):
+        result = read_postfile(self.filepath)
+        assert_frame_equal(self.expected, result)
+
+    def test_read_chunked(self):
+        result = pd.concat(read_postfile(self.filepath, chunksize=3),
+                           ignore_index=True)
+        assert_frame_equal(self.expected, result)
+
+
+class TestPolarBilinear(object):
+
+    def setUp(self):
+        self.radii = np.array([100., 200., 400., 800.])
+        self.deg_step = 10
+        num_dirs = 36
+        spokes = np.radians(self.deg_step * np.arange(1, num_dirs + 1))
+        self.grid_dx = np.outer(self.radii, np.sin(spokes))
+        self.grid_dy = np.outer(self.radii, np.cos(spokes))
+
+    def test_nodes_exact(self):
+        grid = np.random.rand(len(self.radii), 36, 2)
+        result = polar_bilinear(grid, self.radii, self.deg_step,
+                                self.deg_step, self.grid_dx.ravel(),
+                                self.grid_dy.ravel())
+        np.testing.assert_allclose(grid.reshape(-1, 2), result)
+
+    def test_linear_in_radius(self):
+        grid = np.repeat(self.radii[:, None], 36, axis=1)
+        dx = np.array([0, 150, -300, 600, 10, 900])
+        dy = np.array([120, 0, 250, -50, 10, 0])
+        expected = np.clip(np.sqrt(dx ** 2 + dy ** 2), 100, 800)
+        result = polar_bilinear(grid, self.radii, self.deg_step,
+                                self.deg_step, dx, dy)
+        np.testing.assert_allclose(expected, result)
+
+    def test_polar_inp(self):
+        source = pd.DataFrame(
+            {'facid': 1, 'utm_east': 378647, 'utm_north': 3782677,
+             'pop1990': 8863164, 'metsite_code': 'burk', 'metsite_z': 175,
+             'metsite_year': 9, 'emit_share': 1., 'stack_ht': 33.528,
+             'stack_diam': 2.4384, 'stack_veloc': 12.90829,
+             'stack_temp': 413.3352}, index=[1])
+        receptor = pd.DataFrame([[378647 + 500, 3782677]],
+                                columns=['utm_east', 'utm_north'])
+        model = Aermod(receptor, source, polar=True, polar_radii=self.radii,
+                       polar_step=self.deg_step)
+        inp, unit_count = model.make_inp_file()
+        assert unit_count == len(self.radii) * 36
+        assert 'DISCCART' not in inp
+        assert 'GDIR 36 10 10' in inp
+
+
+class TestLinear(object):
+
+    def setUp(self):
+        source = pd.DataFrame(
+            {'facid': 1, 'utm_east': 378647, 'utm_north': 3782677,
+             'pop1990': 8863164, 'metsite_code': 'burk', 'metsite_z': 175,
+             'metsite_year': 9, 'emit_share': .2, 'stack_ht': 33.528,
+             'stack_diam': 2.4384, 'stack_veloc': 12.90829,
+             'stack_temp': 413.3352}, index=[1])
+        self.sources = pd.concat([source] * 3, ignore_index=True)
+        self.sources['emit_share'] = [.2, .3, .5]
+        self.sources.loc[1, 'stack_ht'] = 50.
+
+    def test_unit_sources(self):
+        unit_sources, weights = unit_stack_sources(self.sources)
+        np.testing.assert_allclose(weights, [.7, .3])
+        np.testing.assert_array_equal(unit_sources['stack_ht'],
+                                      [33.528, 50.])
+        assert (unit_sources['emit_share'] == 1).all()
+
+    def test_unit_receptors(self):
+        receptors = pd.DataFrame(
+            np.random.randint(-2000, 2000, size=(20, 2)) + [378647, 3782677],
+            columns=['utm_east', 'utm_north']).drop_duplicates()
+        expected = run_linear(receptors, self.sources, quiet=True,
+                              reducer=_mean_reducer)
+        wider = receptors.append(receptors.iloc[:5] + 3000)
+        result = run_linear(receptors, self.sources, quiet=True,
+                            reducer=_mean_reducer,
+                            unit_receptors=[wider, wider.iloc[::-1]])
+        assert_frame_equal(expected, result)
+
+    def test_combine_long(self):
+        unit = pd.DataFrame({'utm_east': [1, 2], 'utm_north': [3, 4],
+                             'exposure': [1., 10.], 'month': [1, 1]},
+                            columns=['utm_east', 'utm_north', 'exposure',
+                                     'month'])
+        other = unit.copy()
+        other['exposure'] = [2., 20.]
+        expected = unit.copy()
+        expected['exposure'] = [1.8, 18.]
+        result = combine_unit_runs([unit, other], [.2, .8])
+        assert_frame_equal(expected, result)
+
+    def test_combine_wide(self):
+        unit = pd.DataFrame(np.ones((3, 4)), columns=range(1, 5))
+        expected = unit * 2.5
+        result = combine_unit_runs([unit, unit * 2], [.5, 1.])
+        assert_frame_equal(expected, result)
+
+
+def _mean_reducer(postfile_path, receptorDF):
+    postfile = read_postfile(postfile_path)
+    by_month = postfile.groupby(['utm_east', 'utm_north', 'month'])
+    return by_month['exposure'].mean().unstack('month')
+
+
+def _postfile_dtypes(df):
+    return df.astype({'utm_east': np.int32, 'utm_north': np.int32,
+                      'exposure': np.float32, 'month': np.int8})
+
 
 if __name__ == '__main__':
     nose.runmodule(argv=[__file__, '-v'], exit=False)
@@ -0,0 +1,221 @@
+import os
+import re
+import glob
+import shutil
+import stat
+import tempfile
+
+import nose
+from nose.tools import assert_equal
+
+import numpy as np
+import pandas as pd
+
+import atmods.batchrun as batchrun
+import atmods.check_jobs as check_jobs
+import atmods.run_and_write as run_and_write
+from atmods.executors import FirmChunk
+from atmods.chunktools import SOURCE_CONFIG
+
+FAKE_SBATCH = (
+    '#!/bin/sh\n'
+    '{{ echo "# sbatch $*"; cat; }} > "$(mktemp {folder}/submitted.XXXXXX)"\n'
+    'echo "Submitted batch job 1"\n'
+)
+
+
+def _firm_chunk(facid, chunk_id, num_chunks, cpu_per_stack, shards=1):
+    resources = pd.Series({'num_shards': float(shards),
+                           'cpu_per_stack': cpu_per_stack,
+                           'time_buffer': np.nan, 'mem': 1200.})
+    jobname = 'hA{}c{}{}'.format(facid, chunk_id, num_chunks)
+    return FirmChunk(jobname, facid, (chunk_id, num_chunks), resources)
+
+
+class TestJobArray(object):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        fake_sbatch = os.path.join(self.root, 'sbatch')
+        with open(fake_sbatch, 'w') as f:
+            f.write(FAKE_SBATCH.format(folder=self.root))
+        os.chmod(fake_sbatch, stat.S_IRWXU)
+
+        self.saved = (batchrun.SBATCH_COMMAND, batchrun.MANIFEST_PATH,
+                      batchrun._save_sbatch_script, batchrun.sleep)
+        batchrun.SBATCH_COMMAND = fake_sbatch
+        batchrun.MANIFEST_PATH = os.path.join(self.root, 'manifests')
+        batchrun._save_sbatch_script = lambda script: None
+        batchrun.sleep = lambda sec: None
+
+        self.firm_chunks = [_firm_chunk(10, 1, 2, 50.),
+                            _firm_chunk(10, 2, 2, 50.),
+                            _firm_chunk(11, 1, 1, 5.),
+                            _firm_chunk(12, 1, 1, 50., shards=2)]
+
+    def tearDown(self):
+        (batchrun.SBATCH_COMMAND, batchrun.MANIFEST_PATH,
+         batchrun._save_sbatch_script, batchrun.sleep) = self.saved
+        shutil.rmtree(self.root)
+
+    def _submitted(self):
+        scripts = []
+        for filepath in glob.glob(os.path.join(self.root, 'submitted.*')):
+            with open(filepath) as f:
+                scripts.append(f.read())
+        return scripts
+
+    def test_arrays_by_class(self):
+        batchrun.SlurmExecutor(pack_minutes=0).run('house', self.firm_chunks,
+                                                   bypass_confirm=True)
+        scripts = self._submitted()
+        # Short firm 11 and 2-core firm 12 each get their own array
+        assert_equal(len(scripts), 3)
+        num_tasks = sorted(
+            int(re.search(r'--array=0-(\d+)', s).group(1)) + 1
+            for s in scripts)
+        assert_equal(num_tasks, [1, 1, 2])
+
+    def test_log_per_submission(self):
+        batchrun.SlurmExecutor(pack_minutes=0).run(
+            'house', self.firm_chunks[:2], bypass_confirm=True)
+        script, = self._submitted()
+        # Slurm fills in the array's job id, so resubmitting doesn't reuse
+        # the log names
+        log = re.search(r'--output (\S+)', script).group(1)
+        assert log.endswith('_%A_%a.out')
+
+    def _dispatch(self, manifest_path, task_id):
+        calls = []
+        saved = run_and_write.run_and_write, run_and_write.load_receptors
+        run_and_write.run_and_write = lambda *args, **kwargs: calls.append(
+            (args, kwargs))
+        run_and_write.load_receptors = lambda geounit: geounit + ' receptors'
+        os.environ['SLURM_ARRAY_TASK_ID'] = str(task_id)
+        try:
+            run_and_write.dispatch(manifest_path)
+        finally:
+            run_and_write.run_and_write, run_and_write.load_receptors = saved
+            del os.environ['SLURM_ARRAY_TASK_ID']
+        return calls
+
+    def test_manifest_dispatch(self):
+        batchrun.SlurmExecutor(pack_minutes=0).run(
+            'house', self.firm_chunks[:2], bypass_confirm=True)
+        script, = self._submitted()
+        manifest_path = re.search(r"dispatch\('([^']+)'", script).group(1)
+        manifest = pd.read_csv(manifest_path, index_col='task_id')
+        assert_equal(manifest['jobname'].tolist(), ['hA10c12', 'hA10c22'])
+
+        (args, kwargs), = self._dispatch(manifest_path, 1)
+        assert_equal(args, ('house', 'aermod', 10))
+        assert_equal(kwargs['chunk_info'], (2, 2))
+        assert_equal(kwargs['shards'], 1)
+
+    def test_pack(self):
+        packs = batchrun.pack_firm_chunks(self.firm_chunks, pack_minutes=60)
+        packed = [[fc.jobname for fc in pack] for pack in packs]
+        # 2-core firm 12 isn't packed; 5 minute firm 11 fits with a 50
+        assert_equal(packed, [['hA12c11'], ['hA10c12', 'hA11c11'],
+                              ['hA10c22']])
+
+    def test_packed_dispatch(self):
+        batchrun.SlurmExecutor(pack_minutes=120).run(
+            'house', self.firm_chunks[:3], bypass_confirm=True)
+        script, = self._submitted()
+        assert '--array=0-0' in script
+        manifest_path = re.search(r"dispatch\('([^']+)'", script).group(1)
+
+        calls = self._dispatch(manifest_path, 0)
+        assert_equal([kwargs['chunk_info'] for __, kwargs in calls],
+                     [(1, 2), (2, 2), (1, 1)])
+        # Receptors loaded once, shared
+        assert_equal(set(kwargs['receptorDF'] for __, kwargs in calls),
+                     set(['house receptors']))
+
+    def test_queued_array_not_resubmitted(self):
+        batchrun.SlurmExecutor(pack_minutes=0).run(
+            'house', self.firm_chunks[:2], bypass_confirm=True)
+        script, = self._submitted()
+        manifest_path = re.search(r'--comment (\S+)', script).group(1)
+        arrayname = re.search(r'--job-name (\S+)', script).group(1)
+        # Task 0 finished, task 1 still queued
+        squeue_lines = ['{}|1|{}'.format(arrayname, manifest_path),
+                        'hA13c11|N/A|(null)']
+        in_queue = check_jobs.queued_jobnames(squeue_lines)
+        assert_equal(in_queue, set([arrayname, 'hA10c22', 'hA13c11']))
+
+        saved = (check_jobs.hostname, check_jobs.calc_resources,
+                 check_jobs.check_storage, check_jobs.get_squeue_names)
+        check_jobs.hostname = 'harvard'
+        check_jobs.calc_resources = lambda *args, **kwargs: None
+        check_jobs.check_storage = lambda *args, **kwargs: (
+            'hA10c12', 'hA10c22', 'hA11c11')
+        check_jobs.get_squeue_names = lambda: in_queue
+        try:
+            to_run = check_jobs.jobs_to_run('house', 'aermod', units=True)
+        finally:
+            (check_jobs.hostname, check_jobs.calc_resources,
+             check_jobs.check_storage, check_jobs.get_squeue_names) = saved
+        assert_equal(to_run, ('hA10c12', 'hA11c11'))
+
+    def test_linear_unique_sources_first(self):
+        stack = {'utm_east': 378647, 'utm_north': 3782677,
+                 'stack_ht': 33.528, 'stack_diam': 2.4384,
+                 'stack_veloc': 12.90829, 'stack_temp': 413.3352,
+                 'metsite_code': 'burk', 'metsite_year': 9, 'metsite_z': 175,
+                 'pop1990': 8863164}
+        configs = pd.DataFrame([stack] * 2)
+        configs.loc[1, 'stack_ht'] = 50.1
+        configs['receptor_km'] = [21., 22.]
+        configs['cpu_per_stack'] = [50., 100.]
+        saved = batchrun.plan_unique_sources, batchrun.dedup_report
+        batchrun.plan_unique_sources = lambda *args, **kwargs: (configs,
+                                                                None)
+        batchrun.dedup_report = lambda *args: None
+        try:
+            batchrun.SlurmExecutor(pack_minutes=120).run(
+                'house', self.firm_chunks[:2], bypass_confirm=True,
+                linear=True)
+        finally:
+            batchrun.plan_unique_sources, batchrun.dedup_report = saved
+
+        unique, = [s for s in self._submitted()
+                   if 'dispatch_unique_sources' in s]
+        firms, = [s for s in self._submitted() if s != unique]
+        # Firm-chunks wait on the unique stacks' array
+        assert 'dependency' not in unique.splitlines()[0]
+        assert '--dependency=afterany:1' in firms.splitlines()[0]
+        # 100 + 50 minutes is more than a task
+        assert '--array=0-1' in unique
+
+        manifest_path = re.search(r"dispatch\('([^']+)'", firms).group(1)
+        assert all(kwargs['linear']
+                   for __, kwargs in self._dispatch(manifest_path, 0))
+
+        manifest_path = re.search(r"dispatch_unique_sources\('([^']+)'",
+                                  unique).group(1)
+        calls = []
+        saved = run_and_write.run_source_configs
+        run_and_write.run_source_configs = lambda *args, **kwargs: (
+            calls.append(args))
+        try:
+            run_and_write.dispatch_unique_sources(manifest_path, task_id=1)
+        finally:
+            run_and_write.run_source_configs = saved
+        (geounit, task_configs), = calls
+        assert_equal(geounit, 'house')
+        # Longest first, so the 50 minute config is task 1
+        assert_equal(task_configs[SOURCE_CONFIG + ['receptor_km']].values
+                     .tolist(),
+                     configs.loc[[0], SOURCE_CONFIG + ['receptor_km']].values
+                     .tolist())
+
+    def test_no_array(self):
+        batchrun.SlurmExecutor(array=False).run('house', self.firm_chunks,
+                                                bypass_confirm=True)
+        assert_equal(len(self._submitted()), 4)
+
+
+if __name__ == '__main__':
+    nose.runmodule(argv=[__file__, '-v'], exit=False)
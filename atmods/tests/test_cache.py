@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+
+import nose
+from nose.tools import assert_equal
+from pandas.util.testing import assert_frame_equal
+
+import numpy as np
+import pandas as pd
+
+from atmods.aermod import Aermod
+from atmods.cache import AermodCache, EVICT_MARKER
+
+
+class TestAermodCache(object):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = AermodCache(root=self.root)
+        self.source = pd.DataFrame(
+            {'facid': 1, 'utm_east': 378647, 'utm_north': 3782677,
+             'pop1990': 8863164, 'metsite_code': 'burk', 'metsite_z': 175,
+             'metsite_year': 9, 'emit_share': .5, 'stack_ht': 33.528,
+             'stack_diam': 2.4384, 'stack_veloc': 12.90829,
+             'stack_temp': 413.3352}, index=[1])
+        self.receptors = pd.DataFrame([[379647., 3783677.]],
+                                      columns=['utm_east', 'utm_north'])
+        self.output = pd.DataFrame(np.random.rand(10, 2), columns=['a', 'b'])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_key_same_inputs(self):
+        key1 = self.cache.key(Aermod(self.receptors, self.source))
+        key2 = self.cache.key(Aermod(self.receptors.copy(), self.source))
+        assert_equal(key1, key2)
+
+    def test_key_new_stack_params(self):
+        key1 = self.cache.key(Aermod(self.receptors, self.source))
+        taller = self.source.copy()
+        taller['stack_ht'] += 1
+        key2 = self.cache.key(Aermod(self.receptors, taller))
+        assert key1 != key2
+
+    def test_key_reducer(self):
+        key1 = self.cache.key(Aermod(self.receptors, self.source))
+        key2 = self.cache.key(Aermod(self.receptors, self.source,
+                                     reducer=_dummy_reducer))
+        assert key1 != key2
+
+    def test_key_ignores_facid(self):
+        key1 = self.cache.key(Aermod(self.receptors, self.source))
+        other_firm = self.source.copy()
+        other_firm['facid'] = 2
+        key2 = self.cache.key(Aermod(self.receptors, other_firm))
+        assert_equal(key1, key2)
+
+    def test_put_get(self):
+        self.cache.put('abc123', self.output)
+        assert_frame_equal(self.output, self.cache.get('abc123'))
+
+    def test_miss(self):
+        assert self.cache.get('notthere') is None
+
+    def test_evict_lru(self):
+        self.cache.put('aa1', self.output)
+        self.cache.put('bb2', self.output)
+        # Make 'aa1' oldest, then shrink cache to fit one entry
+        os.utime(self.cache.path('aa1'), (1, 1))
+        self.cache.max_bytes = os.path.getsize(self.cache.path('bb2'))
+        self.cache.evict()
+        assert self.cache.get('aa1') is None
+        assert self.cache.get('bb2') is not None
+
+    def test_put_evicts_when_due(self):
+        self.cache.max_bytes = 0
+        # No eviction yet, so the first put evicts
+        self.cache.put('aa1', self.output)
+        assert self.cache.get('aa1') is None
+        # Evicted just now, so skip
+        self.cache.put('bb2', self.output)
+        assert self.cache.get('bb2') is not None
+        os.utime(os.path.join(self.root, EVICT_MARKER), (1, 1))
+        self.cache.put('cc3', self.output)
+        assert self.cache.get('bb2') is None
+        assert self.cache.get('cc3') is None
+
+
+def _dummy_reducer(postfile_path, receptorDF):
+    pass
+
+
+if __name__ == '__main__':
+    nose.runmodule(argv=[__file__, '-v'], exit=False)
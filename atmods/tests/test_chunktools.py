@@ -0,0 +1,97 @@
+import nose
+from nose.tools import assert_equal
+
+import numpy as np
+import pandas as pd
+
+import atmods.chunktools as chunktools
+from atmods.chunktools import (group_source_configs, unit_receptor_radius,
+                               stack_chunk_ids, UNIT_RECEPTOR_STEP)
+
+
+class TestGroupSourceConfigs(object):
+
+    def setUp(self):
+        stack = {'utm_east': 378647, 'utm_north': 3782677,
+                 'stack_ht': 33.528, 'stack_diam': 2.4384,
+                 'stack_veloc': 12.90829, 'stack_temp': 413.3352,
+                 'metsite_code': 'burk', 'metsite_year': 9, 'metsite_z': 175,
+                 'pop1990': 8863164}
+        # Firms 1 and 2 share the first stack but their other stacks put
+        # their centers 300 m apart
+        stacks = pd.DataFrame([stack] * 4)
+        stacks['facid'] = [1, 1, 2, 2]
+        stacks.loc[1, 'utm_east'] += 400
+        stacks.loc[3, 'utm_east'] -= 200
+        stacks.loc[3, 'stack_ht'] = 50.
+        self.stacks = stacks
+        self.maxdist = 20
+
+    def test_shared_stack_across_centers(self):
+        grouped = group_source_configs(self.stacks, self.maxdist)
+        assert_equal(grouped.loc[0, 'config_id'],
+                     grouped.loc[2, 'config_id'])
+        assert_equal(grouped['config_id'].nunique(), 3)
+        assert_equal(grouped.loc[0, 'receptor_km'],
+                     self.maxdist + UNIT_RECEPTOR_STEP)
+
+    def test_far_center_not_shared(self):
+        stacks = self.stacks
+        stacks.loc[3, 'utm_east'] -= 4000
+        grouped = group_source_configs(stacks, self.maxdist)
+        assert grouped.loc[0, 'config_id'] != grouped.loc[2, 'config_id']
+
+    def test_radius_covers_firm(self):
+        stack_utm = np.random.randint(0, 5000, size=(50, 2))
+        center_utm = np.array([[2500, 2500]])
+        stacks = pd.DataFrame(stack_utm, columns=['utm_east', 'utm_north'])
+        center = pd.DataFrame(center_utm, columns=['utm_east', 'utm_north'])
+        radius = unit_receptor_radius(stacks, center, self.maxdist)
+        offset = np.sqrt(((stack_utm - center_utm) ** 2).sum(axis=1)) / 1000
+        assert (radius > self.maxdist + offset).all()
+        assert (radius <= self.maxdist + offset + UNIT_RECEPTOR_STEP).all()
+
+
+class _FakeIdxwalk(object):
+
+    def get_firmid(self, facid, group_rep=True):
+        return facid
+
+
+class TestCalcResources(object):
+
+    def setUp(self):
+        # Firm 1 has 100 stacks, firm 2 one
+        stacks = pd.DataFrame({'facid': [1] * 100 + [2], 'stack_ht': 30.,
+                               'metsite_code': 'burk'})
+        model = pd.Series({'intercept': .01, 'stack_ht': 0.,
+                           'receptors_k': 0., 'stacks': .001, 'buffer': 1.2})
+        self.saved = (chunktools.load_stacks, chunktools.FirmIDXwalk,
+                      chunktools.load_cost_model)
+        chunktools.load_stacks = lambda: stacks
+        chunktools.FirmIDXwalk = _FakeIdxwalk
+        chunktools.load_cost_model = lambda geounit: model
+        self.units = pd.Series([100000, 1000], index=[1, 2])
+
+    def tearDown(self):
+        (chunktools.load_stacks, chunktools.FirmIDXwalk,
+         chunktools.load_cost_model) = self.saved
+
+    def test_predict_at_chunk_stacks(self):
+        df = chunktools.calc_resources(self.units, geounit='house')
+        # At 100 stacks firm 1 would need 88 chunks, so predict at 2 stacks
+        np.testing.assert_allclose(df['sec_per_unit'], [.012, .011])
+        np.testing.assert_allclose(df.loc[1, 'total_cpu'],
+                                   100000 * .012 / 60 * 100)
+        assert_equal(df.loc[1, 'num_chunks'], 10)
+        assert_equal(df.loc[2, 'num_chunks'], 1)
+
+
+class TestStackChunkIds(object):
+
+    def test_even_split(self):
+        np.testing.assert_array_equal(stack_chunk_ids(5, 2), [1, 1, 1, 2, 2])
+
+
+if __name__ == '__main__':
+    nose.runmodule(argv=[__file__, '-v'], exit=False)
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+
+import nose
+from nose.tools import assert_equal, assert_raises
+from pandas.util.testing import assert_frame_equal
+
+import numpy as np
+import pandas as pd
+
+from atmods.dechunker import group_chunk_files, combine_chunks
+
+
+class TestDechunker(object):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        index = pd.MultiIndex.from_tuples([(1, 2), (3, 4), (5, 6)],
+                                          names=['utm_east', 'utm_north'])
+        self.chunks = [pd.DataFrame(np.random.rand(3, 4), index=index)
+                       for __ in range(3)]
+        self.paths = []
+        for chunk_id, df in enumerate(self.chunks, start=1):
+            this_path = os.path.join(self.folder,
+                                     'hA10c{}3.p'.format(chunk_id))
+            df.to_pickle(this_path)
+            self.paths.append(this_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_combine(self):
+        expected = self.chunks[0] + self.chunks[1] + self.chunks[2]
+        result = combine_chunks(self.paths, 10)
+        assert_frame_equal(expected, result)
+
+    def test_combine_mismatch(self):
+        self.chunks[1].iloc[:2].to_pickle(self.paths[1])
+        assert_raises(AssertionError, combine_chunks, self.paths, 10)
+
+    def test_group(self):
+        # Firm 11 is missing a chunk, firm 10 has a stale chunk
+        file_list = self.paths[::-1] + ['x/hA11c12.p', 'x/hA10c12.p']
+        result = group_chunk_files(file_list)
+        assert_equal(result, {10: self.paths})
+
+
+if __name__ == '__main__':
+    nose.runmodule(argv=[__file__, '-v'], exit=False)
@@ -0,0 +1,52 @@
+import shutil
+import tempfile
+from os import path
+
+import nose
+from nose.tools import assert_equal, assert_raises
+
+import numpy as np
+import pandas as pd
+
+from atmods.emitcube import EmissionsCube, write_cube
+
+
+class TestEmissionsCube(object):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.years = range(1995, 1997 + 1)
+        index = pd.MultiIndex.from_tuples(
+            [(20, 1995, 1), (20, 1996, 4), (10, 1995, 2), (10, 1990, 1)],
+            names=['facid', 'year', 'quarter'])
+        self.emit = pd.Series([1., 2., 3., 4.], index=index)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_quarterly(self):
+        cube_path = path.join(self.folder, 'emissions_nox')
+        write_cube(cube_path, self.emit, self.years, quarters=range(1, 5))
+        cube = EmissionsCube(cube_path)
+        assert_equal(cube.facids.tolist(), [10, 20])
+        assert_equal(cube.values.shape, (2, 3, 4))
+        firm = cube.firm(20)
+        assert_equal(firm[0, 0], 1.)
+        assert_equal(firm[1, 3], 2.)
+        # 1990 isn't in `years`, everything else missing
+        assert_equal(np.isnan(cube.firm(10)).sum(), 11)
+        assert 10 in cube
+        assert_raises(KeyError, cube.firm, 30)
+
+    def test_annual(self):
+        cube_path = path.join(self.folder, 'emissions_lead')
+        annual = self.emit.groupby(level=['facid', 'year']).sum()
+        write_cube(cube_path, annual, self.years)
+        cube = EmissionsCube(cube_path)
+        assert_equal(cube.values.shape, (2, 3, 1))
+        assert_equal(cube.quarters, None)
+        np.testing.assert_array_equal(cube.firm(20)[:, 0], [1., 2., np.nan])
+
+
+if __name__ == '__main__':
+    nose.runmodule(argv=[__file__, '-v'], exit=False)
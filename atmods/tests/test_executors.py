@@ -0,0 +1,49 @@
+import nose
+from nose.tools import assert_equal
+
+import pandas as pd
+
+from atmods.executors import LocalExecutor, FirmChunk
+
+
+def _firm_chunk(facid, total_cpu, shards=1, mem=1000):
+    resources = pd.Series({'total_cpu': total_cpu, 'num_chunks': 1.,
+                           'num_shards': float(shards), 'mem': float(mem)})
+    return FirmChunk('hA{}c11'.format(facid), facid, (1, 1), resources)
+
+
+class TestStartable(object):
+
+    def setUp(self):
+        self.executor = LocalExecutor(procs=4, mem_budget=3000)
+
+    def _started(self, pending, running=[]):
+        running = [(fc, None) for fc in running]
+        return [fc.facid
+                for fc in self.executor._startable(pending, running)]
+
+    def test_mem_budget(self):
+        pending = [_firm_chunk(1, 30), _firm_chunk(2, 20),
+                   _firm_chunk(3, 10, mem=2000), _firm_chunk(4, 5)]
+        # Job 3 doesn't fit after 1 and 2, smaller job 4 does
+        assert_equal(self._started(pending), [1, 2, 4])
+
+    def test_procs(self):
+        pending = [_firm_chunk(1, 30, shards=3), _firm_chunk(2, 20, shards=2),
+                   _firm_chunk(3, 10)]
+        assert_equal(self._started(pending), [1, 3])
+
+    def test_running_counts(self):
+        pending = [_firm_chunk(2, 20), _firm_chunk(3, 10)]
+        running = [_firm_chunk(1, 30, mem=2500)]
+        assert_equal(self._started(pending, running), [])
+
+    def test_too_big_runs_alone(self):
+        pending = [_firm_chunk(1, 30, mem=5000), _firm_chunk(2, 20)]
+        assert_equal(self._started(pending), [1])
+        running = [_firm_chunk(2, 20)]
+        assert_equal(self._started(pending[:1], running), [])
+
+
+if __name__ == '__main__':
+    nose.runmodule(argv=[__file__, '-v'], exit=False)
@@ -1,5 +1,9 @@
+import os
+import shutil
+import tempfile
 from os import path
 
+import numpy as np
 import pandas as pd
 
 from nose import runmodule
@@ -7,13 +11,18 @@ from nose.plugins.attrib import attr
 from nose.tools import assert_equal, assert_raises
 from pandas.util.testing import assert_frame_equal
 
+import atmods.io as io
 from util.system import data_path, test_path
+from atmods.store import write_store
 from atmods.io import AIRQ_PATH, LOCAL_CHUNK_PATH
 from atmods.io import (normed_firmexp_path, normed_firmexp_fname,
                        filepath_airqdata, parse_firm_info,
                        load_full_exposure, load_firm_normed_exp,
                        load_firm_exposure, sum_allfirms_exposure,
-                       sum_allfirms_exposure_mp, parse_kernmodel)
+                       sum_allfirms_exposure_mp, parse_kernmodel,
+                       atomic_pickle, record_output, load_output_manifest,
+                       list_outputs, _add_firm_exposure, GridCells,
+                       utm_keys, _bilinear_cells)
 
 
 class TestAirqPath(object):
@@ -161,6 +170,224 @@ def load_data(filename):
     return pd.read_pickle(test_path(filename))
 
 
+class TestOutputManifest(object):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.df = pd.DataFrame(np.arange(6).reshape(3, 2), columns=['a', 'b'])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_record(self):
+        filepath = path.join(self.folder, 'hA10c11.p')
+        atomic_pickle(self.df, filepath)
+        record_output(filepath)
+        entries = load_output_manifest(self.folder)
+        assert_equal(entries.keys(), ['hA10c11.p'])
+        assert_equal(entries['hA10c11.p']['size'], path.getsize(filepath))
+        assert_frame_equal(pd.read_pickle(filepath), self.df)
+
+    def test_list_outputs(self):
+        for name in ('hA10c12.p', 'hA10c22.p'):
+            filepath = path.join(self.folder, name)
+            atomic_pickle(self.df, filepath)
+            if name == 'hA10c12.p':
+                record_output(filepath)
+        assert_equal(list_outputs(self.folder),
+                     set(['hA10c12.p', 'hA10c22.p', '_completed.jsonl']))
+        assert_equal(list_outputs(self.folder, use_manifest=True),
+                     set(['hA10c12.p']))
+        assert_equal(list_outputs(path.join(self.folder, 'nope')), set())
+
+
+class TestFirmStore(object):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = (io.normed_store_path, io.normed_firmexp_path,
+                      io.exposure_matrices_path, io.load_geounit)
+        io.normed_store_path = lambda geounit, model, altmaxdist=False: (
+            path.join(self.folder, 'store'))
+        io.normed_firmexp_path = lambda geounit, model, facid, **kwargs: (
+            path.join(self.folder, '{}.p'.format(facid)))
+        io.exposure_matrices_path = lambda geounit, model: (
+            path.join(self.folder, 'matrices'))
+        io._OPEN_STORES.clear()
+
+        index = pd.MultiIndex.from_tuples([(0, 0), (0, 100)],
+                                          names=['utm_east', 'utm_north'])
+        columns = pd.Index(range(1, 4 + 1), name='quarter')
+        self.stored = pd.DataFrame(np.ones((2, 4)), index=index,
+                                   columns=columns)
+        self.pickled = self.stored * 2
+        write_store(io.normed_store_path('grid', 'aermod'), [10],
+                    lambda facid: self.stored)
+        self.pickle_path = io.normed_firmexp_path('grid', 'aermod', 10)
+        atomic_pickle(self.pickled, self.pickle_path)
+        self.store_mtime = path.getmtime(
+            path.join(io.normed_store_path('grid', 'aermod'), 'meta.json'))
+        receptors = self.stored.reset_index()[['utm_east', 'utm_north']]
+        io.load_geounit = lambda geounit: receptors
+
+    def tearDown(self):
+        (io.normed_store_path, io.normed_firmexp_path,
+         io.exposure_matrices_path, io.load_geounit) = self.saved
+        io._OPEN_STORES.clear()
+        shutil.rmtree(self.folder)
+
+    def _load(self):
+        return load_firm_normed_exp('grid', 'aermod', 10, altmaxdist=False)
+
+    def test_older_pickle_uses_store(self):
+        os.utime(self.pickle_path, (self.store_mtime - 60,) * 2)
+        assert io.firm_store('grid', 'aermod', 10) is not None
+        assert_frame_equal(self._load(), self.stored, check_dtype=False)
+
+    def test_rerun_pickle_wins(self):
+        os.utime(self.pickle_path, (self.store_mtime + 60,) * 2)
+        assert io.firm_store('grid', 'aermod', 10) is None
+        assert_frame_equal(self._load(), self.pickled)
+
+    def test_exposure_matrices(self):
+        os.utime(self.pickle_path, (self.store_mtime - 60,) * 2)
+        utm_idx = self.stored.index
+        facids, matrices = io.firm_exposure_matrices('grid', 'aermod', [10],
+                                                     utm_idx)
+        assert_equal(facids, [10])
+        assert_equal(len(matrices), 4)
+        np.testing.assert_allclose(matrices[0].toarray(), [[1.], [1.]])
+        assert_raises(ValueError, io.firm_exposure_matrices, 'grid',
+                      'aermod', [], utm_idx)
+
+    def test_saved_exposure_matrices(self):
+        os.utime(self.pickle_path, (self.store_mtime - 60,) * 2)
+        # Firm 11 only has a pickle
+        atomic_pickle(self.pickled * 2,
+                      io.normed_firmexp_path('grid', 'aermod', 11))
+        __, facids, matrices = io.load_exposure_matrices('grid', 'aermod',
+                                                         [11, 10])
+        assert_equal(facids, [11, 10])
+        np.testing.assert_allclose(matrices[0].toarray(), [[4., 1.]] * 2)
+
+        read = []
+        saved = io.firm_exposure_matrices
+
+        def spy(geounit, model, firm_list, utm_idx):
+            read.append(list(firm_list))
+            return saved(geounit, model, firm_list, utm_idx)
+
+        io.firm_exposure_matrices = spy
+        try:
+            io.load_exposure_matrices('grid', 'aermod', [10, 11])
+            # Nothing changed, so nothing read
+            assert_equal(read, [])
+            # Re-run firm 10
+            os.utime(self.pickle_path, (self.store_mtime + 60,) * 2)
+            __, __, matrices = io.load_exposure_matrices('grid', 'aermod',
+                                                         [10, 11])
+        finally:
+            io.firm_exposure_matrices = saved
+        assert_equal(read, [[10]])
+        np.testing.assert_allclose(matrices[0].toarray(), [[2., 4.]] * 2)
+
+
+class TestEmissionsCube(object):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = (io.AIRQ_PATH, io.emissions, io.EMISSIONS_SOURCES)
+        self.source = path.join(self.folder, 'pr2_nox.p')
+        io.AIRQ_PATH = self.folder
+        io.EMISSIONS_SOURCES = {'nox': self.source}
+        io.emissions = lambda: self.emit
+        io._OPEN_CUBES.clear()
+        self._set_emissions(1.)
+
+    def tearDown(self):
+        io.AIRQ_PATH, io.emissions, io.EMISSIONS_SOURCES = self.saved
+        io._OPEN_CUBES.clear()
+        shutil.rmtree(self.folder)
+
+    def _set_emissions(self, tons, mtime=None):
+        index = pd.MultiIndex.from_product(
+            [[10], io.PR2_YEARS, range(1, 4 + 1)],
+            names=['facid', 'year', 'quarter'])
+        self.emit = pd.Series(tons, index=index)
+        atomic_pickle(self.emit, self.source)
+        if mtime is not None:
+            os.utime(self.source, (mtime,) * 2)
+
+    def test_rebuild_on_new_source(self):
+        np.testing.assert_allclose(io.emissions_cube('nox').firm(10), 1.)
+        # Unchanged source keeps the cube
+        assert io.emissions_cube('nox') is io.emissions_cube('nox')
+        self._set_emissions(2., mtime=path.getmtime(self.source) + 60)
+        cube = io.emissions_cube('nox')
+        assert_equal(cube.source, io.file_fingerprint(self.source))
+        np.testing.assert_allclose(cube.firm(10), 2.)
+
+
+class TestAddFirmExposure(object):
+
+    def setUp(self):
+        self.idx = pd.MultiIndex.from_tuples(
+            [(0, 0), (0, 100), (100, 0), (100, 100)],
+            names=['utm_east', 'utm_north'])
+        self.col_idx = pd.MultiIndex.from_tuples(
+            [(1997, 'aermod'), (1998, 'aermod')], names=['year', 'model'])
+
+    def test_matches_reindex(self):
+        # Firm's receptors out of order, one outside `idx`, one year only
+        firm_idx = pd.MultiIndex.from_tuples(
+            [(100, 100), (0, 0), (200, 0)], names=['utm_east', 'utm_north'])
+        firm = pd.DataFrame([[1.], [2.], [3.]], index=firm_idx,
+                            columns=self.col_idx[1:])
+        running_tot = np.ones((4, 2))
+        _add_firm_exposure(running_tot, self.idx, self.col_idx, firm)
+        expected = (pd.DataFrame(np.ones((4, 2)), index=self.idx,
+                                 columns=self.col_idx) +
+                    firm.reindex(index=self.idx,
+                                 columns=self.col_idx).fillna(0))
+        assert_frame_equal(expected, pd.DataFrame(running_tot, index=self.idx,
+                                                  columns=self.col_idx))
+
+
+class TestBilinearCells(object):
+
+    def setUp(self):
+        # 100m cells, exposure linear in UTM, 2 quarters x 3 years
+        east, north = np.meshgrid(np.arange(0, 500, 100),
+                                  np.arange(1000, 1500, 100), indexing='ij')
+        east, north = east.ravel(), north.ravel()
+        slopes = np.arange(1., 7.).reshape(1, 2, 3)
+        values = (east[:, np.newaxis, np.newaxis] * slopes +
+                  north[:, np.newaxis, np.newaxis] / slopes)
+        columns = pd.MultiIndex.from_tuples(
+            [(y, 'aermod') for y in (1997, 1998, 1999)],
+            names=['year', 'model'])
+        self.slopes = slopes
+        self.cells = GridCells(utm_keys(east, north), values, [1, 2], columns)
+
+    def test_linear_is_exact(self):
+        east = np.array([150., 0., 333.3])
+        north = np.array([1210., 1000., 1399.9])
+        values, found = _bilinear_cells(self.cells, east, north)
+        assert found.all()
+        expected = (east[:, np.newaxis, np.newaxis] * self.slopes +
+                    north[:, np.newaxis, np.newaxis] / self.slopes)
+        np.testing.assert_allclose(values, expected)
+
+    def test_missing_cells(self):
+        # On the east edge (only 2 corners), and off the grid
+        east = np.array([400., 650.])
+        north = np.array([1250., 1250.])
+        values, found = _bilinear_cells(self.cells, east, north)
+        assert_equal(found.tolist(), [True, False])
+        expected = (400 * self.slopes + 1250 / self.slopes)
+        np.testing.assert_allclose(values[0], expected[0])
+
+
 if __name__ == '__main__':
     import sys
     argv = [__file__, '-vs', '-a', '!slow'] + sys.argv[1:]
@@ -0,0 +1,39 @@
+import nose
+from pandas.util.testing import assert_frame_equal, assert_series_equal
+
+import numpy as np
+import pandas as pd
+
+from atmods.refresh import _emit_to_json, _emit_from_json, _same_inputs
+
+
+class TestEmitJson(object):
+
+    def test_quarterly(self):
+        years = pd.Index([1995, 1996], name='year')
+        quarters = pd.Index(range(1, 4 + 1), name='quarter')
+        emit = pd.DataFrame(np.arange(8.).reshape(2, 4), index=years,
+                            columns=quarters)
+        emit.iloc[1, 2] = np.nan
+        assert_frame_equal(emit, _emit_from_json(_emit_to_json(emit)))
+
+    def test_annual(self):
+        years = pd.Index([1995, 1996], name='year')
+        emit = pd.Series([1., np.nan], index=years, name='lead')
+        assert_series_equal(emit, _emit_from_json(_emit_to_json(emit)))
+
+    def test_no_emissions(self):
+        assert _emit_from_json(_emit_to_json(None)) is None
+
+
+class TestSameInputs(object):
+
+    def test_changed(self):
+        old = {'normed': 'file:10:1.5', 'emit_hash': 'abc'}
+        assert _same_inputs(old, dict(old))
+        assert not _same_inputs(old, dict(old, normed='file:10:2.5'))
+        assert not _same_inputs(old, dict(old, emit_hash='abd'))
+
+
+if __name__ == '__main__':
+    nose.runmodule(argv=[__file__, '-v'], exit=False)
@@ -0,0 +1,49 @@
+import os
+import tempfile
+
+import nose
+from nose.tools import assert_raises
+from pandas.util.testing import assert_frame_equal
+
+import numpy as np
+import pandas as pd
+
+from util import UTM
+from atmods.aermod import read_postfile
+from atmods.run_and_write import _reduce_aermodout, _format_aermodout
+
+
+class TestReduceAermodout(object):
+
+    def setUp(self):
+        N = 7
+        self.receptors = pd.DataFrame(
+            np.column_stack((np.arange(N) * 100 + 378000,
+                             np.arange(N)[::-1] * 100 + 3782000)),
+            columns=UTM)
+        line = ("  {:.2f}  {:.2f}  {:13.5f}     22.00     22.00      0.00"
+                "  MONTH    ALL      09{:02d}3124\n")
+        fd, self.filepath = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            for month in range(1, 12 + 1):
+                for x, y in self.receptors.values:
+                    conc = (x % 97 + y % 89) * month / 100.
+                    f.write(line.format(x, y, conc, month))
+
+    def tearDown(self):
+        os.remove(self.filepath)
+
+    def test_matches_format_aermodout(self):
+        expected = _format_aermodout(read_postfile(self.filepath))
+        result = _reduce_aermodout(self.filepath, self.receptors, chunksize=5)
+        assert_frame_equal(expected, result, check_column_type=False,
+                           check_index_type=False)
+
+    def test_out_of_order(self):
+        shuffled = self.receptors.iloc[::-1]
+        assert_raises(ValueError, _reduce_aermodout, self.filepath,
+                      shuffled)
+
+
+if __name__ == '__main__':
+    nose.runmodule(argv=[__file__, '-v'], exit=False)
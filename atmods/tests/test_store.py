@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+
+import nose
+from nose.tools import assert_equal, assert_raises
+from pandas.util.testing import assert_frame_equal
+
+import numpy as np
+import pandas as pd
+
+from atmods.store import ExposureStore, write_store
+
+
+def _fake_firm(facid, num_receptors=50):
+    np.random.seed(facid)
+    utm = np.random.randint(0, 20, (num_receptors, 2)) * 100
+    utm = pd.DataFrame(utm, columns=['utm_east', 'utm_north']).astype(
+        np.int32).drop_duplicates()
+    index = pd.MultiIndex.from_arrays([utm['utm_east'], utm['utm_north']])
+    columns = pd.Index(range(1, 4 + 1), name='quarter')
+    return pd.DataFrame(np.random.rand(len(index), 4), index=index,
+                        columns=columns)
+
+
+class TestExposureStore(object):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.folder, 'grid_aermod_store')
+        self.firms = {facid: _fake_firm(facid) for facid in (30, 10, 20)}
+        write_store(self.store_path, self.firms.keys(), self.firms.get)
+        self.store = ExposureStore(self.store_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_roundtrip(self):
+        for facid, expected in self.firms.items():
+            result = self.store.load_firm(facid)
+            expected = expected.sort_index().astype(np.float32)
+            assert_frame_equal(expected, result, check_index_type=False)
+
+    def test_contains(self):
+        assert self.store.exists()
+        assert 20 in self.store
+        assert 40 not in self.store
+        assert_equal(self.store.facids.tolist(), [10, 20, 30])
+
+    def test_positions(self):
+        assert_equal(self.store.positions([30, 10]).tolist(), [2, 0])
+        assert_raises(KeyError, self.store.positions, [40])
+
+    def test_shared_receptors(self):
+        all_utm = set()
+        for df in self.firms.values():
+            all_utm.update(df.index.tolist())
+        assert_equal(len(self.store.receptors), len(all_utm))
+
+    def test_series(self):
+        series_path = os.path.join(self.folder, 'grid_unif5_store')
+        firms = {facid: self.firms[facid][1].rename('unif5')
+                 for facid in self.firms}
+        write_store(series_path, firms.keys(), firms.get)
+        result = ExposureStore(series_path).load_firm(10)
+        assert_equal(result.columns.tolist(), ['unif5'])
+
+    def test_rewrite(self):
+        firms = {10: self.firms[10] * 2}
+        write_store(self.store_path, firms.keys(), firms.get)
+        store = ExposureStore(self.store_path)
+        assert 20 not in store
+        assert_frame_equal(store.load_firm(10),
+                           (self.firms[10] * 2).sort_index().astype(
+                               np.float32),
+                           check_index_type=False)
+
+    def test_no_firms(self):
+        assert_raises(ValueError, write_store,
+                      os.path.join(self.folder, 'empty'), [], None)
+
+
+if __name__ == '__main__':
+    nose.runmodule(argv=[__file__, '-v'], exit=False)
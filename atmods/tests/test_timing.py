@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+
+import nose
+from nose.tools import assert_equal, assert_almost_equal
+
+import numpy as np
+
+from atmods.aermod import TIMING_LINE
+from atmods.timing import (parse_timing_lines, ingest_job_logs,
+                           fit_cost_model, load_cost_model,
+                           predict_sec_per_unit, MIN_RUNS, MET_PREFIX)
+
+
+class TestTiming(object):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.root, 'timing.db')
+        self.log_dir = os.path.join(self.root, 'logs')
+        os.mkdir(self.log_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write_log(self, jobname, runs, stacks=None, metsites=None,
+                   met_effects={}):
+        lines = ['Some other output']
+        if stacks is None:
+            stacks = [1] * len(runs)
+        if metsites is None:
+            metsites = ['burk'] * len(runs)
+        for (stack_ht, receptors), num_stacks, metsite in zip(runs, stacks,
+                                                              metsites):
+            # Exact linear cost
+            sec_per_unit = (.02 + .001 * stack_ht + .01 * receptors / 1000 +
+                            .002 * num_stacks + met_effects.get(metsite, 0))
+            lines.append(TIMING_LINE.format(
+                units=receptors * num_stacks, sec_per_unit=sec_per_unit,
+                stacks=num_stacks, receptors=receptors, stack_ht=stack_ht,
+                metsite=metsite))
+        with open(os.path.join(self.log_dir, jobname + '.out'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def test_parse_old_and_new(self):
+        lines = ['1000 units, 0.0650 sec per unit\n',
+                 'junk\n',
+                 TIMING_LINE.format(units=2000, sec_per_unit=.05, stacks=2,
+                                    receptors=1000, stack_ht=30.,
+                                    metsite='burk')]
+        runs = parse_timing_lines(lines)
+        assert_equal(len(runs), 2)
+        assert_equal(runs[0]['stack_ht'], None)
+        assert_equal(runs[1]['receptors'], '1000')
+        assert_equal(runs[1]['line_no'], 2)
+
+    def test_ingest_idempotent(self):
+        self._write_log('hA10c11', [(30., 1000), (40., 2000)])
+        added = ingest_job_logs(log_dir=self.log_dir, db_path=self.db_path)
+        assert_equal(added, 2)
+        added = ingest_job_logs(log_dir=self.log_dir, db_path=self.db_path)
+        assert_equal(added, 0)
+
+    def test_fit_recovers_cost(self):
+        np.random.seed(0)
+        stack_ht = np.random.uniform(10, 100, MIN_RUNS)
+        receptors = np.random.randint(1000, 20000, MIN_RUNS)
+        self._write_log('hA10c11', zip(stack_ht, receptors))
+        ingest_job_logs(log_dir=self.log_dir, db_path=self.db_path)
+
+        fit_cost_model('house', db_path=self.db_path)
+        model = load_cost_model('house', db_path=self.db_path)
+        # Every run has one stack, so its cost is in the intercept
+        assert_almost_equal(model['intercept'], .02 + .002, places=3)
+        assert_almost_equal(model['stack_ht'], .001, places=4)
+        assert_equal(model['stacks'], 0)
+        expected = .02 + .002 + .001 * 50 + .01 * 5
+        assert_almost_equal(predict_sec_per_unit(model, 50, 5000), expected,
+                            places=3)
+
+    def test_fit_recovers_stacks_and_met(self):
+        np.random.seed(0)
+        N = MIN_RUNS * 2
+        stack_ht = np.random.uniform(10, 100, N)
+        receptors = np.random.randint(1000, 20000, N)
+        stacks = np.random.randint(1, 10, N)
+        metsites = ['burk'] * (N // 2) + ['lgbh'] * (N // 4) + ['ontr'] * (
+            N - N // 2 - N // 4)
+        self._write_log('hA10c11', zip(stack_ht, receptors), stacks=stacks,
+                        metsites=metsites,
+                        met_effects={'lgbh': .03, 'ontr': -.01})
+        ingest_job_logs(log_dir=self.log_dir, db_path=self.db_path)
+
+        fit_cost_model('house', db_path=self.db_path)
+        model = load_cost_model('house', db_path=self.db_path)
+        assert_almost_equal(model['stacks'], .002, places=4)
+        assert_almost_equal(model[MET_PREFIX + 'lgbh'], .03, places=3)
+        assert_almost_equal(model[MET_PREFIX + 'ontr'], -.01, places=3)
+        assert MET_PREFIX + 'burk' not in model
+        expected = .02 + .001 * 50 + .01 * 5 + .002 * 4
+        predicted = predict_sec_per_unit(model, np.array([50, 50, 50]),
+                                         5000, stacks=4,
+                                         metsite=['burk', 'lgbh', 'new'])
+        np.testing.assert_allclose(predicted, [expected, expected + .03,
+                                               expected], atol=1e-3)
+
+    def test_no_model(self):
+        self._write_log('hA10c11', [(30., 1000)])
+        ingest_job_logs(log_dir=self.log_dir, db_path=self.db_path)
+        assert_equal(fit_cost_model('house', db_path=self.db_path), None)
+        assert_equal(load_cost_model('house', db_path=self.db_path), None)
+        assert_equal(load_cost_model('grid', db_path=self.db_path), None)
+
+
+if __name__ == '__main__':
+    nose.runmodule(argv=[__file__, '-v'], exit=False)
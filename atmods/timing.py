@@ -0,0 +1,215 @@
+"""
+Local database of Aermod run times, and a cost model fit from them.
+
+Each Aermod run prints a `atmods.aermod.TIMING_LINE` to its Slurm job's log.
+`ingest_job_logs` collects those into a sqlite database and `fit_cost_model`
+regresses seconds per unit (stack x receptor) on stack height, receptor and
+stack counts, and met site for each geounit. `chunktools.calc_resources`
+sizes chunks and `batchrun` requests time from the stored fit, falling back
+to `CPU_SEC_PER_UNIT` for geounits without one.
+
+Fits are only updated when `fit_cost_model` is called, so chunk counts (and
+job names) stay stable between `check_jobs` and `batchrun` calls.
+"""
+from __future__ import division
+
+import os
+import re
+import sqlite3
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from util.system import data_path
+from atmods.env import JOB_OUT_PATH
+
+TIMING_DB_PATH = data_path('aermod_timing.db')
+
+# Old logs only have the first two fields
+TIMING_RE = re.compile(
+    r'^(?P<units>\d+) units, (?P<sec_per_unit>[\d.]+) sec per unit'
+    r'(?:, (?P<stacks>\d+) stacks, (?P<receptors>\d+) receptors, '
+    r'stack_ht (?P<stack_ht>[\d.]+), met (?P<metsite>\S+))?\s*$'
+)
+GEOUNIT_INITIALS = {'h': 'house', 'b': 'block', 'g': 'grid', 'm': 'monitor'}
+
+COST_REGRESSORS = ['stack_ht', 'receptors_k', 'stacks']
+# Fitted met site effects are stored as '{MET_PREFIX}{metsite}'
+MET_PREFIX = 'met_'
+# Don't fit on fewer runs than this
+MIN_RUNS = 30
+# Quantile of actual/predicted run time to pad time requests by
+BUFFER_QUANTILE = 0.95
+MIN_BUFFER = 1.1
+MIN_SEC_PER_UNIT = 0.005
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS runs ("
+    "  jobname TEXT, line_no INTEGER, geounit TEXT, units INTEGER,"
+    "  sec_per_unit REAL, stacks INTEGER, receptors INTEGER, stack_ht REAL,"
+    "  metsite TEXT, PRIMARY KEY (jobname, line_no));"
+    "CREATE TABLE IF NOT EXISTS cost_terms ("
+    "  geounit TEXT, term TEXT, value REAL, PRIMARY KEY (geounit, term));"
+)
+
+
+def connect(db_path=TIMING_DB_PATH):
+    conn = sqlite3.connect(db_path)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def parse_timing_lines(lines):
+    """Return list of dicts, one per timing line in iterable `lines`."""
+    runs = []
+    for line_no, line in enumerate(lines):
+        match = TIMING_RE.match(line)
+        if match is None:
+            continue
+        run = match.groupdict()
+        run['line_no'] = line_no
+        runs.append(run)
+    return runs
+
+
+def ingest_job_logs(log_dir=JOB_OUT_PATH, db_path=TIMING_DB_PATH):
+    """
+    Add timing lines from Slurm logs ('{jobname}_{job id}.out') in
+    `log_dir` to the database. Re-ingesting a log doesn't duplicate its
+    runs. Returns number of runs added.
+    """
+    conn = connect(db_path)
+    count_before = conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+    for filename in os.listdir(log_dir):
+        jobname, ext = os.path.splitext(filename)
+        if ext != '.out' or jobname[0] not in GEOUNIT_INITIALS:
+            continue
+        with open(os.path.join(log_dir, filename)) as f:
+            runs = parse_timing_lines(f)
+        rows = [(jobname, run['line_no'], GEOUNIT_INITIALS[jobname[0]],
+                 run['units'], run['sec_per_unit'], run['stacks'],
+                 run['receptors'], run['stack_ht'], run['metsite'])
+                for run in runs]
+        conn.executemany(
+            "INSERT OR IGNORE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows)
+    conn.commit()
+    count_after = conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+    conn.close()
+    return count_after - count_before
+
+
+def load_runs(geounit, db_path=TIMING_DB_PATH):
+    conn = connect(db_path)
+    df = pd.read_sql("SELECT * FROM runs WHERE geounit = ?", conn,
+                     params=(geounit,))
+    conn.close()
+    return df
+
+
+def fit_cost_model(geounit, db_path=TIMING_DB_PATH):
+    """
+    Regress seconds per unit on stack height, receptors (1000s), stacks,
+    and met site dummies for `geounit`'s runs, weighted by units so long
+    runs dominate. Met site effects are relative to the site with the most
+    runs (`intercept`). Regressors that don't vary get 0. Stores and
+    returns the fit as a Series (see `load_cost_model`), or None if there
+    aren't `MIN_RUNS` runs with stack info.
+    """
+    runs = load_runs(geounit, db_path=db_path).dropna(subset=['stack_ht'])
+    if runs.shape[0] < MIN_RUNS:
+        print "Only {} timed runs for {}, not fitting".format(runs.shape[0],
+                                                              geounit)
+        return None
+    runs['receptors_k'] = runs['receptors'] / 1000
+    regressors = [x for x in COST_REGRESSORS if runs[x].nunique() > 1]
+    metsites = runs['metsite'].value_counts().index
+    mets = pd.get_dummies(runs['metsite'], prefix=MET_PREFIX, prefix_sep='')
+    mets = mets.drop(MET_PREFIX + metsites[0], axis=1).astype(float)
+
+    X = np.column_stack([np.ones(runs.shape[0]), runs[regressors].values,
+                         mets.values])
+    y = runs['sec_per_unit'].values
+    w = np.sqrt(runs['units'].values)
+    beta = np.linalg.lstsq(X * w[:, np.newaxis], y * w, rcond=-1)[0]
+
+    fit = pd.Series(beta,
+                    index=['intercept'] + regressors + mets.columns.tolist())
+    model = fit.reindex(['intercept'] + COST_REGRESSORS).fillna(0)
+    model = model.append(fit[mets.columns])
+    ratio = y / np.maximum(X.dot(beta), 1e-6)
+    model['buffer'] = max(np.percentile(ratio, BUFFER_QUANTILE * 100),
+                          MIN_BUFFER)
+    model['num_runs'] = runs.shape[0]
+
+    conn = connect(db_path)
+    conn.execute("DELETE FROM cost_terms WHERE geounit = ?", (geounit,))
+    conn.executemany("INSERT INTO cost_terms VALUES (?, ?, ?)",
+                     [(geounit, term, float(value))
+                      for term, value in model.iteritems()])
+    conn.commit()
+    conn.close()
+
+    return model
+
+
+def load_cost_model(geounit, db_path=TIMING_DB_PATH):
+    """
+    Return `geounit`'s stored fit as Series with `intercept`,
+    `COST_REGRESSORS` coefficients, met site effects, `buffer`, and
+    `num_runs`; None if it hasn't been fit.
+    """
+    if not os.path.isfile(db_path):
+        return None
+    conn = connect(db_path)
+    df = pd.read_sql("SELECT term, value FROM cost_terms WHERE geounit = ?",
+                     conn, params=(geounit,))
+    conn.close()
+    if df.empty:
+        return None
+    model = df.set_index('term')['value']
+    model.index.name = None
+    model.name = None
+    return model
+
+
+def predict_sec_per_unit(model, stack_ht, receptors, stacks=1,
+                         metsite=None):
+    """
+    Predicted seconds per unit from `model` (see `load_cost_model`). Met
+    sites the fit hasn't seen get the base site's cost.
+    """
+    sec_per_unit = (model['intercept'] +
+                    model['stack_ht'] * stack_ht +
+                    model['receptors_k'] * receptors / 1000 +
+                    model['stacks'] * stacks)
+    if metsite is not None:
+        # Fits on one met site have no effects
+        met_effects = pd.Series(
+            {term[len(MET_PREFIX):]: value for term, value in model.items()
+             if term.startswith(MET_PREFIX)}, dtype=np.float64)
+        if np.isscalar(metsite):
+            sec_per_unit += met_effects.get(metsite, 0.)
+        else:
+            sec_per_unit += pd.Series(np.asarray(metsite)).map(
+                met_effects).fillna(0).values
+    # Extrapolated fits shouldn't promise Aermod is free
+    return np.maximum(sec_per_unit, MIN_SEC_PER_UNIT)
+
+
+def cli_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('geounit',
+                        choices=['house', 'monitor', 'block', 'grid'],
+                        help='Geographic unit to fit cost model for')
+    parser.add_argument('--log-dir', default=JOB_OUT_PATH,
+                        help='Directory of Slurm job logs to ingest')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = cli_args()
+    print "Ingested {} runs".format(ingest_job_logs(log_dir=args.log_dir))
+    print fit_cost_model(args.geounit)
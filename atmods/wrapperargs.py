@@ -39,12 +39,26 @@ common_opts.add_argument('--altmaxdist', action='store_true',
 model_opts = argparse.ArgumentParser(add_help=False)
 model_opts.add_argument('--chunk-info', type=int, nargs=2, default=None,
                         help="Chunk id, Total Chunks")
+model_opts.add_argument('--shards', type=int, default=1,
+                        help="Split receptors across this many processes")
+model_opts.add_argument('--polar', action='store_true',
+                        help="Run Aermod on polar grid, interpolate receptors")
+model_opts.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help="Don't use or fill the Aermod output cache")
+model_opts.add_argument('--linear', action='store_true',
+                        help="Run stacks at unit emissions, sum by share")
+model_opts.add_argument('--unique-sources', action='store_true',
+                        help="Only run each unique stack at unit emissions, "
+                             "filling the cache for `--linear` runs")
 
 
 # sbatch-specific args
 sbatch_opts = argparse.ArgumentParser(add_help=False)
 # Designate firmlist
 sbatch_opts.add_argument('--facids', type=int, nargs='+')
+sbatch_opts.add_argument('--linear', action='store_true',
+                         help="Run unique stacks at unit emissions first, "
+                              "then firm-chunks from their cached runs")
 # Sbatch options
 sbatch_opts.add_argument('-t', '--timescale', type=float, default=1,
                          help="Scale default run time")
@@ -56,3 +70,16 @@ sbatch_opts.add_argument('--mail', choices=['all', 'end', 'start'],
                          action='append', default=['fail'])
 sbatch_opts.add_argument('--yes', action='store_true',
                          help="Submit to Slurm w/o confirmation")
+# Where to run
+sbatch_opts.add_argument('--executor', choices=['slurm', 'local'],
+                         default='slurm',
+                         help="Submit to Slurm or run on this machine")
+sbatch_opts.add_argument('--no-array', dest='array', action='store_false',
+                         help="Submit each firm-chunk as its own Slurm job")
+sbatch_opts.add_argument('--pack-minutes', type=float, default=120.,
+                         help="Pack small firm-chunks into array tasks of "
+                              "about this many minutes (0: don't pack)")
+sbatch_opts.add_argument('--procs', type=int, default=None,
+                         help="Cores for local executor (default: all)")
+sbatch_opts.add_argument('--mem-budget', type=int, default=None,
+                         help="MB for local executor (default: physical)")
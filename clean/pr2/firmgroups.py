@@ -5,8 +5,8 @@ from econtools import load_or_build, DataInteractModel
 
 from util import UTM
 from util.system import data_path
-from util.distance import getdist
-from util.networks import equiv_class
+from util.distance import SpatialIndex
+from util.networks import equiv_class_pairs
 from util.gis import draw_googlemap
 from clean.pr2.rawio import read_pr2table, build_int_qcer
 from clean.pr2.geocode import load_pr2geocodes
@@ -55,9 +55,8 @@ def combine_on_location(geocodes):
     emi = emi['emi']
 
     # Get 'equiv_classes' by distance
-    dists = getdist(geocodes, geocodes, within=.4)
-    dists.index = dists.columns
-    firm_groups = equiv_class(dists)
+    close, other, __ = SpatialIndex(geocodes).within(geocodes, .4)
+    firm_groups = equiv_class_pairs(geocodes.index, close, other)
     # Eyeball groups with more than one member
     firm_groups = firm_groups[firm_groups[1].notnull()]
     firm_groups_list = [b.dropna().astype(int).tolist()
@@ -3,10 +3,10 @@ Create flags for "ZIP+4 is in the coastal sample."
 """
 import pandas as pd
 import numpy as np
-from scipy.spatial.distance import cdist
 
 from econtools import load_or_build
 
+from util.distance import within_any
 from get_zip_utm import zip4_utms
 
 
@@ -47,7 +47,7 @@ def center_sw(regdata, maxdist=10, convex=False):
     region_points = get_region_points()
     _push_out_southwest(region_points)
     # Main "distance from seed firms" criterion
-    in_region = getdist(df, region_points, within=maxdist).max(axis=1)
+    in_region = within_any(df, region_points, maxdist)
 
     if convex:
         # Add area between circles
@@ -119,19 +119,5 @@ def get_region_points():
     return df
 
 
-def getdist(base, target, within=0):
-    distDF = pd.DataFrame(
-        cdist(base[UTM].values / 1000, target[UTM].values / 1000),
-        columns=target.index,
-    )
-    distDF.index = pd.MultiIndex.from_arrays(
-        [base['utm_east'], base['utm_north']])
-
-    if within > 0:
-        distDF = distDF <= within
-
-    return distDF
-
-
 if __name__ == '__main__':
     df = get_zip4_coast_flag(_rebuild=True)
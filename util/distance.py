@@ -1,12 +1,90 @@
 """
 Distance tools.
+
+`SpatialIndex` answers neighbor queries (pairs within a radius, nearest
+points, counts within a radius) with a KD-tree, without a dense
+(base x target) distance matrix. `getdist` builds that dense matrix and
+is kept for small problems. Distances are in km, UTM in meters.
 """
 import numpy as np
 import pandas as pd
+from scipy.spatial import cKDTree
 
 from util import UTM
 
 
+class SpatialIndex(object):
+    """
+    KD-tree over `points`' UTM (see `utm_array`). Query results are
+    positions in `points`.
+    """
+
+    def __init__(self, points):
+        self.utm = utm_array(points)
+        self.tree = cKDTree(self.utm)
+
+    def __len__(self):
+        return len(self.utm)
+
+    def within(self, targets, radius):
+        """
+        Every (target, point) pair within `radius` km (inclusive). Returns
+        arrays of target positions, point positions, and distances (km),
+        sorted by target.
+        """
+        target_utm = utm_array(targets)
+        neighbors = self.tree.query_ball_point(target_utm, radius * 1000.)
+        counts = np.array([len(x) for x in neighbors], dtype=np.int64)
+        target_pos = np.repeat(np.arange(len(target_utm)), counts)
+        if counts.sum():
+            point_pos = np.concatenate(
+                [x for x in neighbors if x]).astype(np.int64)
+        else:
+            point_pos = np.zeros(0, dtype=np.int64)
+        diff = target_utm[target_pos] - self.utm[point_pos]
+        dist = np.sqrt((diff ** 2).sum(axis=1)) / 1000.
+        return target_pos, point_pos, dist
+
+    def nearest(self, targets, k=1):
+        """
+        Distance (km) and position of each target's `k` nearest points,
+        shape (targets,) if `k` is 1, else (targets, k).
+        """
+        dist, point_pos = self.tree.query(utm_array(targets), k=k)
+        return dist / 1000., point_pos
+
+    def count_within(self, targets, radius):
+        """ Number of points within `radius` km of each target. """
+        neighbors = self.tree.query_ball_point(utm_array(targets),
+                                               radius * 1000.)
+        return np.array([len(x) for x in neighbors], dtype=np.int64)
+
+
+def utm_array(df):
+    """
+    (N, 2) float64 array of `df`'s UTM, from its UTM columns, or its index
+    if UTM is there. A Series is one point, an Index is its UTM levels.
+    """
+    if isinstance(df, pd.Series):
+        return df[UTM].values.astype(np.float64).reshape(1, 2)
+    if isinstance(df, pd.Index):
+        index = df
+    elif set(UTM) <= set(df.columns):
+        return df[UTM].values.astype(np.float64)
+    else:
+        index = df.index
+    utm = np.column_stack([index.get_level_values(x) for x in UTM])
+    return utm.astype(np.float64)
+
+
+def utm_index(df):
+    """ `df`'s UTM as a MultiIndex, like `getdist`'s rows. """
+    utm = utm_array(df)
+    if isinstance(df, pd.DataFrame) and set(UTM) <= set(df.columns):
+        return pd.MultiIndex.from_arrays([df[x] for x in UTM])
+    return pd.MultiIndex.from_arrays([utm[:, 0], utm[:, 1]], names=UTM)
+
+
 def center_data(df, target_utms, maxdist, grab=None):
     """Restrict `basedf` to the area within `maxdist` km of target points """
 
@@ -18,9 +96,10 @@ def center_data(df, target_utms, maxdist, grab=None):
         bases_utm = df.reset_index(UTM)[UTM].drop_duplicates()
         utm_in_index = True
 
-    dist_to_nn = getdist(bases_utm, target_utms).min(axis=1)
+    dist_to_nn, __ = SpatialIndex(target_utms).nearest(bases_utm)
     distname = 'dist_to_nn'
-    dist_to_nn.name = distname
+    dist_to_nn = pd.Series(dist_to_nn, index=utm_index(bases_utm),
+                           name=distname)
 
     if utm_in_index:
         centered_df = df.join(dist_to_nn)
@@ -53,6 +132,10 @@ def center_data(df, target_utms, maxdist, grab=None):
 
 
 def getdist(base, target, within=0):
+    """
+    Dense (base x target) distances in km (or `dist <= within` if
+    `within`). Memory is O(base x target); use `SpatialIndex` for big sets.
+    """
     base = base.copy()
     target = target.copy()
 
@@ -87,12 +170,22 @@ def getdist(base, target, within=0):
 
 
 def nearestneighbor(base, target, return_dist=False):
-    dist = getdist(base, target)
+    dist, target_pos = SpatialIndex(target).nearest(base)
 
-    targetID = dist.columns.name
-    nn = pd.DataFrame(dist.idxmin(axis=1), columns=[targetID])
+    targetID = target.index.name
+    nn = pd.DataFrame(target.index.values[target_pos], columns=[targetID],
+                      index=utm_index(base))
 
     if return_dist:
-        nn[targetID + '_distkm'] = dist.min(axis=1)
+        nn[targetID + '_distkm'] = dist
 
     return nn
+
+
+def within_any(base, target, within):
+    """
+    Boolean Series, indexed like `getdist`'s rows, of whether each `base`
+    point is within `within` km of any `target` point.
+    """
+    counts = SpatialIndex(target).count_within(base, within)
+    return pd.Series(counts > 0, index=utm_index(base))
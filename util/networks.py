@@ -1,5 +1,7 @@
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
 
 
 def equiv_class(indf):
@@ -22,6 +24,33 @@ def equiv_class(indf):
     return outdf
 
 
+def equiv_class_pairs(labels, rows, cols):
+    """
+    `equiv_class` of a relation given as pairs (`rows[i]`, `cols[i]`) of
+    positions in `labels`, instead of a dense indicator frame.
+    """
+    num = len(labels)
+    graph = sp.coo_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                          shape=(num, num))
+    __, component = connected_components(graph, directed=False)
+    labels = np.asarray(labels)
+
+    # Classes in order of their first member, like `equiv_class`
+    __, first = np.unique(component, return_index=True)
+    classes = [np.sort(labels[component == component[pos]])
+               for pos in np.sort(first)]
+    outdf = pd.DataFrame([pd.Series(names, name=names[0])
+                          for names in classes])
+
+    try:
+        outdf = outdf.astype(labels.dtype)
+    except ValueError as ve:
+        if not np.isnan(outdf).any().any():
+            raise ve
+
+    return outdf
+
+
 def make_transitive(inarr):
     """
     Make a non-directional relation matrix transitive; i.e., indicator matrix
@@ -0,0 +1,123 @@
+import nose
+from nose.tools import assert_equal
+
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_series_equal, assert_frame_equal
+
+from util import UTM
+from util.distance import getdist, SpatialIndex, within_any, utm_array
+from util.networks import equiv_class, equiv_class_pairs
+
+
+def _fake_points(num_points, seed):
+    np.random.seed(seed)
+    utm = np.random.randint(0, 100, size=(num_points, 2)) * 100
+    return pd.DataFrame(utm + [370000, 3730000], columns=UTM)
+
+
+class TestSpatialIndex(object):
+
+    def setUp(self):
+        self.base = _fake_points(300, 0)
+        self.target = _fake_points(20, 1)
+        self.radius = 1.5
+        self.dist = getdist(self.base, self.target).values
+        self.index = SpatialIndex(self.target)
+
+    def test_within(self):
+        base_pos, target_pos, dist = self.index.within(self.base,
+                                                       self.radius)
+        close = np.zeros(self.dist.shape, dtype=bool)
+        close[base_pos, target_pos] = True
+        np.testing.assert_array_equal(close, self.dist <= self.radius)
+        np.testing.assert_allclose(dist, self.dist[base_pos, target_pos])
+        assert (np.diff(base_pos) >= 0).all()
+
+    def test_nearest(self):
+        dist, target_pos = self.index.nearest(self.base)
+        np.testing.assert_allclose(dist, self.dist.min(axis=1))
+        np.testing.assert_allclose(
+            self.dist[np.arange(len(self.base)), target_pos], dist)
+
+    def test_count_within(self):
+        counts = self.index.count_within(self.base, self.radius)
+        np.testing.assert_array_equal(
+            counts, (self.dist <= self.radius).sum(axis=1))
+
+    def test_boundary_inclusive(self):
+        # Exactly `radius` km apart counts as within, like `getdist`
+        base = pd.DataFrame([[0, 0]], columns=UTM)
+        target = pd.DataFrame([[3000, 0], [0, 3001]], columns=UTM)
+        index = SpatialIndex(target)
+        __, target_pos, dist = index.within(base, 3)
+        np.testing.assert_array_equal(target_pos, [0])
+        np.testing.assert_allclose(dist, [3.])
+        np.testing.assert_array_equal(index.count_within(base, 3), [1])
+        np.testing.assert_array_equal(
+            getdist(base, target, within=3).values, [[True, False]])
+
+    def test_empty(self):
+        far = self.target + 10 ** 6
+        base_pos, target_pos, dist = SpatialIndex(far).within(self.base,
+                                                              self.radius)
+        assert_equal(len(base_pos), 0)
+        assert_equal(len(target_pos), 0)
+        assert_equal(len(dist), 0)
+        counts = SpatialIndex(far).count_within(self.base, self.radius)
+        np.testing.assert_array_equal(counts, np.zeros(len(self.base)))
+
+
+class TestWithinAny(object):
+
+    def test_matches_getdist(self):
+        base = _fake_points(300, 2)
+        target = _fake_points(10, 3)
+        expected = getdist(base, target, within=1.).any(axis=1)
+        result = within_any(base, target, 1.)
+        assert_series_equal(result, expected, check_names=False)
+
+    def test_none_within(self):
+        base = _fake_points(30, 4)
+        result = within_any(base, base.iloc[:1] + 10 ** 6, 1.)
+        assert not result.any()
+        assert_equal(len(result), len(base))
+
+
+class TestUtmArray(object):
+
+    def setUp(self):
+        self.df = pd.DataFrame([[1, 2, 10], [3, 4, 20]],
+                               columns=UTM + ['x'])
+        self.expected = np.array([[1., 2.], [3., 4.]])
+
+    def test_columns(self):
+        np.testing.assert_array_equal(utm_array(self.df), self.expected)
+
+    def test_index(self):
+        df = self.df.set_index(UTM)
+        np.testing.assert_array_equal(utm_array(df), self.expected)
+        np.testing.assert_array_equal(utm_array(df.index), self.expected)
+
+    def test_series(self):
+        utm = utm_array(self.df.iloc[1])
+        assert_equal(utm.shape, (1, 2))
+        np.testing.assert_array_equal(utm, self.expected[1:])
+
+
+class TestEquivClassPairs(object):
+
+    def test_matches_equiv_class(self):
+        labels = np.array([12, 3, 7, 25, 8, 14, 9])
+        rows = np.array([0, 2, 5, 4])
+        cols = np.array([2, 5, 0, 6])
+        dense = pd.DataFrame(np.eye(len(labels), dtype=bool),
+                             index=labels, columns=labels)
+        dense.values[rows, cols] = True
+        expected = equiv_class(dense)
+        result = equiv_class_pairs(labels, rows, cols)
+        assert_frame_equal(result, expected, check_names=False)
+
+
+if __name__ == '__main__':
+    nose.runmodule(argv=[__file__, '-v'], exit=False)